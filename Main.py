@@ -1,3 +1,6 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # the "import" startup phase starts here
+
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -5,15 +8,45 @@ load_dotenv()
 # Railway variables: BOT_TOKEN, ADMIN_ID, DATABASE_URL
 import os
 import re
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import csv
+import gzip
 import logging
-from datetime import datetime
-from typing import Optional, Dict, Any, List
+import functools
+import hashlib
+import hmac
+import json
+import math
+import multiprocessing
+import queue
+import random
+import secrets
+import signal
+import sys
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Iterator, Set, Tuple, TypeVar
+from urllib.parse import urlsplit, parse_qs
 
 from zoneinfo import ZoneInfo
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, TIMESTAMP, text
+from sqlalchemy import Engine, MetaData, Table, create_engine, inspect, insert, update, delete, select, and_, or_, func, Column, Index, Integer, String, BigInteger, Boolean, Date, Text, TIMESTAMP, text
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.dialects import postgresql, sqlite
 
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -28,6 +61,11 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
+    TypeHandler,
+    Updater,
     filters,
 )
 
@@ -35,492 +73,2639 @@ from telegram.ext import (
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_ID_RAW = os.environ.get("ADMIN_ID")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+ADMIN_ID = int(ADMIN_ID_RAW) if ADMIN_ID_RAW and ADMIN_ID_RAW.isdigit() else 0
 
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN environment variable is missing.")
-if not ADMIN_ID_RAW or not ADMIN_ID_RAW.isdigit():
-    raise RuntimeError("ADMIN_ID environment variable is missing or invalid.")
-ADMIN_ID = int(ADMIN_ID_RAW)
-if not DATABASE_URL:
-    raise RuntimeError("DATABASE_URL environment variable is missing.")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-)
-logger = logging.getLogger("iteach_bot")
-
-# DB setup
-Base = declarative_base()
-engine = create_engine(DATABASE_URL, echo=False, pool_pre_ping=True, future=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
-
-class Registration(Base):
-    __tablename__ = "registrations"
+def check_config() -> None:
+    # Checked when the bot is built, not on import, so tools can import Main without them.
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN environment variable is missing.")
+    if not ADMIN_ID:
+        raise RuntimeError("ADMIN_ID environment variable is missing or invalid.")
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL environment variable is missing.")
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    tg_user_id = Column(BigInteger, nullable=False, index=True)
-    username = Column(String, nullable=True)
-    first_name = Column(String, nullable=True)
-    last_name = Column(String, nullable=True)
-    full_name = Column(String, nullable=False)
-    age = Column(Integer, nullable=False)
-    phone = Column(String, nullable=False)
-    course = Column(String, nullable=False)
-    level = Column(String, nullable=True)
-    section = Column(String, nullable=False)
-    created_at = Column(TIMESTAMP(timezone=True), server_default=text("NOW() AT TIME ZONE 'UTC'"))
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "0") == "1"
+# Worker processes behind one update receiver (see "Multi-worker mode"); 1 runs in-process.
+BOT_WORKERS = max(1, int(os.environ.get("BOT_WORKERS", "1")))
+# Set in worker processes only (0..BOT_WORKERS-1); None in a single-process bot and the ingress.
+worker_index: Optional[int] = None
 
-Base.metadata.create_all(bind=engine)
+def is_primary_worker() -> bool:
+    # Work that must happen once per bot (admin outbox, stats backfill) runs here.
+    return worker_index in (None, 0)
 
-# ----------------------- Constants & Labels -----------------------
-COURSES = {
-    "english": "🇬🇧 Ingliz tili",
-    "german": "🇩🇪 Nemis tili",
-    "math": "🧮 Matematika",
-    "history": "📜 Tarix",
-    "biology": "🧬 Biologiya",
-    "chemistry": "⚗️ Kimyo",
-}
-COURSES_WITH_LEVEL = {"english", "german"}
+# ----------------------- Logging -----------------------
+# Loggers only put records on a queue; a listener thread formats and writes them, so log
+# I/O never runs on the event loop. When the queue is full, records below ERROR are dropped
+# and counted, while errors are written straight to stderr (one short line each, without
+# waiting for room), so they are never lost. LOG_FORMAT=text gives the old human-readable
+# lines.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_TRACE_SAMPLE = float(os.environ.get("LOG_TRACE_SAMPLE", "0.01"))
+LOG_QUEUE_SIZE = 10_000
 
-LEVELS = {
-    "A1": "A1 • Beginner",
-    "A2": "A2 • Elementary",
-    "B1": "B1 • Intermediate",
-    "B2": "B2 • Upper-Intermediate",
-    "C1": "C1 • Advanced",
-    "C2": "C2 • Proficient",
-}
+# Set per update by the update scheduler; copied into every record logged while it runs.
+log_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("log_context", default={})
 
-SECTIONS_ENGLISH = {
-    "kids": "👶 Kids",
-    "general": "📘 General",
-    "cefr": "🧭 CEFR",
-    "ielts": "🎓 IELTS",
-}
-SECTIONS_GERMAN = {
-    "kids": "👶 Kids",
-    "general": "📘 General",
-    "certificate": "🏅 Certificate",
-}
-SECTIONS_OTHERS = {
-    "kids": "👶 Kids",
-    "general": "📘 General",
-    "certificate": "🏅 Certificate",
-}
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "ctx", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
 
-TASHKENT_TZ = ZoneInfo("Asia/Tashkent")
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        ctx = getattr(record, "ctx", None)
+        if ctx:
+            head, sep, tail = line.partition("\n")
+            line = head + " [" + " ".join(f"{k}={v}" for k, v in ctx.items()) + "]" + sep + tail
+        return line
 
-# ----------------------- Helpers: Keyboards -----------------------
-def kb_register() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("🚀 Ro'yxatdan o'tish", callback_data="reg:start")]])
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, q: "queue.Queue[logging.LogRecord]"):
+        super().__init__(q)
+        self.dropped = 0
+        self.overflowed = 0
+        self._reported = 0
 
-def kb_courses() -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    items = list(COURSES.items())
-    # make rows of 2
-    for i in range(0, len(items), 2):
-        row = []
-        for key, label in items[i:i+2]:
-            row.append(InlineKeyboardButton(label, callback_data=f"reg:course:{key}"))
-        rows.append(row)
-    rows.append([InlineKeyboardButton("❌ Bekor qilish", callback_data="reg:cancel")])
-    return InlineKeyboardMarkup(rows)
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only the message is rendered here; tracebacks are formatted on the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        record.ctx = log_context.get()
+        return record
 
-def kb_levels() -> InlineKeyboardMarkup:
-    rows = [
-        [
-            InlineKeyboardButton(LEVELS["A1"], callback_data="reg:level:A1"),
-            InlineKeyboardButton(LEVELS["A2"], callback_data="reg:level:A2"),
-        ],
-        [
-            InlineKeyboardButton(LEVELS["B1"], callback_data="reg:level:B1"),
-            InlineKeyboardButton(LEVELS["B2"], callback_data="reg:level:B2"),
-        ],
-        [
-            InlineKeyboardButton(LEVELS["C1"], callback_data="reg:level:C1"),
-            InlineKeyboardButton(LEVELS["C2"], callback_data="reg:level:C2"),
-        ],
-        [InlineKeyboardButton("⬅️ Ortga (Kurslar)", callback_data="reg:back:courses")],
-    ]
-    return InlineKeyboardMarkup(rows)
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno >= logging.ERROR:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                # Blocking here would stall the event loop in the middle of an error burst.
+                self.overflowed += 1
+                sys.stderr.write(f"{record.levelname} {record.name}: {record.msg} {record.ctx or ''}\n")
+            return
+        try:
+            if self.dropped > self._reported:
+                missed = self.dropped - self._reported
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": "iteach_bot", "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"Log queue was full; dropped {missed} record(s)", "ctx": {},
+                }))
+                self._reported += missed
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
-def kb_sections(course_key: str) -> InlineKeyboardMarkup:
-    if course_key == "english":
-        sections = SECTIONS_ENGLISH
-        back = "reg:back:levels"
-    elif course_key == "german":
-        sections = SECTIONS_GERMAN
-        back = "reg:back:levels"
+def setup_logging() -> Tuple[NonBlockingQueueHandler, QueueListener]:
+    output = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
     else:
-        sections = SECTIONS_OTHERS
-        back = "reg:back:courses"
+        output.setFormatter(TextFormatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s"))
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Bot API request at INFO, bot token included in the URL.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler, listener
 
-    rows: List[List[InlineKeyboardButton]] = []
-    items = list(sections.items())
-    for i in range(0, len(items), 2):
-        row = []
-        for key, label in items[i:i+2]:
-            row.append(InlineKeyboardButton(label, callback_data=f"reg:section:{key}"))
-        rows.append(row)
-    rows.append([InlineKeyboardButton("⬅️ Ortga", callback_data=back)])
-    rows.append([InlineKeyboardButton("❌ Bekor qilish", callback_data="reg:cancel")])
-    return InlineKeyboardMarkup(rows)
+log_handler, log_listener = setup_logging()
+logger = logging.getLogger("iteach_bot")
+# High-volume traces (every callback, every write batch) go here, guarded by trace_sampled()
+# so that a trace left out costs one random() call and no LogRecord.
+trace_logger = logging.getLogger("iteach_bot.trace")
 
-def kb_review() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Tasdiqlash", callback_data="reg:confirm"),
-            InlineKeyboardButton("✏️ O‘zgartirish", callback_data="reg:edit"),
-        ],
-        [InlineKeyboardButton("❌ Bekor qilish", callback_data="reg:cancel")],
-    ])
+def trace_sampled() -> bool:
+    return random.random() < LOG_TRACE_SAMPLE
 
-def kb_edit_menu(course_key: str) -> InlineKeyboardMarkup:
-    row1 = [InlineKeyboardButton("📚 Kurs", callback_data="reg:edit:course"),
-            InlineKeyboardButton("🗂 Bo‘lim", callback_data="reg:edit:section")]
-    row2 = [InlineKeyboardButton("👤 Ism familiya", callback_data="reg:edit:name"),
-            InlineKeyboardButton("🎂 Yosh", callback_data="reg:edit:age")]
-    row3 = [InlineKeyboardButton("📱 Telefon", callback_data="reg:edit:phone")]
-    rows = [row1, row2, row3]
-    if course_key in COURSES_WITH_LEVEL:
-        rows.insert(1, [InlineKeyboardButton("📊 Daraja", callback_data="reg:edit:level")])
-    rows.append([InlineKeyboardButton("⬅️ Ortga (Ko‘rib chiqish)", callback_data="reg:back:review")])
-    return InlineKeyboardMarkup(rows)
+# ----------------------- Metrics -----------------------
+# Prometheus text format without a client library. Metrics are updated from the event
+# loop and the DB threads (hence the locks) and rendered on scrape at /metrics.
+METRICS_PORT = os.environ.get("METRICS_PORT", "")
+FUNNEL_IDLE_SECONDS = float(os.environ.get("FUNNEL_IDLE_SECONDS", "1800"))
+FUNNEL_SWEEP_SECONDS = 60.0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-# ----------------------- Helpers: Validation -----------------------
-NAME_REGEX = re.compile(r"^[A-Za-zÀ-ÖØ-öø-ÿ'`-]+(?:\s+[A-Za-zÀ-ÖØ-öø-ÿ'`-]+)+$")
+metrics_registry: List["Metric"] = []
 
-def valid_full_name(s: str) -> bool:
-    s = s.strip()
-    return bool(NAME_REGEX.match(s)) and (2 <= len(s.split()) <= 5)
+def _metric_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
 
-def valid_age(s: str) -> bool:
-    if not s.isdigit():
-        return False
-    n = int(s)
-    return 3 <= n <= 100
+def _label_value(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-PHONE_REGEX = re.compile(r"^\+998\d{9}$")
+class Metric:
+    kind = "untyped"
 
-def normalize_phone(text: str) -> Optional[str]:
-    t = text.strip().replace(" ", "")
-    if t.startswith("998") and len(t) == 12:
-        t = "+" + t
-    if PHONE_REGEX.match(t):
-        return t
-    return None
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
 
-# ----------------------- Content builders -----------------------
-def build_review_text(d: Dict[str, Any]) -> str:
-    course_label = COURSES.get(d.get("course_key", ""), d.get("course_label", ""))
-    level_label = d.get("level_label")
-    section_label = d.get("section_label")
-    full_name = d.get("full_name", "")
-    age = d.get("age", "")
-    phone = d.get("phone", "")
+    def _labels(self, values: Tuple[Any, ...], extra: str = "") -> str:
+        pairs = [f'{k}="{_label_value(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
 
-    lines = [
-        "🧾 *Ma’lumotlarni ko‘rib chiqing:*",
-        f"• 📚 *Kurs:* {course_label}",
-        f"• 🗂 *Bo‘lim:* {section_label}",
-        f"• 👤 *Ism familiya:* {full_name}",
-        f"• 🎂 *Yosh:* {age}",
-        f"• 📱 *Telefon:* {phone}",
-    ]
-    if d.get("course_key") in COURSES_WITH_LEVEL and level_label:
-        lines.insert(2, f"• 📊 *Daraja:* {level_label}")
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
 
-    return "\n".join(lines)
+    def samples(self) -> List[str]:
+        return []
 
-def build_admin_text(d: Dict[str, Any], u) -> str:
-    course_label = COURSES.get(d.get("course_key", ""), d.get("course_label", ""))
-    level_label = d.get("level_label")
-    section_label = d.get("section_label")
-    full_name = d.get("full_name", "")
-    age = d.get("age", "")
-    phone = d.get("phone", "")
+class CounterMetric(Metric):
+    kind = "counter"
 
-    username = f"@{u.username}" if u.username else "@None"
-    tnow = datetime.now(TASHKENT_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_, labels)
+        self.values: Dict[Tuple[Any, ...], float] = {}
 
-    lines = [
-        "🔔 *Yangi o‘quvchi ro‘yxatdan o‘tdi*",
-        f"👤 *Ism:* {full_name}",
-        f"🎂 *Yosh:* {age}",
-        f"📱 *Telefon:* {phone}",
-        f"📚 *Kurs:* {course_label}",
-        f"🗂 *Bo‘lim:* {section_label}",
-    ]
-    if d.get("course_key") in COURSES_WITH_LEVEL and level_label:
-        lines.insert(6, f"📊 *Daraja:* {level_label}")
+    def inc(self, *labels, value: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
 
-    lines += [
-        f"🆔 *Telegram ID:* {u.id}",
-        f"👤 *Username:* {username}",
-        f"📅 *Sana:* {tnow} (Asia/Tashkent)",
-    ]
-    return "\n".join(lines)
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self.values.items(), key=lambda kv: tuple(map(str, kv[0])))
+        return [f"{self.name}{self._labels(k)} {_metric_value(v)}" for k, v in items]
 
-# ----------------------- Flow helpers -----------------------
-async def goto_courses(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        "📚 Qaysi *kurs*da o‘qimoqchisiz?\n"
-        "_Iltimos, quyidagilardan birini tanlang._"
-    )
-    if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=kb_courses(), parse_mode="Markdown")
-    else:
-        await update.message.reply_text(text, reply_markup=kb_courses(), parse_mode="Markdown")
-    context.user_data["step"] = "choose_course"
+class GaugeMetric(Metric):
+    # Read on scrape from live objects, so nothing has to keep it up to date.
+    kind = "gauge"
 
-async def goto_levels(query, context):
-    await query.edit_message_text(
-        "📊 Iltimos, *darajangizni* tanlang:",
-        reply_markup=kb_levels(),
-        parse_mode="Markdown",
-    )
-    context.user_data["step"] = "choose_level"
+    def __init__(self, name: str, help_: str, collect: Callable[[], Dict[Tuple[Any, ...], float]], labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_, labels)
+        self.collect = collect
 
-async def goto_sections(query, context):
-    course_key = context.user_data.get("course_key")
-    await query.edit_message_text(
-        "🗂 Iltimos, *bo‘lim*ni tanlang:",
-        reply_markup=kb_sections(course_key),
-        parse_mode="Markdown",
-    )
-    context.user_data["step"] = "choose_section"
+    def samples(self) -> List[str]:
+        try:
+            values = self.collect()
+        except Exception:
+            return []
+        return [f"{self.name}{self._labels(k)} {_metric_value(v)}" for k, v in sorted(values.items())]
 
-async def ask_full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = (
-        "✍️ *Iltimos, to‘liq ism-familiyangizni kiriting.*\n"
-        "_Masalan: Alamozon Alovuddinov_"
-    )
-    await update.effective_chat.send_message(msg, parse_mode="Markdown", reply_markup=ReplyKeyboardRemove())
-    context.user_data["step"] = "ask_name"
+class HistogramMetric(Metric):
+    kind = "histogram"
 
-async def ask_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.effective_chat.send_message("🎂 *Yoshingizni kiriting:*", parse_mode="Markdown")
-    context.user_data["step"] = "ask_age"
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: one count per bucket, one for +Inf, then the sum.
+        self.series: Dict[Tuple[Any, ...], List[float]] = {}
 
-async def ask_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    kb = ReplyKeyboardMarkup(
-        [[KeyboardButton("📱 Raqamni ulashish", request_contact=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-    await update.effective_chat.send_message(
-        "📞 *Telefon raqamingizni kiriting* (format: `+998XXXXXXXXX`) yoki pastdagi tugma orqali yuboring.",
-        parse_mode="Markdown",
-        reply_markup=kb,
-    )
-    context.user_data["step"] = "ask_phone"
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
 
-async def show_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = build_review_text(context.user_data)
-    if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=kb_review(), parse_mode="Markdown")
-    else:
-        await update.effective_chat.send_message(text, reply_markup=kb_review(), parse_mode="Markdown")
-    context.user_data["step"] = "review"
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(s)) for k, s in self.series.items())
+        lines = []
+        for labels, s in items:
+            total = 0
+            for bound, n in zip(self.buckets + (float("inf"),), s):
+                total += n
+                le = "+Inf" if bound == float("inf") else _metric_value(bound)
+                bucket_labels = self._labels(labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {total}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {_metric_value(s[-1])}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {total}")
+        return lines
 
-# ----------------------- Handlers -----------------------
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome = (
-        "Assalomu alaykum!\n"
-        "*Welcome to ITeach Academy* 🎓\n\n"
-        "Bizning o‘quv jamoamizga qo‘shilish va ro‘yxatdan o‘tish uchun pastdagi tugmani bosing."
-    )
-    await update.message.reply_text(welcome, reply_markup=kb_register(), parse_mode="Markdown")
-    context.user_data.clear()
+HANDLER_SECONDS = HistogramMetric("bot_handler_seconds", "Handler latency by handler and the flow step it ran in.", ("handler", "step"))
+HANDLER_ERRORS = CounterMetric("bot_handler_errors_total", "Handler exceptions by handler and flow step.", ("handler", "step"))
+BOT_API_SECONDS = HistogramMetric("bot_api_request_seconds", "Bot API call latency by method.", ("method",))
+BOT_API_ERRORS = CounterMetric("bot_api_errors_total", "Failed Bot API calls (HTTP errors and network failures) by method.", ("method",))
+DB_CHECKOUT_SECONDS = HistogramMetric(
+    "bot_db_pool_checkout_seconds", "Time to get a connection from the DB pool, including the pre-ping.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+REG_FLUSH_SECONDS = HistogramMetric("bot_registration_flush_seconds", "Commit time of one registration batch.")
+REGISTRATIONS = CounterMetric("bot_registrations_total", "Registrations by outcome (saved, duplicate, failed, imported).", ("outcome",))
+FUNNEL_ENTERED = CounterMetric("bot_funnel_entered_total", "Times users reached each flow step.", ("step",))
+FUNNEL_EXITED = CounterMetric(
+    "bot_funnel_exited_total",
+    "Users leaving the flow by last step and outcome (completed, duplicate, cancelled, idle).",
+    ("step", "outcome"),
+)
 
-async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    data = query.data or ""
-    await query.answer()
-    logger.info("Callback data: %s", data)
+class FunnelTracker:
+    # Where each user currently is in the flow. Users idle on a step for longer than
+    # FUNNEL_IDLE_SECONDS are counted as drop-outs on that step when metrics are scraped,
+    # and at most every FUNNEL_SWEEP_SECONDS as updates come in, so abandoned sessions are
+    # let go of even when nothing scrapes /metrics.
+    def __init__(self):
+        self.active: Dict[int, Tuple[str, float]] = {}
+        self.swept = time.monotonic()
 
-    # Cancel from anywhere
-    if data == "reg:cancel":
-        context.user_data.clear()
-        await query.edit_message_text("❌ Ro‘yxatdan o‘tish bekor qilindi.")
-        return
+    def observe(self, user_id: int, before: Optional[str], after: Optional[str]):
+        if time.monotonic() - self.swept >= FUNNEL_SWEEP_SECONDS:
+            self.sweep()
+        if after == before:
+            if after is not None:
+                self.active[user_id] = (after, time.monotonic())
+            return
+        if after is None:
+            self.leave(user_id, "cancelled")
+            return
+        FUNNEL_ENTERED.inc(after)
+        self.active[user_id] = (after, time.monotonic())
 
-    # Start registration -> choose course
-    if data == "reg:start":
-        await goto_courses(update, context)
-        return
+    def leave(self, user_id: int, outcome: str):
+        entry = self.active.pop(user_id, None)
+        if entry is not None:
+            FUNNEL_EXITED.inc(entry[0], outcome)
 
-    # Back navigations
-    if data == "reg:back:courses":
-        # cleanup level/section if any
-        context.user_data.pop("level_key", None)
-        context.user_data.pop("level_label", None)
-        context.user_data.pop("section_key", None)
-        context.user_data.pop("section_label", None)
-        await goto_courses(update, context)
-        return
+    def sweep(self):
+        self.swept = time.monotonic()
+        cutoff = self.swept - FUNNEL_IDLE_SECONDS
+        for user_id, (step, at) in list(self.active.items()):
+            if at < cutoff:
+                del self.active[user_id]
+                FUNNEL_EXITED.inc(step, "idle")
 
-    if data == "reg:back:levels":
-        # only for EN/DE
-        context.user_data.pop("section_key", None)
-        context.user_data.pop("section_label", None)
-        await goto_levels(query, context)
-        return
+    def by_step(self) -> Dict[Tuple[str], int]:
+        return Counter((step,) for step, _ in self.active.values())
 
-    if data == "reg:back:review":
-        await show_review(update, context)
-        return
+funnel = FunnelTracker()
 
-    # Choose course
-    if data.startswith("reg:course:"):
-        course_key = data.split(":")[2]
-        if course_key not in COURSES:
-            await query.edit_message_text("Noto‘g‘ri kurs tanlandi. Qaytadan urinib ko‘ring.")
-            return
-        context.user_data["course_key"] = course_key
-        context.user_data["course_label"] = COURSES[course_key]
-        # Reset dependent fields
-        context.user_data.pop("level_key", None)
-        context.user_data.pop("level_label", None)
-        context.user_data.pop("section_key", None)
-        context.user_data.pop("section_label", None)
-
-        if course_key in COURSES_WITH_LEVEL:
-            await goto_levels(query, context)
-        else:
-            await goto_sections(query, context)
-        return
+# Objects referenced here are defined further down; gauges only read them on scrape.
+GaugeMetric("bot_funnel_active_users", "Users currently on each flow step.", funnel.by_step, ("step",))
+GaugeMetric("bot_db_pool_in_use", "DB connections checked out of the pool.", lambda: {(): engine.pool.checkedout()} if engine is not None else {})
+GaugeMetric("bot_registration_queue_depth", "Confirmed registrations waiting for the writer.", lambda: {(): reg_writer.depth})
+GaugeMetric("bot_updates_running", "Updates being handled right now.", lambda: {(): update_scheduler.active})
+GaugeMetric("bot_updates_pending", "Updates accepted but not finished.", lambda: {(): sum(update_scheduler.depths.values())})
+GaugeMetric("bot_log_queue_depth", "Log records waiting for the log writer thread.", lambda: {(): log_handler.queue.qsize()})
+GaugeMetric("bot_log_records_dropped", "Log records below ERROR dropped because the log queue was full.", lambda: {(): log_handler.dropped})
+GaugeMetric("bot_log_errors_overflowed", "Error records written straight to stderr because the log queue was full.", lambda: {(): log_handler.overflowed})
 
-    # Choose level (only EN/DE)
-    if data.startswith("reg:level:"):
-        level_key = data.split(":")[2]
-        if level_key not in LEVELS:
-            await query.edit_message_text("Noto‘g‘ri daraja tanlandi. Qaytadan urinib ko‘ring.")
-            return
-        context.user_data["level_key"] = level_key
-        context.user_data["level_label"] = LEVELS[level_key]
-        await goto_sections(query, context)
-        return
+def instrumented(name: str):
+    """Record latency, errors and funnel movement for a handler, labelled by the flow step."""
+    def wrap(handler):
+        @functools.wraps(handler)
+        async def run(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user_data = context.user_data if context.user_data is not None else {}
+            before = user_data.get("step")
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(name, before or "-")
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, name, before or "-")
+                if update.effective_user:
+                    funnel.observe(update.effective_user.id, before, user_data.get("step"))
+        return run
+    return wrap
 
-    # Choose section
-    if data.startswith("reg:section:"):
-        section_key = data.split(":")[2]
-        course_key = context.user_data.get("course_key")
-        valid_keys = (
-            SECTIONS_ENGLISH if course_key == "english"
-            else SECTIONS_GERMAN if course_key == "german"
-            else SECTIONS_OTHERS
-        )
-        if section_key not in valid_keys:
-            await query.edit_message_text("Noto‘g‘ri bo‘lim tanlandi. Qaytadan urinib ko‘ring.")
-            return
-        context.user_data["section_key"] = section_key
-        context.user_data["section_label"] = valid_keys[section_key]
-        # Next ask full name
-        await ask_full_name(update, context)
-        return
-
-    # Review actions
-    if data == "reg:confirm":
-        # Validate all required fields are present
-        required = ["course_key", "course_label", "section_label", "full_name", "age", "phone"]
-        if context.user_data.get("course_key") in COURSES_WITH_LEVEL:
-            required.append("level_label")
-        missing = [k for k in required if not context.user_data.get(k)]
-        if missing:
-            await query.edit_message_text("Ma’lumotlar yetarli emas. Iltimos, qaytadan boshlang: /start")
-            context.user_data.clear()
-            return
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and failures of every Bot API call."""
 
-        # Save to DB
-        u = update.effective_user
-        d = context.user_data
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        # File downloads carry the file path in the URL; keep the label set small.
+        api_method = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
         try:
-            with SessionLocal() as session:
-                reg = Registration(
-                    tg_user_id=u.id,
-                    username=u.username,
-                    first_name=u.first_name,
-                    last_name=u.last_name,
-                    full_name=d["full_name"],
-                    age=int(d["age"]),
-                    phone=d["phone"],
-                    course=d["course_label"],
-                    level=d.get("level_label"),
-                    section=d["section_label"],
-                )
-                session.add(reg)
-                session.commit()
-        except Exception as e:
-            logger.exception("DB error: %s", e)
-            await query.edit_message_text("Server xatosi yuz berdi. Iltimos, birozdan so‘ng qayta urinib ko‘ring.")
-            return
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            BOT_API_ERRORS.inc(api_method)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            BOT_API_ERRORS.inc(api_method)
+        return code, payload
 
-        # Notify user
-        await query.edit_message_text(
-            "🎉 *Tabriklaymiz!* Siz ro‘yxatdan o‘tdingiz.\n"
-            "Tez orada siz bilan telefon raqamingiz orqali bog‘lanamiz.",
-            parse_mode="Markdown"
-        )
+def render_metrics() -> str:
+    funnel.sweep()
+    lines: List[str] = []
+    for metric in metrics_registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+# ----------------------- DB setup -----------------------
+# All DB work runs on a dedicated thread pool sized to the connection pool, so
+# handlers never block the event loop and never queue for a connection inside a thread.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# How long startup waits for a database that is not accepting connections yet.
+DB_CONNECT_TIMEOUT = float(os.environ.get("DB_CONNECT_TIMEOUT", "60"))
 
-        # Notify admin
+class TimedQueuePool(QueuePool):
+    def connect(self):
+        started = time.perf_counter()
         try:
-            admin_text = build_admin_text(context.user_data, update.effective_user)
-            await context.bot.send_message(chat_id=ADMIN_ID, text=admin_text, parse_mode="Markdown")
-        except Exception as e:
-            logger.warning("Failed to notify admin: %s", e)
+            return super().connect()
+        finally:
+            DB_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
 
-        context.user_data.clear()
-        return
+# SQLAlchemy names pool loggers after the pool class; keep this one as quiet as its own.
+logging.getLogger(f"{TimedQueuePool.__module__}.{TimedQueuePool.__name__}").setLevel(logging.WARNING)
 
-    if data == "reg:edit":
-        course_key = context.user_data.get("course_key", "")
-        await query.edit_message_text(
-            "Qaysi *bo‘limni* o‘zgartiramiz?",
-            reply_markup=kb_edit_menu(course_key),
-            parse_mode="Markdown",
-        )
-        context.user_data["step"] = "edit_menu"
-        return
+Base = declarative_base()
+# Engines are created by init_engines() when startup reaches the database, so importing
+# Main never connects; SessionLocal is bound to the pooled engine then.
+engine: Optional[Engine] = None
+bulk_engine: Optional[Engine] = None
+SessionLocal = sessionmaker(autoflush=False, autocommit=False, future=True)
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+# Long-running admin jobs (exports etc.) get their own threads and unpooled connections,
+# so they never take a connection or a thread away from signups.
+bulk_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="bulk")
 
-    if data.startswith("reg:edit:"):
-        field = data.split(":")[2]
-        context.user_data["edit_field"] = field
+def init_engines() -> None:
+    global engine, bulk_engine
+    if engine is not None:
+        return
+    engine = create_engine(
+        DATABASE_URL,
+        echo=False,
+        poolclass=TimedQueuePool,
+        pool_pre_ping=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=0,
+        pool_timeout=DB_POOL_TIMEOUT,
+        future=True,
+    )
+    bulk_engine = create_engine(DATABASE_URL, echo=False, poolclass=NullPool, future=True)
+    SessionLocal.configure(bind=engine)
 
-        if field == "course":
-            await goto_courses(update, context)
-            return
-        if field == "level":
-            await goto_levels(query, context)
-            return
-        if field == "section":
-            await goto_sections(query, context)
-            return
-        if field == "name":
-            await query.edit_message_text("✍️ Yangi *ism-familiya*ni kiriting:", parse_mode="Markdown")
-            context.user_data["step"] = "ask_name"
-            return
-        if field == "age":
-            await query.edit_message_text("🎂 Yangi *yosh*ni kiriting:", parse_mode="Markdown")
-            context.user_data["step"] = "ask_age"
+def connect_database() -> None:
+    # A database that is still starting (same deploy, failover) is retried with backoff.
+    init_engines()
+    deadline = time.monotonic() + DB_CONNECT_TIMEOUT
+    delay = 0.5
+    while True:
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
             return
-        if field == "phone":
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton("📱 Raqamni ulashish", request_contact=True)]],
-                resize_keyboard=True,
-                one_time_keyboard=True,
-            )
-            await query.edit_message_text(
-                "📞 Yangi *telefon*ni kiriting (format: `+998XXXXXXXXX`) yoki pastdagi tugma orqali yuboring.",
-                parse_mode="Markdown",
+        except OperationalError as e:
+            if time.monotonic() + delay > deadline:
+                raise
+            logger.warning("Database not reachable yet, retrying in %.1fs: %s", delay, str(e.orig).strip())
+            time.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+# The bot accepts updates before startup has reached the database (see "App bootstrap").
+# Until db_ready is set, run_db and run_bulk wait, so early updates and confirmations
+# queue instead of failing; if startup gives up, db_error makes them fail instead.
+db_ready = asyncio.Event()
+db_error: Optional[BaseException] = None
+
+def database_failed(error: BaseException) -> None:
+    global db_error
+    db_error = error
+    db_ready.set()
+
+async def wait_for_db() -> None:
+    await db_ready.wait()
+    if db_error is not None:
+        raise RuntimeError("The database is not available.") from db_error
+
+T = TypeVar("T")
+
+def in_executor(executor: ThreadPoolExecutor, fn: Callable[..., T], *args, **kwargs) -> "asyncio.Future[T]":
+    # The copied context carries the update's log_context into the worker thread.
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return loop.run_in_executor(executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+async def run_db(fn: Callable[..., T], *args, **kwargs) -> T:
+    await wait_for_db()
+    return await in_executor(db_executor, fn, *args, **kwargs)
+
+async def run_bulk(fn: Callable[..., T], *args, **kwargs) -> T:
+    await wait_for_db()
+    return await in_executor(bulk_executor, fn, *args, **kwargs)
+
+class Registration(Base):
+    # One signup per user and per phone number for each course (see migration_registration_indexes).
+    # Imported walk-ins have no Telegram account and share tg_user_id 0 (WALK_IN_USER_ID).
+    __tablename__ = "registrations"
+    __table_args__ = (
+        Index(
+            "uq_registrations_user_course", "tg_user_id", "course", unique=True,
+            postgresql_where=text("tg_user_id <> 0"), sqlite_where=text("tg_user_id <> 0"),
+        ),
+        # Month ranges for /export and the archiver.
+        Index("ix_registrations_created_at", "created_at"),
+        Index("uq_registrations_phone_course", "phone", "course", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    tg_user_id = Column(BigInteger, nullable=False, index=True)
+    username = Column(String, nullable=True)
+    first_name = Column(String, nullable=True)
+    last_name = Column(String, nullable=True)
+    full_name = Column(String, nullable=False)
+    age = Column(Integer, nullable=False)
+    phone = Column(String, nullable=False)
+    course = Column(String, nullable=False)
+    level = Column(String, nullable=True)
+    section = Column(String, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+# Case-insensitive @username lookups for /find.
+Index("ix_registrations_username_lower", func.lower(Registration.username))
+
+class RegistrationNameToken(Base):
+    # Lower-cased words of each registration's names, written with the registration, for
+    # /find. A name prefix is a range scan on the primary key; on Postgres the token uses
+    # the "C" collation, so index order is the byte order a prefix range relies on.
+    __tablename__ = "registration_name_tokens"
+
+    token = Column(String(64).with_variant(String(64, collation="C"), "postgresql"), primary_key=True)
+    registration_id = Column(Integer, primary_key=True)
+
+class UserState(Base):
+    # One row per context.user_data key, so only changed keys are ever written.
+    __tablename__ = "user_state"
+
+    tg_user_id = Column(BigInteger, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(Text, nullable=False)
+
+class AdminOutbox(Base):
+    # Admin notifications are written in the same transaction as the registration
+    # and delivered by AdminNotifier, so a Telegram failure never loses one.
+    __tablename__ = "admin_outbox"
+    __table_args__ = (
+        Index(
+            "ix_admin_outbox_pending", "next_attempt_at",
+            postgresql_where=text("sent_at IS NULL"), sqlite_where=text("sent_at IS NULL"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    sent_at = Column(TIMESTAMP(timezone=True), nullable=True)
+
+class CatalogCourse(Base):
+    __tablename__ = "catalog_courses"
+
+    key = Column(String, primary_key=True)
+    label = Column(String, nullable=False)
+    has_level = Column(Boolean, nullable=False, default=False)
+    position = Column(Integer, nullable=False, default=0)
+    active = Column(Boolean, nullable=False, default=True)
+
+class CatalogSection(Base):
+    # course_key "*" holds the sections of every course without its own list.
+    __tablename__ = "catalog_sections"
+
+    course_key = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    label = Column(String, nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+
+class CatalogLevel(Base):
+    __tablename__ = "catalog_levels"
+
+    key = Column(String, primary_key=True)
+    label = Column(String, nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+
+class CatalogMeta(Base):
+    # Bump version after editing the catalog tables; running bots pick it up.
+    __tablename__ = "catalog_meta"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=1)
+
+class RegistrationDailyStat(Base):
+    # Signups per Tashkent day/course/section/level, maintained on every insert so
+    # /stats never has to scan registrations. level is "" for courses without levels.
+    __tablename__ = "registration_daily_stats"
+
+    day = Column(Date, primary_key=True)
+    course = Column(String, primary_key=True)
+    section = Column(String, primary_key=True)
+    level = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class AppMeta(Base):
+    __tablename__ = "app_meta"
+
+    key = Column(String, primary_key=True)
+    value = Column(Text, nullable=False)
+
+class Broadcast(Base):
+    # One /broadcast: the admin's message is copied to every registered student matching
+    # the filters (labels, as stored in registrations; NULL matches all). Recipients are
+    # walked in tg_user_id order and last_user_id is the last one handled, so a restart
+    # resumes there.
+    __tablename__ = "broadcasts"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)  # where the report goes
+    from_chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(BigInteger, nullable=False)
+    course = Column(String, nullable=True)
+    section = Column(String, nullable=True)
+    level = Column(String, nullable=True)
+    status = Column(String, nullable=False, default="running")  # running, done, cancelled
+    total = Column(Integer, nullable=False, default=0)
+    last_user_id = Column(BigInteger, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    finished_at = Column(TIMESTAMP(timezone=True), nullable=True)
+
+class RegistrationArchive(Base):
+    # One archive file in ARCHIVE_DIR: registrations of one month (Tashkent time) with ids
+    # first_id..last_id, moved out of registrations by the Archiver. A month archived again
+    # (e.g. after a back-dated import) gets another file.
+    __tablename__ = "registration_archives"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    month = Column(Date, nullable=False, index=True)
+    file = Column(String, nullable=False, unique=True)
+    rows = Column(Integer, nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    archived_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+class RegistrationKey(Base):
+    # What the duplicate check needs of each archived registration, so one signup per user
+    # and per phone number for each course still holds after its row has left registrations.
+    __tablename__ = "registration_keys"
+    __table_args__ = (
+        Index("ix_registration_keys_user_course", "tg_user_id", "course"),
+        Index("ix_registration_keys_phone_course", "phone", "course"),
+    )
+
+    registration_id = Column(Integer, primary_key=True)
+    tg_user_id = Column(BigInteger, nullable=False)
+    phone = Column(String, nullable=False)
+    course = Column(String, nullable=False)
+    full_name = Column(String, nullable=False)
+    level = Column(String, nullable=True)
+    section = Column(String, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=True)
+
+# ----------------------- Migrations -----------------------
+# schema_version holds one row per applied migration. Startup applies the missing ones in
+# order, in one transaction that holds an advisory lock on Postgres, so processes starting
+# together (workers, a rolling deploy) apply each exactly once. SQLite commits DDL on its
+# own, so a migration must also be safe to run again after a crash halfway through.
+MIGRATION_LOCK_KEY = 7_402_215_001
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+# Migrations spell out their own tables and DDL instead of using the models above, so
+# what a version creates never changes with later edits to the models; a schema change is
+# always a new migration.
+
+def migration_baseline(conn) -> None:
+    # The schema as it was before versioning. Databases from that time already have some
+    # or all of it, so only missing tables are created; missing indexes on an existing
+    # registrations table are added by migration_registration_indexes.
+    meta = MetaData()
+    registrations = Table(
+        "registrations", meta,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("tg_user_id", BigInteger, nullable=False, index=True),
+        Column("username", String, nullable=True),
+        Column("first_name", String, nullable=True),
+        Column("last_name", String, nullable=True),
+        Column("full_name", String, nullable=False),
+        Column("age", Integer, nullable=False),
+        Column("phone", String, nullable=False),
+        Column("course", String, nullable=False),
+        Column("level", String, nullable=True),
+        Column("section", String, nullable=False),
+        Column("created_at", TIMESTAMP(timezone=True), server_default=func.now()),
+        Index("uq_registrations_user_course", "tg_user_id", "course", unique=True),
+        Index("uq_registrations_phone_course", "phone", "course", unique=True),
+    )
+    Index("ix_registrations_username_lower", func.lower(registrations.c.username))
+    Table(
+        "registration_name_tokens", meta,
+        Column("token", String(64).with_variant(String(64, collation="C"), "postgresql"), primary_key=True),
+        Column("registration_id", Integer, primary_key=True),
+    )
+    Table(
+        "user_state", meta,
+        Column("tg_user_id", BigInteger, primary_key=True),
+        Column("key", String, primary_key=True),
+        Column("value", Text, nullable=False),
+    )
+    Table(
+        "admin_outbox", meta,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("chat_id", BigInteger, nullable=False),
+        Column("text", Text, nullable=False),
+        Column("attempts", Integer, nullable=False),
+        Column("next_attempt_at", TIMESTAMP(timezone=True), nullable=False),
+        Column("created_at", TIMESTAMP(timezone=True), nullable=False),
+        Column("sent_at", TIMESTAMP(timezone=True), nullable=True),
+        Index(
+            "ix_admin_outbox_pending", "next_attempt_at",
+            postgresql_where=text("sent_at IS NULL"), sqlite_where=text("sent_at IS NULL"),
+        ),
+    )
+    Table(
+        "catalog_courses", meta,
+        Column("key", String, primary_key=True),
+        Column("label", String, nullable=False),
+        Column("has_level", Boolean, nullable=False),
+        Column("position", Integer, nullable=False),
+        Column("active", Boolean, nullable=False),
+    )
+    Table(
+        "catalog_sections", meta,
+        Column("course_key", String, primary_key=True),
+        Column("key", String, primary_key=True),
+        Column("label", String, nullable=False),
+        Column("position", Integer, nullable=False),
+    )
+    Table(
+        "catalog_levels", meta,
+        Column("key", String, primary_key=True),
+        Column("label", String, nullable=False),
+        Column("position", Integer, nullable=False),
+    )
+    Table(
+        "catalog_meta", meta,
+        Column("id", Integer, primary_key=True),
+        Column("version", Integer, nullable=False),
+    )
+    Table(
+        "registration_daily_stats", meta,
+        Column("day", Date, primary_key=True),
+        Column("course", String, primary_key=True),
+        Column("section", String, primary_key=True),
+        Column("level", String, primary_key=True),
+        Column("count", Integer, nullable=False),
+    )
+    Table(
+        "app_meta", meta,
+        Column("key", String, primary_key=True),
+        Column("value", Text, nullable=False),
+    )
+    Table(
+        "broadcasts", meta,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("chat_id", BigInteger, nullable=False),
+        Column("from_chat_id", BigInteger, nullable=False),
+        Column("message_id", BigInteger, nullable=False),
+        Column("course", String, nullable=True),
+        Column("section", String, nullable=True),
+        Column("level", String, nullable=True),
+        Column("status", String, nullable=False),
+        Column("total", Integer, nullable=False),
+        Column("last_user_id", BigInteger, nullable=False),
+        Column("sent", Integer, nullable=False),
+        Column("blocked", Integer, nullable=False),
+        Column("failed", Integer, nullable=False),
+        Column("created_at", TIMESTAMP(timezone=True), nullable=False),
+        Column("finished_at", TIMESTAMP(timezone=True), nullable=True),
+    )
+    meta.create_all(conn)
+
+def index_names(conn, table: str) -> Set[str]:
+    # From the catalog: inspect() warns about expression indexes and SQLite's leaves them out.
+    if conn.dialect.name == "sqlite":
+        stmt = text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table")
+    elif conn.dialect.name == "postgresql":
+        stmt = text("SELECT indexname FROM pg_indexes WHERE tablename = :table AND schemaname = current_schema()")
+    else:
+        return {ix["name"] for ix in inspect(conn).get_indexes(table)}
+    return set(conn.scalars(stmt, {"table": table}))
+
+def migration_walk_ins(conn) -> None:
+    # The one-signup-per-user index skips tg_user_id 0 so walk-ins can share it. Rebuilt
+    # only where the full unique index exists: rows that satisfy it satisfy the partial one.
+    # A degraded database keeps its plain fallback index (see migration_registration_indexes).
+    if "uq_registrations_user_course" in index_names(conn, "registrations"):
+        conn.execute(text("DROP INDEX uq_registrations_user_course"))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX uq_registrations_user_course ON registrations (tg_user_id, course) WHERE tg_user_id <> 0"
+        ))
+
+def migration_archives(conn) -> None:
+    meta = MetaData()
+    Table(
+        "registration_archives", meta,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("month", Date, nullable=False, index=True),
+        Column("file", String, nullable=False, unique=True),
+        Column("rows", Integer, nullable=False),
+        Column("first_id", Integer, nullable=False),
+        Column("last_id", Integer, nullable=False),
+        Column("archived_at", TIMESTAMP(timezone=True), nullable=False),
+    )
+    meta.create_all(conn)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_registrations_created_at ON registrations (created_at)"))
+
+def migration_registration_keys(conn) -> None:
+    # Months archived before this table existed get their keys from the archive files,
+    # read here as they were written at the time (gzip JSON lines, one registration each,
+    # under ARCHIVE_DIR) rather than with read_archive(), which may change later.
+    archive_dir = os.environ.get("ARCHIVE_DIR", "archive")
+    meta = MetaData()
+    keys_table = Table(
+        "registration_keys", meta,
+        Column("registration_id", Integer, primary_key=True),
+        Column("tg_user_id", BigInteger, nullable=False),
+        Column("phone", String, nullable=False),
+        Column("course", String, nullable=False),
+        Column("full_name", String, nullable=False),
+        Column("level", String, nullable=True),
+        Column("section", String, nullable=False),
+        Column("created_at", TIMESTAMP(timezone=True), nullable=True),
+        Index("ix_registration_keys_user_course", "tg_user_id", "course"),
+        Index("ix_registration_keys_phone_course", "phone", "course"),
+    )
+    meta.create_all(conn)
+    archives = Table("registration_archives", MetaData(), Column("id", Integer), Column("file", String))
+    for (name,) in conn.execute(select(archives.c.file).order_by(archives.c.id)).all():
+        try:
+            with gzip.open(os.path.join(archive_dir, name), "rt", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+        except OSError as e:
+            logger.warning("Archive %s unreadable, its registrations are not kept as duplicates: %s", name, e)
+            continue
+        if records:
+            ids = [record["id"] for record in records]
+            conn.execute(delete(keys_table).where(keys_table.c.registration_id.in_(ids)))
+            conn.execute(insert(keys_table), [
+                {
+                    "registration_id": record["id"],
+                    "tg_user_id": record["tg_user_id"],
+                    "phone": record["phone"],
+                    "course": record["course"],
+                    "full_name": record["full_name"],
+                    "level": record["level"],
+                    "section": record["section"],
+                    "created_at": datetime.fromisoformat(record["created_at"]) if record["created_at"] else None,
+                }
+                for record in records
+            ])
+
+# (name, columns, WHERE) of the unique indexes behind one signup per user / per phone.
+REGISTRATION_UNIQUE_INDEXES = (
+    ("uq_registrations_user_course", "tg_user_id, course", "tg_user_id <> 0"),
+    ("uq_registrations_phone_course", "phone, course", None),
+)
+
+def migration_registration_indexes(conn) -> None:
+    # Databases from before versioning kept their registrations table, so they may lack
+    # indexes added since. If old duplicates make a unique one impossible, a plain index
+    # with the same columns (ix_ instead of uq_) keeps lookups fast and DuplicateGuard
+    # stops new duplicates on its own; /status lists it under degraded_indexes.
+    existing = index_names(conn, "registrations")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_registrations_tg_user_id ON registrations (tg_user_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_registrations_username_lower ON registrations (lower(username))"))
+    for name, columns, where in REGISTRATION_UNIQUE_INDEXES:
+        fallback = "ix_" + name[len("uq_"):]
+        if name in existing or fallback in existing:
+            continue
+        try:
+            with conn.begin_nested():
+                conn.execute(text(
+                    f"CREATE UNIQUE INDEX {name} ON registrations ({columns})" + (f" WHERE {where}" if where else "")
+                ))
+        except IntegrityError:
+            conn.execute(text(f"CREATE INDEX {fallback} ON registrations ({columns})"))
+    # Planner statistics for the new indexes (Postgres has none for an expression index).
+    conn.execute(text("ANALYZE registrations"))
+
+# (version, description, step); append only, never renumber.
+MIGRATIONS: List[Tuple[int, str, Callable[[Any], None]]] = [
+    (1, "baseline schema", migration_baseline),
+    (2, "walk-in registrations share tg_user_id 0", migration_walk_ins),
+    (3, "registration archives and created_at index", migration_archives),
+    (4, "uniqueness keys of archived registrations", migration_registration_keys),
+    (5, "registration indexes missing on databases from before versioning", migration_registration_indexes),
+]
+
+def migrate() -> List[int]:
+    """Apply pending migrations; returns the versions applied."""
+    applied = []
+    with bulk_engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        SchemaVersion.__table__.create(conn, checkfirst=True)
+        done = set(conn.scalars(select(SchemaVersion.version)))
+        for version, description, step in MIGRATIONS:
+            if version in done:
+                continue
+            step(conn)
+            conn.execute(insert(SchemaVersion).values(
+                version=version, description=description, applied_at=datetime.now(timezone.utc),
+            ))
+            applied.append(version)
+    newest = max(done, default=0)
+    if newest > MIGRATIONS[-1][0]:
+        logger.warning("Database schema is at version %d, newer than this code (%d)", newest, MIGRATIONS[-1][0])
+    return applied
+
+# ----------------------- Persistence -----------------------
+def registration_row(d: Dict[str, Any], u) -> Dict[str, Any]:
+    return {
+        "tg_user_id": u.id,
+        "username": u.username,
+        "first_name": u.first_name,
+        "last_name": u.last_name,
+        "full_name": d["full_name"],
+        "age": int(d["age"]),
+        "phone": d["phone"],
+        "course": d["course_label"],
+        "level": d.get("level_label"),
+        "section": d["section_label"],
+    }
+
+NAME_TOKEN_MAX = 64
+_APOSTROPHES = re.compile(r"['`‘’ʻʼ]")
+
+def name_tokens(*names: Optional[str]) -> List[str]:
+    # "O‘ktam Alovuddinov" -> ["oktam", "alovuddinov"]: apostrophes inside Uzbek letters
+    # are dropped rather than splitting the word.
+    tokens = set()
+    for name in names:
+        if name:
+            tokens.update(t[:NAME_TOKEN_MAX] for t in re.findall(r"\w+", _APOSTROPHES.sub("", name.casefold())))
+    return sorted(tokens)
+
+def registration_tokens(registration_id: int, row: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {"token": t, "registration_id": registration_id}
+        for t in name_tokens(row.get("full_name"), row.get("first_name"), row.get("last_name"))
+    ]
+
+def insert_with_ids(session, rows: List[Dict[str, Any]]) -> List[int]:
+    if session.get_bind().dialect.insert_executemany_returning_sort_by_parameter_order:
+        stmt = insert(Registration).returning(Registration.id, sort_by_parameter_order=True)
+        return list(session.scalars(stmt, rows))
+    return [session.execute(insert(Registration).values(row)).inserted_primary_key[0] for row in rows]
+
+StatKey = Tuple[date, str, str, str]
+
+def stat_key(created_at: datetime, course: str, section: str, level: Optional[str]) -> StatKey:
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.astimezone(TASHKENT_TZ).date(), course, section, level or ""
+
+def increment_daily_stats(session, counts: Dict[StatKey, int]) -> None:
+    if not counts:
+        return
+    values = [
+        {"day": day, "course": course, "section": section, "level": level, "count": n}
+        for (day, course, section, level), n in counts.items()
+    ]
+    dialect = session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = dialect_insert(RegistrationDailyStat).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["day", "course", "section", "level"],
+            set_={"count": RegistrationDailyStat.count + stmt.excluded["count"]},
+        )
+        session.execute(stmt)
+        return
+    for v in values:
+        key = and_(
+            RegistrationDailyStat.day == v["day"], RegistrationDailyStat.course == v["course"],
+            RegistrationDailyStat.section == v["section"], RegistrationDailyStat.level == v["level"],
+        )
+        result = session.execute(
+            update(RegistrationDailyStat).where(key).values(count=RegistrationDailyStat.count + v["count"])
+        )
+        if result.rowcount == 0:
+            session.execute(insert(RegistrationDailyStat).values(v))
+
+def insert_registrations(rows: List[Dict[str, Any]], notices: List[Tuple[int, str]]) -> Dict[StatKey, int]:
+    # Runs on db_executor, never on the event loop. One transaction: multi-row INSERT,
+    # the rows' name tokens, the matching admin notifications in the outbox and the daily
+    # summary counters.
+    now = datetime.now(timezone.utc)
+    counts: Dict[StatKey, int] = Counter()
+    for row in rows:
+        row.setdefault("created_at", now)
+        counts[stat_key(row["created_at"], row["course"], row["section"], row.get("level"))] += 1
+    with SessionLocal() as session:
+        ids = insert_with_ids(session, rows)
+        tokens = [t for id_, row in zip(ids, rows) for t in registration_tokens(id_, row)]
+        if tokens:
+            session.execute(insert(RegistrationNameToken), tokens)
+        if notices:
+            session.execute(insert(AdminOutbox), [
+                {"chat_id": chat_id, "text": text_, "attempts": 0, "next_attempt_at": now, "created_at": now}
+                for chat_id, text_ in notices
+            ])
+        increment_daily_stats(session, counts)
+        session.commit()
+    return counts
+
+# ----------------------- Duplicate detection -----------------------
+DUP_FILTER_MIN_KEYS = int(os.environ.get("DUP_FILTER_MIN_KEYS", "100000"))
+DUP_FILTER_ERROR_RATE = 0.01
+
+class DuplicateRegistration(Exception):
+    def __init__(self, existing: Optional[Dict[str, Any]]):
+        super().__init__("Duplicate registration")
+        self.existing = existing
+
+def analyze_table(name: str) -> None:
+    # Planner statistics; without them Postgres has no estimate for a new expression
+    # index and may prefer scanning the primary key.
+    with bulk_engine.begin() as conn:
+        conn.execute(text(f"ANALYZE {name}"))
+
+def degraded_registration_indexes() -> List[str]:
+    # Unique indexes that migration_registration_indexes had to replace with a plain one.
+    with bulk_engine.connect() as conn:
+        existing = index_names(conn, "registrations")
+    return [name for name, _, _ in REGISTRATION_UNIQUE_INDEXES if name not in existing]
+
+def find_existing_registration(tg_user_id: int, phone: str, course: str) -> Optional[Dict[str, Any]]:
+    stmt = (
+        select(
+            Registration.id, Registration.created_at, Registration.full_name, Registration.phone,
+            Registration.course, Registration.level, Registration.section,
+        )
+        .where(Registration.course == course, or_(Registration.tg_user_id == tg_user_id, Registration.phone == phone))
+        .order_by(Registration.id)
+        .limit(1)
+    )
+    archived = (
+        select(
+            RegistrationKey.registration_id.label("id"), RegistrationKey.created_at, RegistrationKey.full_name,
+            RegistrationKey.phone, RegistrationKey.course, RegistrationKey.level, RegistrationKey.section,
+        )
+        .where(RegistrationKey.course == course, or_(RegistrationKey.tg_user_id == tg_user_id, RegistrationKey.phone == phone))
+        .order_by(RegistrationKey.registration_id)
+        .limit(1)
+    )
+    with SessionLocal() as session:
+        row = session.execute(stmt).mappings().first() or session.execute(archived).mappings().first()
+        return dict(row) if row else None
+
+def duplicate_keys(tg_user_id: int, phone: str, course: str) -> Tuple[str, str]:
+    return f"u:{tg_user_id}:{course}", f"p:{phone}:{course}"
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = DUP_FILTER_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+def build_duplicate_filter() -> BloomFilter:
+    # Sized for twice the current table (archived keys included), so it is rebuilt rarely
+    # as signups grow.
+    with bulk_engine.connect() as conn:
+        rows = conn.scalar(select(func.count()).select_from(Registration)) or 0
+        rows += conn.scalar(select(func.count()).select_from(RegistrationKey)) or 0
+        bloom = BloomFilter(max(DUP_FILTER_MIN_KEYS, 4 * rows))
+        for model in (Registration, RegistrationKey):
+            stmt = select(model.tg_user_id, model.phone, model.course)
+            for tg_user_id, phone, course in conn.execution_options(
+                stream_results=True, yield_per=EXPORT_CHUNK_ROWS
+            ).execute(stmt):
+                for key in duplicate_keys(tg_user_id, phone, course):
+                    bloom.add(key)
+    return bloom
+
+class DuplicateGuard:
+    # Pre-check on confirm. A Bloom filter holds every stored (user, course) and
+    # (phone, course): a miss means the signup is new and needs no query; a hit, or a
+    # filter still loading, is settled by one indexed lookup.
+    def __init__(self):
+        self.filter: Optional[BloomFilter] = None
+        self.pending: Optional[List[Tuple[str, str]]] = None
+        self.fast_accepts = 0
+        self.db_checks = 0
+        self.false_positives = 0
+        self.duplicates = 0
+        self.degraded_indexes: List[str] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "filter": "loading" if self.filter is None else f"{self.filter.count}/{self.filter.capacity} keys",
+            "fast_accepts": self.fast_accepts,
+            "db_checks": self.db_checks,
+            "false_positives": self.false_positives,
+            "duplicates": self.duplicates,
+            "degraded_indexes": ", ".join(self.degraded_indexes) or "none",
+        }
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self.pending = []
+            self._task = asyncio.create_task(self._load(), name="duplicate-filter")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _load(self):
+        # Rows committed while the table is scanned are kept in pending and replayed
+        # into the new filter, so it never misses a registration when it goes live.
+        try:
+            bloom = await run_bulk(build_duplicate_filter)
+        except Exception as e:
+            logger.exception("Duplicate filter load failed: %s", e)
+            return
+        for keys in self.pending or ():
+            for key in keys:
+                bloom.add(key)
+        self.filter, self.pending = bloom, None
+        logger.info("Duplicate filter loaded with %d keys", bloom.count)
+
+    def add(self, row: Dict[str, Any]):
+        keys = duplicate_keys(row["tg_user_id"], row["phone"], row["course"])
+        if self.pending is not None:
+            self.pending.append(keys)
+        if self.filter is not None:
+            for key in keys:
+                self.filter.add(key)
+            if self.filter.count > self.filter.capacity:
+                self.start()
+
+    async def check(self, row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        keys = duplicate_keys(row["tg_user_id"], row["phone"], row["course"])
+        bloom = self.filter
+        # Other workers' inserts never reach this filter; without the unique indexes to
+        # catch those, every check has to look at the table.
+        if BOT_WORKERS > 1 and self.degraded_indexes:
+            bloom = None
+        if bloom is not None and not any(key in bloom for key in keys):
+            self.fast_accepts += 1
+            return None
+        self.db_checks += 1
+        existing = await run_db(find_existing_registration, row["tg_user_id"], row["phone"], row["course"])
+        if existing is not None:
+            self.duplicates += 1
+        elif bloom is not None:
+            self.false_positives += 1
+        return existing
+
+duplicate_guard = DuplicateGuard()
+
+# ----------------------- Conversation state -----------------------
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "5"))
+
+def load_user_state(user_id: int) -> Dict[str, str]:
+    with SessionLocal() as session:
+        rows = session.execute(
+            select(UserState.key, UserState.value).where(UserState.tg_user_id == user_id)
+        )
+        return {key: value for key, value in rows}
+
+def write_user_states(changes: Dict[int, Dict[str, Any]]) -> None:
+    # changes: {user_id: {"set": {key: json}, "del": {key, ...}}}
+    with SessionLocal() as session:
+        inserts = []
+        for user_id, diff in changes.items():
+            keys = set(diff["set"]) | diff["del"]
+            if keys:
+                session.execute(
+                    delete(UserState).where(and_(UserState.tg_user_id == user_id, UserState.key.in_(keys)))
+                )
+            inserts += [{"tg_user_id": user_id, "key": k, "value": v} for k, v in diff["set"].items()]
+        if inserts:
+            session.execute(insert(UserState), inserts)
+        session.commit()
+
+def delete_user_state(user_id: int) -> None:
+    with SessionLocal() as session:
+        session.execute(delete(UserState).where(UserState.tg_user_id == user_id))
+        session.commit()
+
+class StatePersistence(BasePersistence):
+    """Stores ``context.user_data`` in the ``user_state`` table.
+
+    State is loaded lazily on a user's first update, only keys that changed since the
+    last write are persisted, and all users touched in one persistence run are written
+    in a single transaction. Users whose state is empty (flow finished or cancelled) are
+    forgotten once that is written, and loaded again if they come back.
+    """
+
+    def __init__(self, update_interval: float = STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._persisted: Dict[int, Dict[str, str]] = {}
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _encode(data: Dict[str, Any]) -> Dict[str, str]:
+        return {k: json.dumps(v, ensure_ascii=False, sort_keys=True, default=str) for k, v in data.items()}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        if user_id in self._persisted:
+            return
+        stored = await run_db(load_user_state, user_id)
+        self._persisted.setdefault(user_id, stored)
+        for k, v in stored.items():
+            user_data.setdefault(k, json.loads(v))
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        encoded = self._encode(data)
+        previous = self._persisted.get(user_id, {})
+        changed = {k: v for k, v in encoded.items() if previous.get(k) != v}
+        removed = previous.keys() - encoded.keys()
+        if not changed and not removed:
+            if not encoded:
+                self._persisted.pop(user_id, None)
+            return
+        diff = self._pending.setdefault(user_id, {"set": {}, "del": set()})
+        for k, v in changed.items():
+            diff["set"][k] = v
+            diff["del"].discard(k)
+        for k in removed:
+            diff["set"].pop(k, None)
+            diff["del"].add(k)
+        self._persisted[user_id] = encoded
+        await self._schedule_write()
+        # Kept while a failed write waits for a retry, so a reload cannot bring the old state back.
+        if not encoded and user_id not in self._pending:
+            self._persisted.pop(user_id, None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._persisted[user_id] = {}
+        await run_db(delete_user_state, user_id)
+        self._persisted.pop(user_id, None)
+
+    async def _schedule_write(self):
+        # Every update_user_data call of one persistence run joins the same write.
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+        await asyncio.shield(self._write_task)
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await run_db(write_user_states, pending)
+        except Exception as e:
+            logger.exception("Failed to persist state for %d user(s): %s", len(pending), e)
+            # Put the diffs back underneath anything newer so the next run retries them.
+            for user_id, diff in pending.items():
+                newer = self._pending.get(user_id)
+                if newer:
+                    diff["set"] = {k: v for k, v in diff["set"].items() if k not in newer["del"]}
+                    diff["set"].update(newer["set"])
+                    diff["del"] = (diff["del"] - newer["set"].keys()) | newer["del"]
+                self._pending[user_id] = diff
+
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            await asyncio.gather(self._write_task, return_exceptions=True)
+        if self._pending:
+            await self._write_pending()
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+# ----------------------- Write-behind queue -----------------------
+REG_BATCH_MAX = int(os.environ.get("REG_BATCH_MAX", "100"))
+REG_BATCH_WAIT_MS = int(os.environ.get("REG_BATCH_WAIT_MS", "50"))
+
+class RegistrationWriter:
+    """Group-commits confirmed registrations.
+
+    ``submit`` resolves only once the batch containing the row is committed, so
+    callers can confirm to the user after the data is durable.
+    """
+
+    def __init__(self, max_batch: int = REG_BATCH_MAX, max_wait_ms: int = REG_BATCH_WAIT_MS):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Tuning stats
+        self.batches = 0
+        self.rows = 0
+        self.failed_batches = 0
+        self.duplicates = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.depth,
+            "batches": self.batches,
+            "rows": self.rows,
+            "failed_batches": self.failed_batches,
+            "duplicates": self.duplicates,
+            "avg_batch_size": round(self.rows / self.batches, 2) if self.batches else 0,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+    def start(self):
+        if self._task is None:
+            self.queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run(), name="registration-writer")
+
+    async def stop(self):
+        # The sentinel is queued behind pending rows, so everything is flushed first.
+        if self._task is None:
+            return
+        self.queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, row: Dict[str, Any], notice: Optional[Tuple[int, str]] = None) -> None:
+        if self._task is None:
+            raise RuntimeError("RegistrationWriter is not running.")
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((row, notice, fut))
+        await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # Keep the writer alive: fail what is still waiting and take the next batch.
+                logger.exception("Registration writer failed a batch of %d: %s", len(batch), e)
+                self.failed_batches += 1
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        try:
+            counts = await run_db(
+                insert_registrations,
+                [row for row, _, _ in batch],
+                [notice for _, notice, _ in batch if notice],
+            )
+            written = batch
+        except IntegrityError:
+            # A unique index rejected the batch; retry row by row so only duplicates fail.
+            counts, written = await self._flush_each(batch)
+        except Exception as e:
+            self.failed_batches += 1
+            REGISTRATIONS.inc("failed", value=len(batch))
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        REG_FLUSH_SECONDS.observe(elapsed / 1000)
+        REGISTRATIONS.inc("saved", value=len(written))
+        self.batches += 1
+        self.rows += len(written)
+        self.last_batch_size = len(batch)
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        for row, _, fut in written:
+            duplicate_guard.add(row)
+            if not fut.done():
+                fut.set_result(None)
+        daily_stats.add(counts)
+        admin_notifier.wake()
+        if trace_sampled():
+            trace_logger.info(
+                "Flushed %d registration(s) in %.1f ms, queue depth %d",
+                len(batch), elapsed, self.depth,
             )
-            await update.effective_chat.send_message("Telefonni yuboring:", reply_markup=kb)
-            context.user_data["step"] = "ask_phone"
+
+    async def _flush_each(self, batch):
+        counts: Dict[StatKey, int] = Counter()
+        written = []
+        for item in batch:
+            row, notice, fut = item
+            try:
+                counts.update(await run_db(insert_registrations, [row], [notice] if notice else []))
+                written.append(item)
+            except IntegrityError:
+                self.duplicates += 1
+                try:
+                    existing = await run_db(find_existing_registration, row["tg_user_id"], row["phone"], row["course"])
+                except Exception as e:
+                    # The caller reports a server error; the row was not saved either way.
+                    if not fut.done():
+                        fut.set_exception(e)
+                    continue
+                if not fut.done():
+                    fut.set_exception(DuplicateRegistration(existing))
+            except Exception as e:
+                REGISTRATIONS.inc("failed")
+                if not fut.done():
+                    fut.set_exception(e)
+        return counts, written
+
+reg_writer = RegistrationWriter()
+
+# ----------------------- Rate limiting -----------------------
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # Honour Telegram's retry_after: nothing goes out until it has passed.
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    return e.retry_after if isinstance(e.retry_after, (int, float)) else e.retry_after.total_seconds()
+
+# ----------------------- Admin notifications -----------------------
+ADMIN_NOTIFY_RATE = float(os.environ.get("ADMIN_NOTIFY_RATE", "1"))  # messages per second
+ADMIN_NOTIFY_BURST = float(os.environ.get("ADMIN_NOTIFY_BURST", "3"))
+ADMIN_DIGEST_THRESHOLD = int(os.environ.get("ADMIN_DIGEST_THRESHOLD", "5"))
+# Other workers' notices cannot wake the primary worker's notifier, so it polls more often.
+OUTBOX_POLL_SECONDS = 10 if BOT_WORKERS == 1 else 2
+OUTBOX_FETCH_LIMIT = 50
+OUTBOX_MAX_BACKOFF = 600
+TELEGRAM_TEXT_LIMIT = 4096
+
+def fetch_due_notices(limit: int) -> List[Tuple[int, int, str, int]]:
+    now = datetime.now(timezone.utc)
+    with SessionLocal() as session:
+        rows = session.execute(
+            select(AdminOutbox.id, AdminOutbox.chat_id, AdminOutbox.text, AdminOutbox.attempts)
+            .where(AdminOutbox.sent_at.is_(None), AdminOutbox.next_attempt_at <= now)
+            .order_by(AdminOutbox.next_attempt_at, AdminOutbox.id)
+            .limit(limit)
+        )
+        return [tuple(r) for r in rows]
+
+def mark_notices_sent(ids: List[int]) -> None:
+    with SessionLocal() as session:
+        session.execute(
+            update(AdminOutbox).where(AdminOutbox.id.in_(ids)).values(sent_at=datetime.now(timezone.utc))
+        )
+        session.commit()
+
+def mark_notices_failed(ids: List[int], attempts: int, delay: float) -> None:
+    with SessionLocal() as session:
+        session.execute(
+            update(AdminOutbox)
+            .where(AdminOutbox.id.in_(ids))
+            .values(attempts=attempts, next_attempt_at=datetime.now(timezone.utc) + timedelta(seconds=delay))
+        )
+        session.commit()
+
+def build_digest(texts: List[str]) -> List[str]:
+    # Roll several notifications into as few messages as fit Telegram's limit.
+    header = "📦 *Yangi ro‘yxatdan o‘tishlar*\n\n"
+    separator = "\n\n➖➖➖\n\n"
+    messages, current = [], ""
+    for t in texts:
+        if current and len(current) + len(separator) + len(t) > TELEGRAM_TEXT_LIMIT:
+            messages.append(current)
+            current = ""
+        current = current + separator + t if current else header + t
+    if current:
+        messages.append(current)
+    return messages
+
+class AdminNotifier:
+    """Delivers ``admin_outbox`` rows off the user's critical path.
+
+    Sending is paced by a token bucket, failures are retried with exponential backoff,
+    and when more than ``ADMIN_DIGEST_THRESHOLD`` notices are due they are merged into
+    digest messages.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(ADMIN_NOTIFY_RATE, ADMIN_NOTIFY_BURST)
+        self._bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.sent = 0
+        self.failed = 0
+        self.digests = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"sent": self.sent, "failed_attempts": self.failed, "digests": self.digests}
+
+    def start(self, bot):
+        if self._task is None:
+            self._bot = bot
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="admin-notifier")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                due = await run_db(fetch_due_notices, OUTBOX_FETCH_LIMIT)
+            except Exception as e:
+                logger.warning("Failed to read admin outbox: %s", e)
+                due = []
+            if not due:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._deliver(due)
+            except Exception as e:
+                # E.g. the outbox could not be updated; unmarked notices are picked up again.
+                logger.exception("Admin notification round failed: %s", e)
+                await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+    async def _deliver(self, due: List[Tuple[int, int, str, int]]):
+        by_chat: Dict[int, List[Tuple[int, str, int]]] = {}
+        for id_, chat_id, text_, attempts in due:
+            by_chat.setdefault(chat_id, []).append((id_, text_, attempts))
+        for chat_id, notices in by_chat.items():
+            if len(notices) > ADMIN_DIGEST_THRESHOLD:
+                # The notices are marked sent only once every part of the digest is out.
+                messages = build_digest([t for _, t, _ in notices])
+                groups = [(messages, [i for i, _, _ in notices], max(a for _, _, a in notices))]
+                self.digests += 1
+            else:
+                groups = [([t], [i], a) for i, t, a in notices]
+            for texts, ids, attempts in groups:
+                if not await self._send(chat_id, texts, ids, attempts):
+                    return
+
+    async def _send(self, chat_id: int, texts: List[str], ids: List[int], attempts: int) -> bool:
+        try:
+            for t in texts:
+                await self.bucket.acquire()
+                try:
+                    await self._bot.send_message(chat_id=chat_id, text=t, parse_mode="Markdown")
+                except BadRequest as e:
+                    if "parse" not in str(e).lower():
+                        raise
+                    # Usernames with "_" etc. break legacy Markdown; send as plain text instead.
+                    await self._bot.send_message(chat_id=chat_id, text=t)
+        except RetryAfter as e:
+            retry_after = retry_after_seconds(e)
+            self.bucket.pause(retry_after)
+            logger.warning("Admin notifications rate limited for %ss", retry_after)
+            return False
+        except Exception as e:
+            self.failed += 1
+            delay = min(OUTBOX_MAX_BACKOFF, 5 * 2 ** attempts)
+            logger.warning("Failed to notify admin (attempt %d, retry in %ss): %s", attempts + 1, delay, e)
+            await run_db(mark_notices_failed, ids, attempts + 1, delay)
+            return True
+        self.sent += len(ids)
+        await run_db(mark_notices_sent, ids)
+        return True
+
+admin_notifier = AdminNotifier()
+
+# ----------------------- Flood protection -----------------------
+# Checked by the update scheduler before an update is queued behind its user, so shed
+# updates never reach a handler, the database or the user's queue. Rates are updates per
+# second; FLOOD_GLOBAL_RATE=0 turns the global limit off.
+FLOOD_USER_RATE = float(os.environ.get("FLOOD_USER_RATE", "2"))
+FLOOD_USER_BURST = float(os.environ.get("FLOOD_USER_BURST", "10"))
+# The global limit is for the whole bot, so each of BOT_WORKERS processes gets its share.
+FLOOD_GLOBAL_RATE = float(os.environ.get("FLOOD_GLOBAL_RATE", "100")) / BOT_WORKERS
+FLOOD_GLOBAL_BURST = float(os.environ.get("FLOOD_GLOBAL_BURST", "300")) / BOT_WORKERS
+FLOOD_DUPLICATE_WINDOW = 1.0  # seconds in which a repeated identical callback is collapsed
+FLOOD_TRACKED_USERS = 50_000
+FLOOD_NOTICE_INTERVAL = 5.0
+
+UPDATES_SHED = CounterMetric("bot_updates_shed_total", "Updates dropped before any handler ran, by reason.", ("reason",))
+
+class FloodGuard:
+    def __init__(self, user_rate: float = FLOOD_USER_RATE, user_burst: float = FLOOD_USER_BURST,
+                 global_rate: float = FLOOD_GLOBAL_RATE, global_burst: float = FLOOD_GLOBAL_BURST):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self.buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.last_callback: "OrderedDict[int, Tuple[str, int, float]]" = OrderedDict()
+        self.noticed: Dict[int, float] = {}
+        self.admitted = 0
+        self.shed: Counter = Counter()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "admitted": self.admitted,
+            "shed_user_rate": self.shed["user"],
+            "shed_global": self.shed["global"],
+            "collapsed_callbacks": self.shed["duplicate"],
+            "tracked_users": len(self.buckets),
+        }
+
+    @staticmethod
+    def _touch(lru: OrderedDict, key: int, value):
+        lru[key] = value
+        lru.move_to_end(key)
+        if len(lru) > FLOOD_TRACKED_USERS:
+            lru.popitem(last=False)
+
+    def check(self, update: object) -> Optional[str]:
+        """None to admit the update, otherwise why it is shed: duplicate, user or global."""
+        user_id = update_user_id(update)
+        if user_id is None or user_id == ADMIN_ID:
+            self.admitted += 1
+            return None
+        now = time.monotonic()
+        query = update.callback_query
+        if query is not None:
+            key = (query.data or "", query.message.message_id if query.message else 0)
+            last = self.last_callback.get(user_id)
+            self._touch(self.last_callback, user_id, key + (now,))
+            if last is not None and last[:2] == key and now - last[2] < FLOOD_DUPLICATE_WINDOW:
+                return "duplicate"
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+        self._touch(self.buckets, user_id, bucket)
+        if not bucket.try_acquire():
+            return "user"
+        if self.global_bucket is not None and not self.global_bucket.try_acquire():
+            return "global"
+        self.admitted += 1
+        return None
+
+    async def shed_update(self, update: Update, reason: str):
+        # Callbacks are answered so the button stops spinning; at most one visible notice per
+        # user every few seconds. Messages are dropped without a reply.
+        self.shed[reason] += 1
+        UPDATES_SHED.inc(reason)
+        query = update.callback_query
+        if query is None:
+            return
+        user_id = update_user_id(update)
+        now = time.monotonic()
+        if now - self.noticed.get(user_id, 0.0) < FLOOD_NOTICE_INTERVAL:
+            return
+        self.noticed[user_id] = now
+        if len(self.noticed) > FLOOD_TRACKED_USERS:
+            self.noticed.clear()
+        text = None if reason == "duplicate" else "⏳ Juda tez! Biroz kutib, qayta urinib ko‘ring."
+        try:
+            await query.answer(text)
+        except TelegramError:
+            pass
+
+flood_guard = FloodGuard()
+
+# ----------------------- Update scheduling -----------------------
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", "10000"))
+USER_QUEUE_WARN_DEPTH = 20
+
+def update_user_id(update: object) -> Optional[int]:
+    if isinstance(update, Update) and update.effective_user:
+        return update.effective_user.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes different users' updates concurrently and each user's updates in order.
+
+    The ``step`` state machine in the handlers assumes one user's updates never overlap,
+    so every update waits for the previous update of the same user before it runs.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_UPDATES, max_pending: int = MAX_PENDING_UPDATES,
+                 guard: Optional[FloodGuard] = None):
+        # The base semaphore bounds updates in flight, including those waiting behind their
+        # user's earlier updates; ``max_concurrent`` bounds the ones actually running.
+        super().__init__(max(max_pending, max_concurrent))
+        self.concurrency = max(1, max_concurrent)
+        self.guard = guard
+        self.depths: Dict[int, int] = {}
+        self._tails: Dict[int, asyncio.Future] = {}
+        self._running: Optional[asyncio.Semaphore] = None
+        self.active = 0
+
+    async def initialize(self) -> None:
+        self._running = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self) -> None:
+        self.depths.clear()
+        self._tails.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        busiest = sorted(self.depths.items(), key=lambda kv: kv[1], reverse=True)[:5]
+        return {
+            "concurrency_cap": self.concurrency,
+            "running": self.active,
+            "pending": sum(self.depths.values()),
+            "users_with_backlog": sum(1 for d in self.depths.values() if d > 1),
+            "max_user_depth": busiest[0][1] if busiest else 0,
+            "busiest_users": busiest,
+        }
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self.guard is not None:
+            reason = self.guard.check(update)
+            if reason is not None:
+                coroutine.close()
+                await self.guard.shed_update(update, reason)
+                return
+        user_id = update_user_id(update)
+        token = None
+        if isinstance(update, Update):
+            token = log_context.set({**log_context.get(), "update_id": update.update_id, "user_id": user_id})
+        try:
+            await self._process(update, user_id, coroutine)
+        finally:
+            if token is not None:
+                log_context.reset(token)
+
+    async def _process(self, update: object, user_id: Optional[int], coroutine: Awaitable[Any]) -> None:
+        if user_id is None:
+            await self._run(coroutine)
             return
 
+        # Chain onto the user's last update synchronously, before any await, so arrival
+        # order is preserved.
+        previous = self._tails.get(user_id)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[user_id] = done
+        depth = self.depths.get(user_id, 0) + 1
+        self.depths[user_id] = depth
+        if depth == USER_QUEUE_WARN_DEPTH:
+            logger.warning("User %s has %d updates queued", user_id, depth)
+        try:
+            if previous is not None:
+                try:
+                    await previous
+                except BaseException:
+                    coroutine.close()
+                    raise
+            await self._run(coroutine)
+        finally:
+            done.set_result(None)
+            if self._tails.get(user_id) is done:
+                del self._tails[user_id]
+            remaining = self.depths.get(user_id, 1) - 1
+            if remaining:
+                self.depths[user_id] = remaining
+            else:
+                self.depths.pop(user_id, None)
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        async with self._running:
+            self.active += 1
+            try:
+                await coroutine
+            finally:
+                self.active -= 1
+
+update_scheduler = PerUserUpdateProcessor(guard=flood_guard)
+
+# ----------------------- Constants & Labels -----------------------
+# Seed values for the catalog tables; handlers read the live `catalog` snapshot.
+COURSES = {
+    "english": "🇬🇧 Ingliz tili",
+    "german": "🇩🇪 Nemis tili",
+    "math": "🧮 Matematika",
+    "history": "📜 Tarix",
+    "biology": "🧬 Biologiya",
+    "chemistry": "⚗️ Kimyo",
+}
+COURSES_WITH_LEVEL = {"english", "german"}
+
+LEVELS = {
+    "A1": "A1 • Beginner",
+    "A2": "A2 • Elementary",
+    "B1": "B1 • Intermediate",
+    "B2": "B2 • Upper-Intermediate",
+    "C1": "C1 • Advanced",
+    "C2": "C2 • Proficient",
+}
+
+SECTIONS_ENGLISH = {
+    "kids": "👶 Kids",
+    "general": "📘 General",
+    "cefr": "🧭 CEFR",
+    "ielts": "🎓 IELTS",
+}
+SECTIONS_GERMAN = {
+    "kids": "👶 Kids",
+    "general": "📘 General",
+    "certificate": "🏅 Certificate",
+}
+SECTIONS_OTHERS = {
+    "kids": "👶 Kids",
+    "general": "📘 General",
+    "certificate": "🏅 Certificate",
+}
+
+TASHKENT_TZ = ZoneInfo("Asia/Tashkent")
+
+# ----------------------- Catalog -----------------------
+CATALOG_POLL_SECONDS = float(os.environ.get("CATALOG_POLL_SECONDS", "30"))
+DEFAULT_SECTIONS_KEY = "*"
+
+class Catalog:
+    """Immutable snapshot of courses, levels and sections.
+
+    Handlers only ever read the module-level ``catalog``; a refresh builds a new
+    snapshot and swaps the reference, so a reader never sees a half-updated catalog.
+    """
+
+    __slots__ = ("version", "courses", "courses_with_level", "levels", "sections")
+
+    def __init__(self, version: int, courses: Dict[str, str], courses_with_level, levels: Dict[str, str],
+                 sections: Dict[str, Dict[str, str]]):
+        self.version = version
+        self.courses = courses
+        self.courses_with_level = frozenset(courses_with_level)
+        self.levels = levels
+        self.sections = sections
+
+    def sections_for(self, course_key: Optional[str]) -> Dict[str, str]:
+        return self.sections.get(course_key) or self.sections.get(DEFAULT_SECTIONS_KEY, {})
+
+def default_catalog() -> Catalog:
+    return Catalog(
+        version=0,
+        courses=dict(COURSES),
+        courses_with_level=COURSES_WITH_LEVEL,
+        levels=dict(LEVELS),
+        sections={"english": dict(SECTIONS_ENGLISH), "german": dict(SECTIONS_GERMAN),
+                  DEFAULT_SECTIONS_KEY: dict(SECTIONS_OTHERS)},
+    )
+
+catalog = default_catalog()
+
+def seed_catalog() -> None:
+    # First run only: copy the hardcoded catalog into the tables.
+    with SessionLocal() as session:
+        if session.get(CatalogMeta, 1) is not None:
+            return
+        seed = default_catalog()
+        session.add_all(
+            CatalogCourse(key=k, label=v, has_level=k in seed.courses_with_level, position=i)
+            for i, (k, v) in enumerate(seed.courses.items())
+        )
+        session.add_all(CatalogLevel(key=k, label=v, position=i) for i, (k, v) in enumerate(seed.levels.items()))
+        session.add_all(
+            CatalogSection(course_key=course_key, key=k, label=v, position=i)
+            for course_key, sections in seed.sections.items()
+            for i, (k, v) in enumerate(sections.items())
+        )
+        session.add(CatalogMeta(id=1, version=1))
+        session.commit()
+
+def fetch_catalog_version() -> int:
+    with SessionLocal() as session:
+        return session.scalar(select(CatalogMeta.version).where(CatalogMeta.id == 1)) or 0
+
+def bump_catalog_version() -> int:
+    with SessionLocal() as session:
+        session.execute(update(CatalogMeta).where(CatalogMeta.id == 1).values(version=CatalogMeta.version + 1))
+        session.commit()
+        return session.scalar(select(CatalogMeta.version).where(CatalogMeta.id == 1))
+
+def load_catalog() -> Catalog:
+    with SessionLocal() as session:
+        version = session.scalar(select(CatalogMeta.version).where(CatalogMeta.id == 1)) or 0
+        courses = session.execute(
+            select(CatalogCourse.key, CatalogCourse.label, CatalogCourse.has_level)
+            .where(CatalogCourse.active.is_(True))
+            .order_by(CatalogCourse.position, CatalogCourse.key)
+        ).all()
+        levels = session.execute(
+            select(CatalogLevel.key, CatalogLevel.label).order_by(CatalogLevel.position, CatalogLevel.key)
+        ).all()
+        sections: Dict[str, Dict[str, str]] = {}
+        for course_key, key, label in session.execute(
+            select(CatalogSection.course_key, CatalogSection.key, CatalogSection.label)
+            .order_by(CatalogSection.course_key, CatalogSection.position, CatalogSection.key)
+        ):
+            sections.setdefault(course_key, {})[key] = label
+    return Catalog(
+        version=version,
+        courses={k: label for k, label, _ in courses},
+        courses_with_level={k for k, _, has_level in courses if has_level},
+        levels=dict(levels),
+        sections=sections,
+    )
+
+def install_catalog(new: Catalog):
+    global catalog
+    catalog = new
+    render_cache.reset(new.version)
+    logger.info(
+        "Catalog v%d installed: %d courses, %d levels", new.version, len(new.courses), len(new.levels)
+    )
+
+async def refresh_catalog(force: bool = False) -> bool:
+    version = await run_db(fetch_catalog_version)
+    if not force and version == catalog.version:
+        return False
+    install_catalog(await run_db(load_catalog))
+    return True
+
+async def catalog_watcher():
+    while True:
+        await asyncio.sleep(CATALOG_POLL_SECONDS)
+        try:
+            await refresh_catalog()
+        except Exception as e:
+            logger.warning("Catalog refresh failed: %s", e)
+
+# ----------------------- Helpers: Keyboards -----------------------
+class RenderCache:
+    """Keyboards and other immutable render output, built once per catalog version.
+
+    Telegram objects are frozen after construction, so every user can share the same
+    instance; ``reset`` drops everything when the catalog changes.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._items: Dict[Any, Any] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build: Callable[[], T]) -> T:
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            value = self._items[key] = build()
+            return value
+        self.hits += 1
+        return value
+
+    def reset(self, version: int):
+        self._items = {}
+        self.version = version
+
+render_cache = RenderCache()
+
+def kb_register() -> InlineKeyboardMarkup:
+    return render_cache.get("register", _build_kb_register)
+
+def kb_courses() -> InlineKeyboardMarkup:
+    return render_cache.get("courses", _build_kb_courses)
+
+def kb_levels() -> InlineKeyboardMarkup:
+    return render_cache.get("levels", _build_kb_levels)
+
+def kb_sections(course_key: str) -> InlineKeyboardMarkup:
+    return render_cache.get(("sections", course_key), lambda: _build_kb_sections(course_key))
+
+def kb_review() -> InlineKeyboardMarkup:
+    return render_cache.get("review", _build_kb_review)
+
+def kb_edit_menu(course_key: str) -> InlineKeyboardMarkup:
+    with_level = course_key in catalog.courses_with_level
+    return render_cache.get(("edit_menu", with_level), lambda: _build_kb_edit_menu(with_level))
+
+def kb_phone() -> ReplyKeyboardMarkup:
+    return render_cache.get("phone", lambda: ReplyKeyboardMarkup(
+        [[KeyboardButton("📱 Raqamni ulashish", request_contact=True)]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+    ))
+
+def _build_kb_register() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🚀 Ro'yxatdan o'tish", callback_data="reg:start")]])
+
+def _build_kb_courses() -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    items = list(catalog.courses.items())
+    # make rows of 2
+    for i in range(0, len(items), 2):
+        row = []
+        for key, label in items[i:i+2]:
+            row.append(InlineKeyboardButton(label, callback_data=f"reg:course:{key}"))
+        rows.append(row)
+    rows.append([InlineKeyboardButton("❌ Bekor qilish", callback_data="reg:cancel")])
+    return InlineKeyboardMarkup(rows)
+
+def _build_kb_levels() -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    items = list(catalog.levels.items())
+    for i in range(0, len(items), 2):
+        rows.append([
+            InlineKeyboardButton(label, callback_data=f"reg:level:{key}") for key, label in items[i:i+2]
+        ])
+    rows.append([InlineKeyboardButton("⬅️ Ortga (Kurslar)", callback_data="reg:back:courses")])
+    return InlineKeyboardMarkup(rows)
+
+def _build_kb_sections(course_key: str) -> InlineKeyboardMarkup:
+    sections = catalog.sections_for(course_key)
+    back = "reg:back:levels" if course_key in catalog.courses_with_level else "reg:back:courses"
+
+    rows: List[List[InlineKeyboardButton]] = []
+    items = list(sections.items())
+    for i in range(0, len(items), 2):
+        row = []
+        for key, label in items[i:i+2]:
+            row.append(InlineKeyboardButton(label, callback_data=f"reg:section:{key}"))
+        rows.append(row)
+    rows.append([InlineKeyboardButton("⬅️ Ortga", callback_data=back)])
+    rows.append([InlineKeyboardButton("❌ Bekor qilish", callback_data="reg:cancel")])
+    return InlineKeyboardMarkup(rows)
+
+def _build_kb_review() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Tasdiqlash", callback_data="reg:confirm"),
+            InlineKeyboardButton("✏️ O‘zgartirish", callback_data="reg:edit"),
+        ],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data="reg:cancel")],
+    ])
+
+def _build_kb_edit_menu(with_level: bool) -> InlineKeyboardMarkup:
+    row1 = [InlineKeyboardButton("📚 Kurs", callback_data="reg:edit:course"),
+            InlineKeyboardButton("🗂 Bo‘lim", callback_data="reg:edit:section")]
+    row2 = [InlineKeyboardButton("👤 Ism familiya", callback_data="reg:edit:name"),
+            InlineKeyboardButton("🎂 Yosh", callback_data="reg:edit:age")]
+    row3 = [InlineKeyboardButton("📱 Telefon", callback_data="reg:edit:phone")]
+    rows = [row1, row2, row3]
+    if with_level:
+        rows.insert(1, [InlineKeyboardButton("📊 Daraja", callback_data="reg:edit:level")])
+    rows.append([InlineKeyboardButton("⬅️ Ortga (Ko‘rib chiqish)", callback_data="reg:back:review")])
+    return InlineKeyboardMarkup(rows)
+
+# ----------------------- Helpers: Validation -----------------------
+NAME_REGEX = re.compile(r"^[A-Za-zÀ-ÖØ-öø-ÿ'`-]+(?:\s+[A-Za-zÀ-ÖØ-öø-ÿ'`-]+)+$")
+
+def valid_full_name(s: str) -> bool:
+    s = s.strip()
+    return bool(NAME_REGEX.match(s)) and (2 <= len(s.split()) <= 5)
+
+def valid_age(s: str) -> bool:
+    if not s.isdigit():
+        return False
+    n = int(s)
+    return 3 <= n <= 100
+
+PHONE_REGEX = re.compile(r"^\+998\d{9}$")
+
+def normalize_phone(text: str) -> Optional[str]:
+    t = text.strip().replace(" ", "")
+    if t.startswith("998") and len(t) == 12:
+        t = "+" + t
+    if PHONE_REGEX.match(t):
+        return t
+    return None
+
+# ----------------------- Content builders -----------------------
+def build_review_text(d: Dict[str, Any]) -> str:
+    course_label = catalog.courses.get(d.get("course_key", ""), d.get("course_label", ""))
+    level_label = d.get("level_label")
+    section_label = d.get("section_label")
+    full_name = d.get("full_name", "")
+    age = d.get("age", "")
+    phone = d.get("phone", "")
+
+    lines = [
+        "🧾 *Ma’lumotlarni ko‘rib chiqing:*",
+        f"• 📚 *Kurs:* {course_label}",
+        f"• 🗂 *Bo‘lim:* {section_label}",
+        f"• 👤 *Ism familiya:* {full_name}",
+        f"• 🎂 *Yosh:* {age}",
+        f"• 📱 *Telefon:* {phone}",
+    ]
+    if d.get("course_key") in catalog.courses_with_level and level_label:
+        lines.insert(2, f"• 📊 *Daraja:* {level_label}")
+
+    return "\n".join(lines)
+
+def build_duplicate_text(existing: Dict[str, Any]) -> str:
+    lines = [
+        "ℹ️ *Siz bu kursga allaqachon ro‘yxatdan o‘tgansiz.*",
+        f"• 📚 *Kurs:* {existing['course']}",
+        f"• 🗂 *Bo‘lim:* {existing['section']}",
+        f"• 👤 *Ism familiya:* {existing['full_name']}",
+        f"• 📱 *Telefon:* {existing['phone']}",
+    ]
+    if existing.get("level"):
+        lines.insert(2, f"• 📊 *Daraja:* {existing['level']}")
+    if existing.get("created_at"):
+        created_at = existing["created_at"]
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        lines.append(f"• 🗓 *Sana:* {created_at.astimezone(TASHKENT_TZ):%Y-%m-%d %H:%M}")
+    lines.append("\nBoshqa kursga yozilish uchun /start bosing.")
+    return "\n".join(lines)
+
+def build_admin_text(d: Dict[str, Any], u) -> str:
+    course_label = catalog.courses.get(d.get("course_key", ""), d.get("course_label", ""))
+    level_label = d.get("level_label")
+    section_label = d.get("section_label")
+    full_name = d.get("full_name", "")
+    age = d.get("age", "")
+    phone = d.get("phone", "")
+
+    username = f"@{u.username}" if u.username else "@None"
+    tnow = datetime.now(TASHKENT_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+    lines = [
+        "🔔 *Yangi o‘quvchi ro‘yxatdan o‘tdi*",
+        f"👤 *Ism:* {full_name}",
+        f"🎂 *Yosh:* {age}",
+        f"📱 *Telefon:* {phone}",
+        f"📚 *Kurs:* {course_label}",
+        f"🗂 *Bo‘lim:* {section_label}",
+    ]
+    if d.get("course_key") in catalog.courses_with_level and level_label:
+        lines.insert(6, f"📊 *Daraja:* {level_label}")
+
+    lines += [
+        f"🆔 *Telegram ID:* {u.id}",
+        f"👤 *Username:* {username}",
+        f"📅 *Sana:* {tnow} (Asia/Tashkent)",
+    ]
+    return "\n".join(lines)
+
+# ----------------------- Prompts -----------------------
+PROMPT_COURSES = (
+    "📚 Qaysi *kurs*da o‘qimoqchisiz?\n"
+    "_Iltimos, quyidagilardan birini tanlang._"
+)
+PROMPT_LEVELS = "📊 Iltimos, *darajangizni* tanlang:"
+PROMPT_SECTIONS = "🗂 Iltimos, *bo‘lim*ni tanlang:"
+PROMPT_FULL_NAME = (
+    "✍️ *Iltimos, to‘liq ism-familiyangizni kiriting.*\n"
+    "_Masalan: Alamozon Alovuddinov_"
+)
+PROMPT_AGE = "🎂 *Yoshingizni kiriting:*"
+PROMPT_PHONE = "📞 *Telefon raqamingizni kiriting* (format: `+998XXXXXXXXX`) yoki pastdagi tugma orqali yuboring."
+PROMPT_EDIT_MENU = "Qaysi *bo‘limni* o‘zgartiramiz?"
+
+# ----------------------- Screen edits -----------------------
+# What each bot message currently shows, so identical edits are skipped instead of
+# costing a round trip that Telegram answers with "message is not modified".
+SCREEN_CACHE_SIZE = 50_000
+_screens: "OrderedDict[Tuple[int, int], Tuple[str, Any]]" = OrderedDict()
+screen_edits_skipped = 0
+
+def _remember_screen(key: Tuple[int, int], screen: Tuple[str, Any]):
+    _screens[key] = screen
+    _screens.move_to_end(key)
+    if len(_screens) > SCREEN_CACHE_SIZE:
+        _screens.popitem(last=False)
+
+async def edit_screen(query, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, parse_mode: Optional[str] = None):
+    global screen_edits_skipped
+    message = query.message
+    key = (message.chat.id, message.message_id) if message else None
+    screen = (text, reply_markup)
+    if key is not None and _screens.get(key) == screen:
+        screen_edits_skipped += 1
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+        screen_edits_skipped += 1
+    if key is not None:
+        _remember_screen(key, screen)
+
+# ----------------------- Flow helpers -----------------------
+async def goto_courses(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.callback_query:
+        await edit_screen(update.callback_query, PROMPT_COURSES, reply_markup=kb_courses(), parse_mode="Markdown")
+    else:
+        await update.message.reply_text(PROMPT_COURSES, reply_markup=kb_courses(), parse_mode="Markdown")
+    context.user_data["step"] = "choose_course"
+
+async def goto_levels(query, context):
+    await edit_screen(query, PROMPT_LEVELS, reply_markup=kb_levels(), parse_mode="Markdown")
+    context.user_data["step"] = "choose_level"
+
+async def goto_sections(query, context):
+    course_key = context.user_data.get("course_key")
+    await edit_screen(query, PROMPT_SECTIONS, reply_markup=kb_sections(course_key), parse_mode="Markdown")
+    context.user_data["step"] = "choose_section"
+
+async def ask_full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_chat.send_message(PROMPT_FULL_NAME, parse_mode="Markdown", reply_markup=ReplyKeyboardRemove())
+    context.user_data["step"] = "ask_name"
+
+async def ask_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_chat.send_message(PROMPT_AGE, parse_mode="Markdown")
+    context.user_data["step"] = "ask_age"
+
+async def ask_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_chat.send_message(PROMPT_PHONE, parse_mode="Markdown", reply_markup=kb_phone())
+    context.user_data["step"] = "ask_phone"
+
+async def show_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = build_review_text(context.user_data)
+    if update.callback_query:
+        await edit_screen(update.callback_query, text, reply_markup=kb_review(), parse_mode="Markdown")
+    else:
+        await update.effective_chat.send_message(text, reply_markup=kb_review(), parse_mode="Markdown")
+    context.user_data["step"] = "review"
+
+# ----------------------- Update recording -----------------------
+# RECORD_UPDATES_PATH turns on an append-only log of incoming updates for replay_updates.py.
+# Use a .gz path for a compressed log. RECORD_SALT keeps user pseudonyms stable across
+# restarts; without it every process picks a random salt.
+RECORD_UPDATES_PATH = os.environ.get("RECORD_UPDATES_PATH", "")
+RECORD_SALT = os.environ.get("RECORD_SALT", "")
+RECORD_FLUSH_SECONDS = 1.0
+
+class UpdateRecorder:
+    """Writes one JSON line per update: ``t`` (seconds since the session started), ``u``
+    (salted hash of the user id), ``s`` (flow step when it arrived), ``k`` (``cmd``,
+    ``text``, ``contact`` or ``cb``) and ``v`` (the value, redacted).
+
+    Names, usernames and phone numbers never reach the log: free text is replaced by a
+    synthetic value that passes or fails the same validation as the original, and phone
+    numbers by a fake one derived from the salted hash, so repeats still look like repeats.
+    """
+
+    def __init__(self, path: str, salt: str = ""):
+        self.path = path
+        self.salt = salt.encode() or secrets.token_bytes(16)
+        self.buffer: List[str] = []
+        self.records = 0
+        self.started = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()
+
+    def _digest(self, value: str) -> bytes:
+        return hashlib.blake2b(value.encode(), key=self.salt, digest_size=8).digest()
+
+    def pseudonym(self, user_id: int) -> int:
+        return int.from_bytes(self._digest(f"u:{user_id}")[:6], "big") + 1
+
+    def fake_phone(self, phone: str) -> str:
+        return "+998" + str(int.from_bytes(self._digest(f"p:{phone}"), "big") % 10**9).zfill(9)
+
+    def redact_phone(self, text: str) -> str:
+        normalized = normalize_phone(text)
+        return self.fake_phone(normalized) if normalized else "12345"
+
+    def redact_text(self, step: Optional[str], text: str) -> Tuple[str, str]:
+        text = text.strip()
+        if text.startswith("/"):
+            return "cmd", text.split()[0]
+        if step == "ask_name":
+            return "text", "Ali Valiyev" if valid_full_name(text) else "x"
+        if step == "ask_age":
+            return "text", text if text.isdigit() and len(text) <= 3 else "abc"
+        if step == "ask_phone":
+            return "text", self.redact_phone(text)
+        return "text", "..."
+
+    async def record(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return
+        step = context.user_data.get("step") if context.user_data is not None else None
+        if update.callback_query is not None:
+            kind, value = "cb", update.callback_query.data or ""
+        elif update.message is not None and update.message.contact is not None:
+            kind, value = "contact", self.redact_phone(update.message.contact.phone_number or "")
+        elif update.message is not None and update.message.text is not None:
+            kind, value = self.redact_text(step, update.message.text)
+        else:
+            return
+        self.buffer.append(json.dumps(
+            {"t": round(time.monotonic() - self.started, 3), "u": self.pseudonym(user.id), "s": step, "k": kind, "v": value},
+            ensure_ascii=False, separators=(",", ":"),
+        ))
+
+    def write(self, lines: List[str]):
+        # Runs on a worker thread. Every call appends a complete gzip member; gzip readers
+        # treat them as one stream. The lock keeps a shutdown flush from interleaving with
+        # one still running.
+        data = ("\n".join(lines) + "\n").encode()
+        with self._write_lock:
+            with (gzip.open(self.path, "ab") if self.path.endswith(".gz") else open(self.path, "ab")) as f:
+                f.write(data)
+            self.records += len(lines)
+
+    async def flush(self):
+        # The batch is taken on the event loop; compression and file I/O happen off it.
+        if not self.buffer:
+            return
+        lines, self.buffer = self.buffer, []
+        await asyncio.get_running_loop().run_in_executor(None, self.write, lines)
+
+    def start(self):
+        if self._task is None:
+            self.buffer.append(json.dumps({"session": datetime.now(timezone.utc).isoformat()}))
+            self._task = asyncio.create_task(self._run(), name="update-recorder")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(RECORD_FLUSH_SECONDS)
+            try:
+                await self.flush()
+            except OSError as e:
+                logger.error("Update recorder could not write %s: %s", self.path, e)
+
+update_recorder = UpdateRecorder(RECORD_UPDATES_PATH, RECORD_SALT) if RECORD_UPDATES_PATH else None
+
+# ----------------------- Handlers -----------------------
+@instrumented("start")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    welcome = (
+        "Assalomu alaykum!\n"
+        "*Welcome to ITeach Academy* 🎓\n\n"
+        "Bizning o‘quv jamoamizga qo‘shilish va ro‘yxatdan o‘tish uchun pastdagi tugmani bosing."
+    )
+    await update.message.reply_text(welcome, reply_markup=kb_register(), parse_mode="Markdown")
+    context.user_data.clear()
+
+# ----------------------- Callback routes -----------------------
+# Every route gets (update, context, arg) where arg is the part after the route's prefix.
+async def cb_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    context.user_data.clear()
+    await edit_screen(update.callback_query, "❌ Ro‘yxatdan o‘tish bekor qilindi.")
+
+async def cb_start(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await goto_courses(update, context)
+
+async def cb_back_courses(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    # cleanup level/section if any
+    context.user_data.pop("level_key", None)
+    context.user_data.pop("level_label", None)
+    context.user_data.pop("section_key", None)
+    context.user_data.pop("section_label", None)
+    await goto_courses(update, context)
+
+async def cb_back_levels(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    # only for EN/DE
+    context.user_data.pop("section_key", None)
+    context.user_data.pop("section_label", None)
+    await goto_levels(update.callback_query, context)
+
+async def cb_back_review(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await show_review(update, context)
+
+async def cb_course(update: Update, context: ContextTypes.DEFAULT_TYPE, course_key: str):
+    query = update.callback_query
+    cat = catalog
+    if course_key not in cat.courses:
+        await edit_screen(query, "Noto‘g‘ri kurs tanlandi. Qaytadan urinib ko‘ring.")
+        return
+    context.user_data["course_key"] = course_key
+    context.user_data["course_label"] = cat.courses[course_key]
+    # Reset dependent fields
+    context.user_data.pop("level_key", None)
+    context.user_data.pop("level_label", None)
+    context.user_data.pop("section_key", None)
+    context.user_data.pop("section_label", None)
+
+    if course_key in cat.courses_with_level:
+        await goto_levels(query, context)
+    else:
+        await goto_sections(query, context)
+
+async def cb_level(update: Update, context: ContextTypes.DEFAULT_TYPE, level_key: str):
+    query = update.callback_query
+    levels = catalog.levels
+    if level_key not in levels:
+        await edit_screen(query, "Noto‘g‘ri daraja tanlandi. Qaytadan urinib ko‘ring.")
+        return
+    context.user_data["level_key"] = level_key
+    context.user_data["level_label"] = levels[level_key]
+    await goto_sections(query, context)
+
+async def cb_section(update: Update, context: ContextTypes.DEFAULT_TYPE, section_key: str):
+    course_key = context.user_data.get("course_key")
+    valid_keys = catalog.sections_for(course_key)
+    if section_key not in valid_keys:
+        await edit_screen(update.callback_query, "Noto‘g‘ri bo‘lim tanlandi. Qaytadan urinib ko‘ring.")
+        return
+    context.user_data["section_key"] = section_key
+    context.user_data["section_label"] = valid_keys[section_key]
+    # Next ask full name
+    await ask_full_name(update, context)
+
+confirming_users: set = set()
+
+async def cb_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    query = update.callback_query
+    # Validate all required fields are present
+    required = ["course_key", "course_label", "section_label", "full_name", "age", "phone"]
+    if context.user_data.get("course_key") in catalog.courses_with_level:
+        required.append("level_label")
+    missing = [k for k in required if not context.user_data.get(k)]
+    if missing:
+        await edit_screen(query, "Ma’lumotlar yetarli emas. Iltimos, qaytadan boshlang: /start")
+        context.user_data.clear()
+        return
+
+    # A second tap on "Tasdiqlash" while the first is still being saved is ignored.
+    user_id = update.effective_user.id
+    if user_id in confirming_users:
+        return
+    confirming_users.add(user_id)
+    try:
+        row = registration_row(context.user_data, update.effective_user)
+        existing = await duplicate_guard.check(row)
+        if existing is None:
+            # Save to DB; the admin notification is queued in the same transaction
+            await reg_writer.submit(row, notice=(ADMIN_ID, build_admin_text(context.user_data, update.effective_user)))
+    except DuplicateRegistration as e:
+        existing = e.existing
+    except Exception as e:
+        logger.exception("DB error: %s", e)
+        await edit_screen(query, "Server xatosi yuz berdi. Iltimos, birozdan so‘ng qayta urinib ko‘ring.")
+        return
+    finally:
+        confirming_users.discard(user_id)
+
+    if existing is not None:
+        REGISTRATIONS.inc("duplicate")
+        funnel.leave(user_id, "duplicate")
+        await edit_screen(query, build_duplicate_text(existing), parse_mode="Markdown")
+        context.user_data.clear()
+        return
+
+    # Notify user
+    await edit_screen(
+        query,
+        "🎉 *Tabriklaymiz!* Siz ro‘yxatdan o‘tdingiz.\n"
+        "Tez orada siz bilan telefon raqamingiz orqali bog‘lanamiz.",
+        parse_mode="Markdown"
+    )
+    funnel.leave(user_id, "completed")
+    context.user_data.clear()
+
+async def cb_edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    course_key = context.user_data.get("course_key", "")
+    await edit_screen(update.callback_query, PROMPT_EDIT_MENU, reply_markup=kb_edit_menu(course_key), parse_mode="Markdown")
+    context.user_data["step"] = "edit_menu"
+
+async def cb_edit_course(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    context.user_data["edit_field"] = "course"
+    await goto_courses(update, context)
+
+async def cb_edit_level(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    context.user_data["edit_field"] = "level"
+    await goto_levels(update.callback_query, context)
+
+async def cb_edit_section(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    context.user_data["edit_field"] = "section"
+    await goto_sections(update.callback_query, context)
+
+async def cb_edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    context.user_data["edit_field"] = "name"
+    await edit_screen(update.callback_query, "✍️ Yangi *ism-familiya*ni kiriting:", parse_mode="Markdown")
+    context.user_data["step"] = "ask_name"
+
+async def cb_edit_age(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    context.user_data["edit_field"] = "age"
+    await edit_screen(update.callback_query, "🎂 Yangi *yosh*ni kiriting:", parse_mode="Markdown")
+    context.user_data["step"] = "ask_age"
+
+async def cb_edit_phone(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    context.user_data["edit_field"] = "phone"
+    await edit_screen(
+        update.callback_query,
+        "📞 Yangi *telefon*ni kiriting (format: `+998XXXXXXXXX`) yoki pastdagi tugma orqali yuboring.",
+        parse_mode="Markdown",
+    )
+    await update.effective_chat.send_message("Telefonni yuboring:", reply_markup=kb_phone())
+    context.user_data["step"] = "ask_phone"
+
+# ----------------------- Registration flow -----------------------
+# The whole callback side of the flow, defined once: callback data (a trailing ":*"
+# takes one argument), the steps it may be pressed from (ANY_STEP = always), handler.
+ANY_STEP = None
+
+REG_FLOW = (
+    ("reg:start",        ANY_STEP,                              cb_start),
+    ("reg:cancel",       ANY_STEP,                              cb_cancel),
+    ("reg:course:*",     {"choose_course"},                     cb_course),
+    ("reg:level:*",      {"choose_level"},                      cb_level),
+    ("reg:section:*",    {"choose_section"},                    cb_section),
+    ("reg:back:courses", {"choose_level", "choose_section"},    cb_back_courses),
+    ("reg:back:levels",  {"choose_section"},                    cb_back_levels),
+    ("reg:back:review",  {"edit_menu"},                         cb_back_review),
+    ("reg:confirm",      {"review"},                            cb_confirm),
+    ("reg:edit",         {"review"},                            cb_edit_menu),
+    ("reg:edit:course",  {"edit_menu"},                         cb_edit_course),
+    ("reg:edit:level",   {"edit_menu"},                         cb_edit_level),
+    ("reg:edit:section", {"edit_menu"},                         cb_edit_section),
+    ("reg:edit:name",    {"edit_menu"},                         cb_edit_name),
+    ("reg:edit:age",     {"edit_menu"},                         cb_edit_age),
+    ("reg:edit:phone",   {"edit_menu"},                         cb_edit_phone),
+)
+
+CallbackRouteHandler = Callable[[Update, ContextTypes.DEFAULT_TYPE, str], Awaitable[None]]
+
+class CallbackRoute:
+    __slots__ = ("name", "from_steps", "handler")
+
+    def __init__(self, name: str, from_steps: Optional[frozenset], handler: CallbackRouteHandler):
+        self.name = name
+        self.from_steps = from_steps
+        self.handler = handler
+
+    def allows(self, step: Optional[str]) -> bool:
+        return self.from_steps is None or step in self.from_steps
+
+class CallbackRouter:
+    """Dispatch table compiled from a flow definition.
+
+    Exact callbacks resolve with one dict lookup; ``prefix:*`` callbacks with a second one
+    on the part before the last ``:``.
+    """
+
+    def __init__(self, flow):
+        self.exact: Dict[str, CallbackRoute] = {}
+        self.prefixed: Dict[str, CallbackRoute] = {}
+        for pattern, from_steps, handler in flow:
+            steps = frozenset(from_steps) if from_steps is not None else None
+            if pattern.endswith(":*"):
+                prefix = pattern[:-2]
+                self.prefixed[prefix] = CallbackRoute(prefix, steps, handler)
+            else:
+                self.exact[pattern] = CallbackRoute(pattern, steps, handler)
+
+    def resolve(self, data: str) -> Tuple[Optional[CallbackRoute], str]:
+        route = self.exact.get(data)
+        if route is not None:
+            return route, ""
+        prefix, _, arg = data.rpartition(":")
+        return self.prefixed.get(prefix), arg
+
+reg_router = CallbackRouter(REG_FLOW)
+
+@instrumented("callback")
+async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data or ""
+    if trace_sampled():
+        trace_logger.info("Callback %s at step %s", data, context.user_data.get("step"))
+
+    route, arg = reg_router.resolve(data)
+    if route is None:
+        await query.answer()
+        return
+    if not route.allows(context.user_data.get("step")):
+        # A button from an earlier screen; the flow has moved on.
+        await query.answer("⚠️ Bu tugma endi faol emas.")
+        return
+    await query.answer()
+    await route.handler(update, context, arg)
+
 # Text input handler (name, age, phone via text)
+@instrumented("text")
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     step = context.user_data.get("step")
     text = (update.message.text or "").strip()
@@ -559,6 +2744,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Iltimos, /start buyrug‘i bilan boshlang yoki jarayon tugmalaridan foydalaning.")
 
 # Contact handler (phone share)
+@instrumented("contact")
 async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     step = context.user_data.get("step")
     contact: Contact = update.message.contact
@@ -576,19 +2762,1923 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("✔️ Qabul qilindi.", reply_markup=ReplyKeyboardRemove())
     await show_review(update, context)
 
+async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = [f"👷 Worker {worker_index} of {BOT_WORKERS}", ""] if worker_index is not None else []
+    lines += ["🗄 *Registration writer*"] + [f"• {k}: `{v}`" for k, v in reg_writer.snapshot().items()]
+    lines += ["", "🧬 *Duplicate check*"] + [f"• {k}: `{v}`" for k, v in duplicate_guard.snapshot().items()]
+    lines += ["", "🔔 *Admin notifications*"] + [f"• {k}: `{v}`" for k, v in admin_notifier.snapshot().items()]
+    lines += ["", "🖼 *Rendering*",
+              f"• cache hits/misses: `{render_cache.hits}/{render_cache.misses}`",
+              f"• edits skipped: `{screen_edits_skipped}`"]
+    lines += ["", "⚙️ *Update scheduler*"] + [f"• {k}: `{v}`" for k, v in update_scheduler.snapshot().items()]
+    lines += ["", "🛡 *Flood guard*"] + [f"• {k}: `{v}`" for k, v in flood_guard.snapshot().items()]
+    lines += ["", "📣 *Broadcast*"] + [f"• {k}: `{v}`" for k, v in broadcaster.snapshot().items()]
+    lines += ["", "🗃 *Archive*"] + [f"• {k}: `{v}`" for k, v in archiver.snapshot().items()]
+    lines += ["", "🚀 *Startup*"] + [f"• {k}: `{v}`" for k, v in startup.snapshot().items()]
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+async def reload_catalog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Bumping the version makes every running instance reload, not just this one.
+    await run_db(bump_catalog_version)
+    await refresh_catalog(force=True)
+    await update.message.reply_text(
+        f"📚 Katalog yangilandi (v{catalog.version}): {len(catalog.courses)} ta kurs, {len(catalog.levels)} ta daraja."
+    )
+
+@instrumented("cancel")
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     await update.message.reply_text("❌ Jarayon bekor qilindi. Qayta boshlash uchun /start bosing.", reply_markup=ReplyKeyboardRemove())
 
+# ----------------------- Export -----------------------
+EXPORT_CHUNK_ROWS = 5000
+XLSX_MAX_ROWS = 1_048_575  # per sheet, header excluded
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024
+EXPORT_USAGE = (
+    "Foydalanish: `/export [csv|xlsx] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [course=kalit]`\n"
+    "Masalan: `/export xlsx from=2024-09-01 course=english`"
+)
+EXPORT_COLUMNS = (
+    "id", "created_at", "tg_user_id", "username", "first_name", "last_name",
+    "full_name", "age", "phone", "course", "level", "section",
+)
+_export_lock = asyncio.Lock()
+
+class ExportRequest:
+    __slots__ = ("fmt", "date_from", "date_to", "course_key")
+
+    def __init__(self, fmt: str = "csv", date_from=None, date_to=None, course_key: Optional[str] = None):
+        self.fmt = fmt
+        self.date_from = date_from
+        self.date_to = date_to
+        self.course_key = course_key
+
+def parse_export_args(args: List[str]) -> ExportRequest:
+    req = ExportRequest()
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep and arg.lower() in ("csv", "xlsx"):
+            req.fmt = arg.lower()
+        elif key == "from":
+            req.date_from = datetime.strptime(value, "%Y-%m-%d").date()
+        elif key == "to":
+            req.date_to = datetime.strptime(value, "%Y-%m-%d").date()
+        elif key == "course" and value in catalog.courses:
+            req.course_key = value
+        else:
+            raise ValueError(arg)
+    return req
+
+def local_day_start(day) -> datetime:
+    # Filters are in Tashkent days; created_at is stored in UTC.
+    return datetime(day.year, day.month, day.day, tzinfo=TASHKENT_TZ).astimezone(timezone.utc)
+
+def registrations_query(req: ExportRequest):
+    stmt = select(*(getattr(Registration, c) for c in EXPORT_COLUMNS)).order_by(Registration.id)
+    if req.date_from:
+        stmt = stmt.where(Registration.created_at >= local_day_start(req.date_from))
+    if req.date_to:
+        stmt = stmt.where(Registration.created_at < local_day_start(req.date_to + timedelta(days=1)))
+    if req.course_key:
+        stmt = stmt.where(Registration.course == catalog.courses[req.course_key])
+    return stmt
+
+def stream_rows(stmt) -> Iterator[tuple]:
+    # Server-side cursor: rows arrive EXPORT_CHUNK_ROWS at a time, never all at once.
+    with bulk_engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS).execute(stmt)
+        for row in result:
+            yield export_row(row._mapping)
+
+def export_rows(req: ExportRequest) -> Iterator[tuple]:
+    # Archived months first (they hold the oldest rows), then the live table. The archive
+    # read lock keeps the archiver from moving rows between the two reads.
+    with archive_read_lock():
+        yield from archived_rows(req)
+        yield from stream_rows(registrations_query(req))
+
+def export_row(row: Dict[str, Any]) -> tuple:
+    created_at = row["created_at"]
+    if created_at is not None:
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        created_at = created_at.astimezone(TASHKENT_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    return tuple(created_at if c == "created_at" else row[c] for c in EXPORT_COLUMNS)
+
+def write_csv_gz(rows: Iterator[tuple], path: str) -> int:
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8-sig", newline="", compresslevel=6) as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+def write_xlsx(rows: Iterator[tuple], path: str) -> int:
+    from openpyxl import Workbook  # only needed for XLSX exports
+
+    wb = Workbook(write_only=True)  # rows are flushed to disk as they are appended
+    ws, in_sheet, count = None, XLSX_MAX_ROWS, 0
+    for row in rows:
+        if in_sheet == XLSX_MAX_ROWS:
+            ws = wb.create_sheet(f"registrations{'' if ws is None else count // XLSX_MAX_ROWS + 1}")
+            ws.append(EXPORT_COLUMNS)
+            in_sheet = 0
+        ws.append(row)
+        in_sheet += 1
+        count += 1
+    if ws is None:
+        wb.create_sheet("registrations").append(EXPORT_COLUMNS)
+    wb.save(path)
+    return count
+
+def build_export(req: ExportRequest, directory: str) -> Tuple[str, int]:
+    stamp = datetime.now(TASHKENT_TZ).strftime("%Y%m%d-%H%M")
+    if req.fmt == "xlsx":
+        path = os.path.join(directory, f"registrations-{stamp}.xlsx")
+        count = write_xlsx(export_rows(req), path)
+    else:
+        path = os.path.join(directory, f"registrations-{stamp}.csv.gz")
+        count = write_csv_gz(export_rows(req), path)
+    return path, count
+
+async def run_export(bot, chat_id: int, req: ExportRequest):
+    async with _export_lock:
+        started = time.perf_counter()
+        try:
+            with tempfile.TemporaryDirectory(prefix="export-") as directory:
+                path, count = await run_bulk(build_export, req, directory)
+                size = os.path.getsize(path)
+                if size > TELEGRAM_FILE_LIMIT:
+                    await bot.send_message(
+                        chat_id, f"❌ Fayl juda katta ({size // (1024 * 1024)} MB). Filtrlardan foydalaning."
+                    )
+                    return
+                with open(path, "rb") as f:
+                    await bot.send_document(
+                        chat_id,
+                        document=f,
+                        filename=os.path.basename(path),
+                        caption=f"📤 {count} ta yozuv • {time.perf_counter() - started:.1f}s",
+                        read_timeout=300,
+                        write_timeout=300,
+                    )
+        except Exception as e:
+            logger.exception("Export failed: %s", e)
+            await bot.send_message(chat_id, "❌ Eksport amalga oshmadi. Loglarni tekshiring.")
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        req = parse_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(EXPORT_USAGE, parse_mode="Markdown")
+        return
+    if _export_lock.locked():
+        await update.message.reply_text("⏳ Oldingi eksport hali tugamadi.")
+        return
+    await update.message.reply_text("⏳ Eksport tayyorlanmoqda, fayl shu yerga yuboriladi.")
+    # Runs in the background; the handler (and this user's update chain) returns at once.
+    context.application.create_task(run_export(context.bot, ADMIN_ID, req), name="export")
+
+# ----------------------- Archive -----------------------
+# With ARCHIVE_AFTER_MONTHS=N, registrations from before the last N months (plus the
+# current one) are moved, one month at a time, into gzip-compressed JSON lines files in
+# ARCHIVE_DIR and deleted from the table together with their name tokens, so the table and
+# its indexes only hold recent seasons. registration_archives lists the files; /export
+# reads them back, and /stats counts come from registration_daily_stats, which keeps every
+# month. The duplicate check and /import also look in registration_keys, which keeps the
+# (user, course) and (phone, course) of every archived row; /find only sees the table.
+# ARCHIVE_DIR must be on a persistent volume.
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("ARCHIVE_AFTER_MONTHS", "0"))  # 0 = never archive
+ARCHIVE_CHECK_SECONDS = 6 * 3600
+ARCHIVE_LOCK_KEY = 7_402_215_002
+# Copied to registration_keys for the duplicate check; "id" becomes registration_id.
+ARCHIVE_KEY_COLUMNS = ("id", "tg_user_id", "phone", "course", "full_name", "level", "section", "created_at")
+
+def add_months(month: date, n: int) -> date:
+    year, index = divmod(month.year * 12 + month.month - 1 + n, 12)
+    return date(year, index + 1, 1)
+
+@contextlib.contextmanager
+def archive_read_lock():
+    # Readers of archives + table share this Postgres advisory lock; the archiver takes it
+    # exclusively to move rows. In one process the export lock already keeps them apart.
+    if bulk_engine.dialect.name != "postgresql":
+        yield
+        return
+    with bulk_engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock_shared(:key)"), {"key": ARCHIVE_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock_shared(:key)"), {"key": ARCHIVE_LOCK_KEY})
+
+def read_archive(name: str) -> Iterator[Dict[str, Any]]:
+    with gzip.open(os.path.join(ARCHIVE_DIR, name), "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            record["created_at"] = datetime.fromisoformat(record["created_at"])
+            yield record
+
+def archived_rows(req: ExportRequest) -> Iterator[tuple]:
+    with SessionLocal(bind=bulk_engine) as session:
+        archives = session.execute(
+            select(RegistrationArchive.month, RegistrationArchive.file)
+            .order_by(RegistrationArchive.month, RegistrationArchive.first_id)
+        ).all()
+    start = local_day_start(req.date_from) if req.date_from else None
+    end = local_day_start(req.date_to + timedelta(days=1)) if req.date_to else None
+    course = catalog.courses[req.course_key] if req.course_key else None
+    for month, name in archives:
+        if (req.date_to and month > req.date_to) or (req.date_from and add_months(month, 1) <= req.date_from):
+            continue
+        for row in read_archive(name):
+            if course is not None and row["course"] != course:
+                continue
+            if (start and row["created_at"] < start) or (end and row["created_at"] >= end):
+                continue
+            yield export_row(row)
+
+def next_archive_month(before: date) -> Optional[date]:
+    # Oldest month with rows that is due, or None. Waits for the stats backfill, which
+    # counts existing rows from the table (there is none when the table started empty).
+    with SessionLocal(bind=bulk_engine) as session:
+        upto = session.get(AppMeta, STATS_BACKFILL_UPTO)
+        if session.get(AppMeta, STATS_BACKFILL_DONE) is None and (upto is None or upto.value != "0"):
+            return None
+        oldest = session.scalar(select(func.min(Registration.created_at)))
+    if oldest is None:
+        return None
+    if oldest.tzinfo is None:
+        oldest = oldest.replace(tzinfo=timezone.utc)
+    month = oldest.astimezone(TASHKENT_TZ).date().replace(day=1)
+    return month if month < before else None
+
+def archive_month(month: date) -> Optional[Tuple[str, int]]:
+    """Move one month of registrations to a file in ARCHIVE_DIR; returns (file, rows)."""
+    with SessionLocal(bind=bulk_engine) as session:
+        upto = session.scalar(select(func.max(Registration.id))) or 0
+    # Rows are never updated, so the same predicate selects the same rows to write and to delete.
+    in_month = and_(
+        Registration.created_at >= local_day_start(month),
+        Registration.created_at < local_day_start(add_months(month, 1)),
+        Registration.id <= upto,
+    )
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    tmp = os.path.join(ARCHIVE_DIR, f".registrations-{month:%Y-%m}.tmp")
+    stmt = select(*(getattr(Registration, c) for c in EXPORT_COLUMNS)).where(in_month).order_by(Registration.id)
+    rows = first_id = last_id = 0
+    with bulk_engine.connect() as conn, gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for row in conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS).execute(stmt):
+            record = dict(row._mapping)
+            created_at = record["created_at"]
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            record["created_at"] = created_at.isoformat()
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            first_id = first_id or row.id
+            last_id = row.id
+            rows += 1
+    if not rows:
+        os.remove(tmp)
+        return None
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    name = f"registrations-{month:%Y-%m}-{first_id}-{last_id}.jsonl.gz"
+    path = os.path.join(ARCHIVE_DIR, name)
+    os.replace(tmp, path)
+
+    with SessionLocal(bind=bulk_engine) as session:
+        if session.get_bind().dialect.name == "postgresql":
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ARCHIVE_LOCK_KEY})
+        ids = select(Registration.id).where(in_month)
+        session.execute(insert(RegistrationKey).from_select(
+            ["registration_id", *ARCHIVE_KEY_COLUMNS[1:]],
+            select(*(getattr(Registration, c) for c in ARCHIVE_KEY_COLUMNS)).where(in_month),
+        ))
+        session.execute(delete(RegistrationNameToken).where(RegistrationNameToken.registration_id.in_(ids)))
+        deleted = session.execute(delete(Registration).where(in_month)).rowcount
+        if deleted != rows:
+            # A transaction still open during the read committed a row into this range.
+            session.rollback()
+            os.remove(path)
+            raise RuntimeError(f"{month:%Y-%m}: wrote {rows} rows but {deleted} match now; will retry")
+        session.add(RegistrationArchive(
+            month=month, file=name, rows=rows, first_id=first_id, last_id=last_id,
+            archived_at=datetime.now(timezone.utc),
+        ))
+        session.commit()
+    return name, rows
+
+class Archiver:
+    """Checks every ARCHIVE_CHECK_SECONDS for months to archive and moves them, oldest first."""
+
+    def __init__(self):
+        self.files = 0
+        self.rows = 0
+        self.last_file: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "after_months": ARCHIVE_AFTER_MONTHS or "off",
+            "files_written": self.files,
+            "rows_moved": self.rows,
+            "last_file": self.last_file or "-",
+        }
+
+    def start(self):
+        if ARCHIVE_AFTER_MONTHS > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="archiver")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.exception("Archiving failed: %s", e)
+            await asyncio.sleep(ARCHIVE_CHECK_SECONDS)
+
+    async def run_once(self):
+        before = add_months(today_tashkent().replace(day=1), -ARCHIVE_AFTER_MONTHS)
+        while (month := await run_bulk(next_archive_month, before)) is not None:
+            started = time.monotonic()
+            # Not while an export in this process is reading the table and the archives.
+            async with _export_lock:
+                result = await run_bulk(archive_month, month)
+            if result is None:
+                break
+            self.files += 1
+            self.rows += result[1]
+            self.last_file = result[0]
+            logger.info("Archived %d registrations from %s to %s in %.1fs", result[1], f"{month:%Y-%m}", result[0], time.monotonic() - started)
+
+archiver = Archiver()
+
+# ----------------------- Import -----------------------
+# Walk-in and phone signups kept in a spreadsheet: the admin sends the CSV (.csv or
+# .csv.gz) or XLSX file with the caption /import. Rows are read as a stream, checked like
+# the bot's own flow and inserted IMPORT_BATCH_ROWS at a time on the bulk connections, one
+# short transaction per batch, so live signups never queue behind the file. Rows already
+# registered (same phone and course) are skipped and listed in the report.
+IMPORT_BATCH_ROWS = 1000
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # Bot API getFile limit
+WALK_IN_USER_ID = 0
+IMPORT_EXTENSIONS = (".csv", ".csv.gz", ".xlsx")
+IMPORT_REQUIRED = ("full_name", "age", "phone", "course", "section")
+IMPORT_USAGE = (
+    "Faylni (CSV yoki XLSX) `/import` izohi bilan yuboring.\n"
+    "Ustunlar: `full_name, age, phone, course, section`, ixtiyoriy `level, created_at` "
+    "(`YYYY-MM-DD [HH:MM]`, Toshkent vaqti).\n"
+    "Kurs, bo‘lim va daraja kaliti yoki nomi bilan yoziladi."
+)
+_import_lock = asyncio.Lock()
+
+class ImportFileError(Exception):
+    """The file as a whole cannot be imported; the message is shown to the admin."""
+
+class ImportReport:
+    __slots__ = ("columns", "rows", "imported", "duplicates", "errors")
+
+    def __init__(self):
+        self.columns: List[str] = []
+        self.rows = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.errors: List[Tuple[int, str, Dict[str, str]]] = []  # (line, reason, cells)
+
+def import_cell(value: Any) -> str:
+    # XLSX cells arrive typed: 998901234567 as a number, dates as datetime.
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value).strip()
+
+def read_import_rows(path: str, report: ImportReport) -> Iterator[Tuple[int, Dict[str, str]]]:
+    """(line number, {column: text}) for each non-empty row after the header."""
+    if path.endswith(".xlsx"):
+        from openpyxl import load_workbook  # only needed for XLSX imports
+
+        wb = load_workbook(path, read_only=True, data_only=True)  # rows are read lazily
+        try:
+            yield from _import_rows(wb.worksheets[0].iter_rows(values_only=True), report)
+        finally:
+            wb.close()
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8-sig", newline="") as f:
+        # Excel saves CSV with ";" in locales that use a decimal comma.
+        head = f.readline()
+        f.seek(0)
+        yield from _import_rows(csv.reader(f, delimiter=";" if head.count(";") > head.count(",") else ","), report)
+
+def _import_rows(rows: Iterator[Any], report: ImportReport) -> Iterator[Tuple[int, Dict[str, str]]]:
+    for line, values in enumerate(rows, start=1):
+        cells = [import_cell(v) for v in values]
+        if not any(cells):
+            continue
+        if not report.columns:
+            report.columns = [c.casefold().replace(" ", "_") for c in cells]
+            missing = [c for c in IMPORT_REQUIRED if c not in report.columns]
+            if missing:
+                raise ImportFileError(f"Sarlavhada ustun(lar) yo‘q: {', '.join(missing)}")
+            continue
+        # Short rows (trailing empty cells dropped by the spreadsheet) still get every column.
+        cells += [""] * (len(report.columns) - len(cells))
+        yield line, dict(zip(report.columns, cells))
+
+def catalog_names(options: Dict[str, str]) -> Dict[str, str]:
+    # Spreadsheets carry the key ("english"), the label, or the label without its emoji.
+    names = {}
+    for key, label in options.items():
+        for name in (key, label, re.sub(r"^\W+", "", label)):
+            names[name.casefold()] = key
+    return names
+
+class ImportNames:
+    """Lower-cased names of the catalog's courses, sections and levels, built once per import."""
+
+    __slots__ = ("courses", "sections", "levels")
+
+    def __init__(self, cat: Catalog):
+        self.courses = catalog_names(cat.courses)
+        self.sections = {key: catalog_names(cat.sections_for(key)) for key in cat.courses}
+        self.levels = catalog_names(cat.levels)
+
+def parse_import_time(value: str, now: datetime) -> datetime:
+    if not value:
+        return now
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%d.%m.%Y %H:%M", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=TASHKENT_TZ).astimezone(timezone.utc)
+        except ValueError:
+            continue
+    raise ValueError("sana noto‘g‘ri")
+
+def import_row(cells: Dict[str, str], cat: Catalog, names: ImportNames, now: datetime) -> Dict[str, Any]:
+    """A registrations row from one spreadsheet row; ValueError names the first problem."""
+    full_name = " ".join(cells["full_name"].split())
+    if not valid_full_name(full_name):
+        raise ValueError("ism familiya noto‘g‘ri")
+    if not valid_age(cells["age"]):
+        raise ValueError("yosh noto‘g‘ri")
+    phone = normalize_phone(cells["phone"])
+    if phone is None:
+        raise ValueError("telefon noto‘g‘ri")
+    course_key = names.courses.get(cells["course"].casefold())
+    if course_key is None:
+        raise ValueError("kurs topilmadi")
+    section_key = names.sections[course_key].get(cells["section"].casefold())
+    if section_key is None:
+        raise ValueError("bo‘lim topilmadi")
+    level = None
+    if course_key in cat.courses_with_level:
+        level_key = names.levels.get(cells.get("level", "").casefold())
+        if level_key is None:
+            raise ValueError("daraja topilmadi")
+        level = cat.levels[level_key]
+    return {
+        "tg_user_id": WALK_IN_USER_ID,
+        "username": None,
+        "first_name": None,
+        "last_name": None,
+        "full_name": full_name,
+        "age": int(cells["age"]),
+        "phone": phone,
+        "course": cat.courses[course_key],
+        "level": level,
+        "section": cat.sections_for(course_key)[section_key],
+        "created_at": parse_import_time(cells.get("created_at", ""), now),
+    }
+
+def insert_import_batch(rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[StatKey, int]]:
+    """Insert the rows not registered yet, with their name tokens and daily counters.
+
+    Returns the inserted rows and their counts. Existing (phone, course) pairs are looked
+    up first, archived ones included, because ON CONFLICT sees neither those nor a degraded
+    phone index; ON CONFLICT still covers a live signup racing the batch.
+    """
+    phones = {row["phone"] for row in rows}
+    with SessionLocal(bind=bulk_engine) as session:
+        taken = set(session.execute(
+            select(Registration.phone, Registration.course).where(Registration.phone.in_(phones))
+            .union_all(select(RegistrationKey.phone, RegistrationKey.course).where(RegistrationKey.phone.in_(phones)))
+        ).all())
+        fresh = [row for row in rows if (row["phone"], row["course"]) not in taken]
+        if not fresh:
+            return [], {}
+        dialect = session.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+            stmt = (
+                dialect_insert(Registration.__table__).on_conflict_do_nothing()
+                .returning(Registration.id, Registration.phone, Registration.course)
+            )
+            ids = {(phone, course): id_ for id_, phone, course in session.connection().execute(stmt, fresh)}
+        else:
+            ids = {(row["phone"], row["course"]): id_ for id_, row in zip(insert_with_ids(session, fresh), fresh)}
+        inserted = [row for row in fresh if (row["phone"], row["course"]) in ids]
+        tokens = [t for row in inserted for t in registration_tokens(ids[(row["phone"], row["course"])], row)]
+        if tokens:
+            session.connection().execute(insert(RegistrationNameToken.__table__), tokens)
+        counts: Dict[StatKey, int] = Counter(
+            stat_key(row["created_at"], row["course"], row["section"], row["level"]) for row in inserted
+        )
+        increment_daily_stats(session, counts)
+        session.commit()
+    return inserted, counts
+
+def import_registrations(path: str, cat: Catalog, on_batch: Callable[[List[Dict[str, Any]], Dict[StatKey, int]], None]) -> ImportReport:
+    # Runs on bulk_executor. on_batch gets every committed batch (rows, daily counts).
+    report = ImportReport()
+    names = ImportNames(cat)
+    now = datetime.now(timezone.utc)
+    seen = set()
+    batch: List[Tuple[int, Dict[str, str], Dict[str, Any]]] = []
+
+    def flush():
+        inserted, counts = insert_import_batch([row for _, _, row in batch])
+        report.imported += len(inserted)
+        done = {(row["phone"], row["course"]) for row in inserted}
+        for line, cells, row in batch:
+            if (row["phone"], row["course"]) not in done:
+                report.duplicates += 1
+                report.errors.append((line, "allaqachon ro‘yxatdan o‘tgan", cells))
+        if inserted:
+            on_batch(inserted, counts)
+        batch.clear()
+
+    for line, cells in read_import_rows(path, report):
+        report.rows += 1
+        try:
+            row = import_row(cells, cat, names, now)
+        except ValueError as e:
+            report.errors.append((line, str(e), cells))
+            continue
+        if (row["phone"], row["course"]) in seen:
+            report.duplicates += 1
+            report.errors.append((line, "faylda takrorlangan", cells))
+            continue
+        seen.add((row["phone"], row["course"]))
+        batch.append((line, cells, row))
+        if len(batch) >= IMPORT_BATCH_ROWS:
+            flush()
+    if batch:
+        flush()
+    if not report.columns:
+        raise ImportFileError("Fayl bo‘sh.")
+    return report
+
+def write_import_errors(report: ImportReport, path: str) -> None:
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["line", "error"] + report.columns)
+        for line, reason, cells in sorted(report.errors, key=lambda e: e[0]):
+            writer.writerow([line, reason] + [cells.get(c, "") for c in report.columns])
+
+def imported_batch(rows: List[Dict[str, Any]], counts: Dict[StatKey, int]) -> None:
+    # On the event loop, like the writer's own bookkeeping after a commit.
+    for row in rows:
+        duplicate_guard.add(row)
+    daily_stats.add(counts)
+    REGISTRATIONS.inc("imported", value=len(rows))
+
+async def run_import(bot, chat_id: int, document):
+    async with _import_lock:
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            with tempfile.TemporaryDirectory(prefix="import-") as directory:
+                name = document.file_name.lower()
+                path = os.path.join(directory, "upload" + (".csv.gz" if name.endswith(".gz") else os.path.splitext(name)[1]))
+                await (await bot.get_file(document.file_id)).download_to_drive(path, read_timeout=300)
+                report = await run_bulk(
+                    import_registrations, path, catalog,
+                    lambda rows, counts: loop.call_soon_threadsafe(imported_batch, rows, counts),
+                )
+                summary = (
+                    f"📥 {report.rows} ta qator: ✅ {report.imported} ta qo‘shildi, "
+                    f"♻️ {report.duplicates} ta takroriy, ❌ {len(report.errors) - report.duplicates} ta xato "
+                    f"• {time.perf_counter() - started:.1f}s"
+                )
+                logger.info(
+                    "Imported %d of %d rows from %s (%d duplicates, %d errors) in %.1fs",
+                    report.imported, report.rows, document.file_name, report.duplicates,
+                    len(report.errors) - report.duplicates, time.perf_counter() - started,
+                )
+                if not report.errors:
+                    await bot.send_message(chat_id, summary)
+                    return
+                errors_path = os.path.join(directory, "import-errors.csv")
+                await run_bulk(write_import_errors, report, errors_path)
+                with open(errors_path, "rb") as f:
+                    await bot.send_document(
+                        chat_id, document=f, filename="import-errors.csv", caption=summary,
+                        read_timeout=300, write_timeout=300,
+                    )
+        except ImportFileError as e:
+            await bot.send_message(chat_id, f"❌ {e}")
+        except Exception as e:
+            logger.exception("Import failed: %s", e)
+            await bot.send_message(chat_id, "❌ Import amalga oshmadi. Loglarni tekshiring.")
+
+async def import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(IMPORT_USAGE, parse_mode="Markdown")
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    if not (document.file_name or "").lower().endswith(IMPORT_EXTENSIONS):
+        await update.message.reply_text(IMPORT_USAGE, parse_mode="Markdown")
+        return
+    if (document.file_size or 0) > TELEGRAM_DOWNLOAD_LIMIT:
+        await update.message.reply_text("❌ Fayl 20 MB dan katta. Uni bir necha qismga bo‘ling.")
+        return
+    if _import_lock.locked():
+        await update.message.reply_text("⏳ Oldingi import hali tugamadi.")
+        return
+    await update.message.reply_text("⏳ Import boshlandi, natija shu yerga yuboriladi.")
+    # Runs in the background like /export; the file is read on the bulk connections.
+    context.application.create_task(run_import(context.bot, ADMIN_ID, document), name="import")
+
+# ----------------------- Broadcast -----------------------
+# /broadcast copies one admin message to registered students. Recipients are read from
+# the database in keyset pages on the bulk connections; sends are paced by a token bucket
+# kept below Telegram's ~30 messages/second per bot, so replies to users still get through,
+# and the broadcast steps aside while every update slot is busy. Progress is saved after
+# each page: after a crash at most one page is sent twice.
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "20"))  # messages per second
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PAGE = 100
+BROADCAST_MAX_ATTEMPTS = 3
+# Broadcasts started on another worker are found by polling.
+BROADCAST_POLL_SECONDS = 10 if BOT_WORKERS == 1 else 2
+BROADCAST_USAGE = (
+    "Foydalanish: yuboriladigan xabarga javob (reply) qilib yozing:\n"
+    "`/broadcast [course=kalit] [section=kalit] [level=kalit]`\n"
+    "To‘xtatish: `/broadcast cancel`"
+)
+
+BROADCAST_MESSAGES = CounterMetric(
+    "bot_broadcast_messages_total", "Broadcast deliveries by outcome (sent, blocked, failed).", ("outcome",)
+)
+
+def parse_broadcast_args(args: List[str]) -> Dict[str, Optional[str]]:
+    # Keys from the catalog, stored as the labels registrations hold.
+    found = {"course": None, "section": None, "level": None}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in found or found[key] is not None:
+            raise ValueError(arg)
+        found[key] = value
+    course_key = found["course"]
+    if course_key is not None and course_key not in catalog.courses:
+        raise ValueError(course_key)
+    sections = catalog.sections_for(course_key)
+    if found["section"] is not None and found["section"] not in sections:
+        raise ValueError(found["section"])
+    if found["level"] is not None and found["level"] not in catalog.levels:
+        raise ValueError(found["level"])
+    return {
+        "course": catalog.courses[course_key] if course_key else None,
+        "section": sections[found["section"]] if found["section"] else None,
+        "level": catalog.levels[found["level"]] if found["level"] else None,
+    }
+
+def recipients_query(filters_: Dict[str, Optional[str]]):
+    # Walk-ins (tg_user_id 0) have no chat to send to.
+    stmt = select(Registration.tg_user_id).where(Registration.tg_user_id != WALK_IN_USER_ID)
+    for column in ("course", "section", "level"):
+        if filters_.get(column) is not None:
+            stmt = stmt.where(getattr(Registration, column) == filters_[column])
+    return stmt
+
+def create_broadcast(chat_id: int, from_chat_id: int, message_id: int, filters_: Dict[str, Optional[str]]) -> Tuple[int, int]:
+    with SessionLocal(bind=bulk_engine) as session:
+        total = session.scalar(
+            select(func.count()).select_from(recipients_query(filters_).distinct().subquery())
+        )
+        broadcast = Broadcast(
+            chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, total=total,
+            status="running", last_user_id=0, sent=0, blocked=0, failed=0,
+            created_at=datetime.now(timezone.utc), **filters_,
+        )
+        session.add(broadcast)
+        session.commit()
+        return broadcast.id, total
+
+def next_broadcast() -> Optional[Dict[str, Any]]:
+    with SessionLocal(bind=bulk_engine) as session:
+        row = session.execute(
+            select(Broadcast.__table__).where(Broadcast.status == "running").order_by(Broadcast.id).limit(1)
+        ).mappings().first()
+        return dict(row) if row else None
+
+def fetch_recipients(job: Dict[str, Any], after: int, limit: int) -> List[int]:
+    # Keyset page: the next ``limit`` distinct users after ``after``, whatever the offset.
+    stmt = (
+        recipients_query(job)
+        .where(Registration.tg_user_id > after)
+        .group_by(Registration.tg_user_id)
+        .order_by(Registration.tg_user_id)
+        .limit(limit)
+    )
+    with bulk_engine.connect() as conn:
+        return list(conn.scalars(stmt))
+
+def save_broadcast_progress(broadcast_id: int, last_user_id: int, counts: Counter, finished: bool = False) -> str:
+    # Returns the status, so a cancel from any worker stops the sender at the next page.
+    values = {"last_user_id": last_user_id, "sent": counts["sent"], "blocked": counts["blocked"], "failed": counts["failed"]}
+    with SessionLocal(bind=bulk_engine) as session:
+        if finished:
+            session.execute(
+                update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status == "running")
+                .values(status="done", finished_at=datetime.now(timezone.utc))
+            )
+        session.execute(update(Broadcast).where(Broadcast.id == broadcast_id).values(**values))
+        status = session.scalar(select(Broadcast.status).where(Broadcast.id == broadcast_id))
+        session.commit()
+        return status
+
+def cancel_broadcasts() -> int:
+    with SessionLocal(bind=bulk_engine) as session:
+        n = session.execute(
+            update(Broadcast).where(Broadcast.status == "running")
+            .values(status="cancelled", finished_at=datetime.now(timezone.utc))
+        ).rowcount
+        session.commit()
+        return n
+
+class Broadcaster:
+    """Works through ``broadcasts`` one at a time; only one instance per bot runs it."""
+
+    def __init__(self):
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self._bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.current: Optional[Dict[str, Any]] = None
+        self.counts: Counter = Counter()
+
+    def snapshot(self) -> Dict[str, Any]:
+        job = self.current
+        return {
+            "running": f"#{job['id']} {sum(self.counts.values())}/{job['total']}" if job else None,
+            "sent": self.counts["sent"],
+            "blocked": self.counts["blocked"],
+            "failed": self.counts["failed"],
+        }
+
+    def start(self, bot):
+        if self._task is None:
+            self._bot = bot
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="broadcaster")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                job = await run_bulk(next_broadcast)
+            except Exception as e:
+                logger.warning("Failed to read broadcasts: %s", e)
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), BROADCAST_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._broadcast(job)
+            except Exception as e:
+                # Progress is saved; the next pass resumes after a pause.
+                logger.exception("Broadcast #%d interrupted: %s", job["id"], e)
+                await asyncio.sleep(BROADCAST_POLL_SECONDS)
+            finally:
+                self.current = None
+
+    async def _broadcast(self, job: Dict[str, Any]):
+        self.current = job
+        self.counts = Counter({k: job[k] for k in ("sent", "blocked", "failed")})
+        errors: Counter = Counter()
+        started, done_before = time.monotonic(), sum(self.counts.values())
+        gate = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last, status = job["last_user_id"], "running"
+        if last:
+            logger.info("Resuming broadcast #%d after user %d", job["id"], last)
+        while status == "running":
+            page = await run_bulk(fetch_recipients, job, last, BROADCAST_PAGE)
+            if page:
+                for outcome, error in await asyncio.gather(*(self._deliver(job, chat_id, gate) for chat_id in page)):
+                    self.counts[outcome] += 1
+                    BROADCAST_MESSAGES.inc(outcome)
+                    if error:
+                        errors[error] += 1
+                last = page[-1]
+            status = await run_bulk(save_broadcast_progress, job["id"], last, self.counts, not page)
+            if not page:
+                break
+        elapsed = time.monotonic() - started
+        handled = sum(self.counts.values()) - done_before
+        logger.info("Broadcast #%d %s: %s in %.1fs", job["id"], status, dict(self.counts), elapsed)
+        head = "✅ yakunlandi" if status == "done" else "⛔️ to‘xtatildi"
+        lines = [
+            f"📣 Xabar #{job['id']} {head}",
+            f"• yuborildi: {self.counts['sent']}",
+            f"• botni bloklagan: {self.counts['blocked']}",
+            f"• xato: {self.counts['failed']}",
+            f"• {elapsed:.0f}s, {handled / elapsed if elapsed else 0:.1f} xabar/s",
+        ]
+        lines += [f"  {n} × {error}" for error, n in errors.most_common(5)]
+        try:
+            await self._bot.send_message(job["chat_id"], "\n".join(lines))
+        except TelegramError as e:
+            logger.warning("Could not report broadcast #%d: %s", job["id"], e)
+
+    async def _deliver(self, job: Dict[str, Any], chat_id: int, gate: asyncio.Semaphore) -> Tuple[str, Optional[str]]:
+        error = None
+        async with gate:
+            attempts = 0
+            while attempts < BROADCAST_MAX_ATTEMPTS:
+                while update_scheduler.active >= update_scheduler.concurrency:
+                    await asyncio.sleep(0.1)
+                await self.bucket.acquire()
+                try:
+                    await self._bot.copy_message(chat_id=chat_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+                    return "sent", None
+                except RetryAfter as e:
+                    # Not the recipient's fault: every send waits, then this one is retried.
+                    self.bucket.pause(retry_after_seconds(e))
+                    continue
+                except Forbidden:
+                    return "blocked", None
+                except BadRequest as e:
+                    return "failed", str(e)
+                except TelegramError as e:
+                    error = str(e)
+                attempts += 1
+                await asyncio.sleep(2 ** attempts)
+        return "failed", error
+
+broadcaster = Broadcaster()
+
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args or []
+    if args == ["cancel"]:
+        n = await run_bulk(cancel_broadcasts)
+        await update.message.reply_text(f"⛔️ {n} ta xabar yuborish to‘xtatildi." if n else "Faol xabar yuborish yo‘q.")
+        return
+    source = update.message.reply_to_message
+    try:
+        filters_ = parse_broadcast_args(args)
+    except ValueError:
+        source = None
+    if source is None:
+        await update.message.reply_text(BROADCAST_USAGE, parse_mode="Markdown")
+        return
+    broadcast_id, total = await run_bulk(
+        create_broadcast, update.effective_chat.id, source.chat_id, source.message_id, filters_
+    )
+    await update.message.reply_text(f"📣 Xabar #{broadcast_id} navbatga qo‘yildi: {total} ta qabul qiluvchi.")
+    broadcaster.wake()
+
+# ----------------------- Search -----------------------
+# /find looks registrations up by phone prefix (range scan on the phone index), @username
+# (lower(username) index) or name words (prefix ranges on registration_name_tokens, every
+# word must match). Results come newest first, FIND_PAGE at a time; the inline buttons
+# carry the id to continue from (keyset pagination) and the query stays in user_data.
+FIND_PAGE = 5
+FIND_MIN_PHONE_PREFIX = 6  # "+998" and a two-digit operator code, e.g. "+99890"; "+998" alone matches the whole table
+FIND_MIN_TOKEN = 2
+FIND_MAX_TOKENS = 4
+FIND_USAGE = (
+    "Foydalanish: `/find +99890123`, `/find @username` yoki `/find Alovuddinov`\n"
+    "Telefon raqamining boshi, username yoki ism-familiya bo‘yicha qidiradi."
+)
+NAME_TOKENS_UPTO = "name_tokens_upto"
+NAME_TOKENS_DONE = "name_tokens_done"  # last registration id already tokenized
+NAME_TOKENS_CHUNK = 5000
+
+FIND_SECONDS = HistogramMetric("bot_find_seconds", "Time of one /find page query by kind.", ("kind",))
+
+def parse_find_query(text_: str) -> Tuple[str, Any]:
+    q = text_.strip()
+    if q.startswith("@"):
+        handle = q[1:].lower()
+        if not re.fullmatch(r"\w{3,32}", handle):
+            raise ValueError(q)
+        return "username", handle
+    digits = re.sub(r"[\s\-()+]", "", q)
+    if digits.isdigit():
+        prefix = ("+" + digits if digits.startswith("998") else "+998" + digits)[:13]
+        if len(prefix) < FIND_MIN_PHONE_PREFIX:
+            raise ValueError(q)
+        return "phone", prefix
+    tokens = [t for t in name_tokens(q) if len(t) >= FIND_MIN_TOKEN]
+    if not tokens:
+        raise ValueError(q)
+    # The longest words are the most selective.
+    return "name", sorted(tokens, key=len, reverse=True)[:FIND_MAX_TOKENS]
+
+def prefix_end(prefix: str) -> str:
+    # Smallest string greater than every string starting with prefix.
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def find_registrations(kind: str, value: Any, before: Optional[int] = None, after: Optional[int] = None) -> List[Dict[str, Any]]:
+    stmt = select(
+        Registration.id, Registration.created_at, Registration.full_name, Registration.phone,
+        Registration.username, Registration.tg_user_id, Registration.course, Registration.section, Registration.level,
+    )
+    if kind == "phone":
+        stmt = stmt.where(Registration.phone >= value, Registration.phone < prefix_end(value))
+    elif kind == "username":
+        stmt = stmt.where(func.lower(Registration.username) == value)
+    else:
+        for token in value:
+            stmt = stmt.where(Registration.id.in_(
+                select(RegistrationNameToken.registration_id)
+                .where(RegistrationNameToken.token >= token, RegistrationNameToken.token < prefix_end(token))
+            ))
+    if after is not None:
+        stmt = stmt.where(Registration.id > after).order_by(Registration.id)
+    else:
+        if before is not None:
+            stmt = stmt.where(Registration.id < before)
+        stmt = stmt.order_by(Registration.id.desc())
+    started = time.perf_counter()
+    with SessionLocal() as session:
+        rows = [dict(r) for r in session.execute(stmt.limit(FIND_PAGE + 1)).mappings()]
+    FIND_SECONDS.observe(time.perf_counter() - started, kind)
+    return rows
+
+def find_page(kind: str, value: Any, direction: Optional[str] = None, cursor: Optional[int] = None) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    started = time.perf_counter()
+    if direction == "newer":
+        rows = find_registrations(kind, value, after=cursor)
+        newer, older = len(rows) > FIND_PAGE, True
+        rows = rows[:FIND_PAGE][::-1]
+    else:
+        rows = find_registrations(kind, value, before=cursor)
+        newer, older = direction == "older", len(rows) > FIND_PAGE
+        rows = rows[:FIND_PAGE]
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    query = "@" + value if kind == "username" else value if kind == "phone" else " ".join(value)
+    if not rows:
+        return f"🔎 {query}: hech narsa topilmadi ({elapsed_ms:.0f} ms)", None
+    lines = [f"🔎 {query} ({elapsed_ms:.0f} ms)", ""]
+    for r in rows:
+        created = r["created_at"]
+        if created is not None:
+            if created.tzinfo is None:
+                created = created.replace(tzinfo=timezone.utc)
+            created = created.astimezone(TASHKENT_TZ).strftime("%Y-%m-%d %H:%M")
+        username = f" • @{r['username']}" if r["username"] else ""
+        level = f" / {r['level']}" if r["level"] else ""
+        lines += [
+            f"#{r['id']} • {created}",
+            f"👤 {r['full_name']} • 📱 {r['phone']}{username} • "
+            + (f"🆔 {r['tg_user_id']}" if r["tg_user_id"] != WALK_IN_USER_ID else "🚶 offlayn"),
+            f"📚 {r['course']} / {r['section']}{level}",
+            "",
+        ]
+    buttons = []
+    if newer:
+        buttons.append(InlineKeyboardButton("⬅️ Yangiroq", callback_data=f"find:newer:{rows[0]['id']}"))
+    if older:
+        buttons.append(InlineKeyboardButton("Eskiroq ➡️", callback_data=f"find:older:{rows[-1]['id']}"))
+    return "\n".join(lines).rstrip(), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def find_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        kind, value = parse_find_query(" ".join(context.args or []))
+    except ValueError:
+        await update.message.reply_text(FIND_USAGE, parse_mode="Markdown")
+        return
+    context.user_data["find"] = [kind, value]
+    text_, markup = await run_db(find_page, kind, value)
+    await update.message.reply_text(text_, reply_markup=markup)
+
+async def find_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if update.effective_user.id != ADMIN_ID:
+        await query.answer()
+        return
+    saved = context.user_data.get("find")
+    parts = query.data.split(":")
+    direction, cursor = parts[1:] if len(parts) == 3 else ("", "")
+    if not saved or direction not in ("newer", "older") or not cursor.isdigit():
+        await query.answer("Qidiruv eskirgan, /find ni qayta yuboring.")
+        return
+    await query.answer()
+    text_, markup = await run_db(find_page, saved[0], saved[1], direction, int(cursor))
+    try:
+        await query.edit_message_text(text_, reply_markup=markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+def prepare_name_token_backfill() -> Optional[Tuple[int, int]]:
+    # Like the stats backfill: registrations up to a boundary fixed before the writer
+    # starts are tokenized here, everything after it by the writer. Returns (done, upto).
+    with SessionLocal() as session:
+        upto = session.get(AppMeta, NAME_TOKENS_UPTO)
+        if upto is None:
+            max_id = session.scalar(select(func.max(Registration.id))) or 0
+            upto = AppMeta(key=NAME_TOKENS_UPTO, value=str(max_id))
+            session.add(upto)
+            session.commit()
+        done = session.get(AppMeta, NAME_TOKENS_DONE)
+        done_id = int(done.value) if done is not None else 0
+        return None if done_id >= int(upto.value) else (done_id, int(upto.value))
+
+def tokenize_registrations(after: int, upto: int) -> Optional[int]:
+    # One chunk and its progress in one transaction, so a restart neither skips nor repeats.
+    with SessionLocal(bind=bulk_engine) as session:
+        rows = session.execute(
+            select(Registration.id, Registration.full_name, Registration.first_name, Registration.last_name)
+            .where(Registration.id > after, Registration.id <= upto)
+            .order_by(Registration.id)
+            .limit(NAME_TOKENS_CHUNK)
+        ).mappings().all()
+        last = rows[-1]["id"] if rows else upto
+        tokens = [t for r in rows for t in registration_tokens(r["id"], r)]
+        if tokens:
+            session.execute(insert(RegistrationNameToken), tokens)
+        done = session.get(AppMeta, NAME_TOKENS_DONE)
+        if done is None:
+            session.add(AppMeta(key=NAME_TOKENS_DONE, value=str(last)))
+        else:
+            done.value = str(last)
+        session.commit()
+        return last if rows else None
+
+async def name_token_backfill(after: int, upto: int):
+    started = time.monotonic()
+    try:
+        while True:
+            last = await run_bulk(tokenize_registrations, after, upto)
+            if last is None:
+                break
+            after = last
+        await run_bulk(analyze_table, RegistrationNameToken.__tablename__)
+        logger.info("Name token backfill reached registration %d in %.0fs", upto, time.monotonic() - started)
+    except Exception as e:
+        logger.exception("Name token backfill failed: %s", e)
+
+# ----------------------- Stats -----------------------
+STATS_BACKFILL_UPTO = "stats_backfill_upto"
+STATS_BACKFILL_DONE = "stats_backfill_done"
+
+def today_tashkent() -> date:
+    return datetime.now(TASHKENT_TZ).date()
+
+def load_daily_stats(day_from: date, day_to: date) -> Dict[Tuple[str, str, str], int]:
+    # Bounded by days x catalog size, whatever the size of registrations.
+    with SessionLocal() as session:
+        rows = session.execute(
+            select(RegistrationDailyStat.course, RegistrationDailyStat.section,
+                   RegistrationDailyStat.level, func.sum(RegistrationDailyStat.count))
+            .where(RegistrationDailyStat.day >= day_from, RegistrationDailyStat.day <= day_to)
+            .group_by(RegistrationDailyStat.course, RegistrationDailyStat.section, RegistrationDailyStat.level)
+        )
+        return {(course, section, level): int(n) for course, section, level, n in rows}
+
+class DailyStatsCache:
+    """Today's counters, kept in memory and advanced by the registration writer."""
+
+    def __init__(self):
+        self.day: Optional[date] = None
+        self.counts: Counter = Counter()
+
+    def load(self, day: date, counts: Dict[Tuple[str, str, str], int]):
+        self.day = day
+        self.counts = Counter(counts)
+
+    def add(self, counts: Dict[StatKey, int]):
+        # Callers add after their commit. Until today's counters have been loaded (after a
+        # restart, or once the day rolls over) leave them to the next today(), which reads
+        # the table and so already includes this batch.
+        today = today_tashkent()
+        if self.day != today:
+            self.day, self.counts = None, Counter()
+            return
+        for (day, course, section, level), n in counts.items():
+            if day == today:
+                self.counts[(course, section, level)] += n
+
+    async def today(self) -> Counter:
+        # Other workers' signups only show up in the table, so with several workers read it.
+        today = today_tashkent()
+        if self.day != today or BOT_WORKERS > 1:
+            self.load(today, await run_db(load_daily_stats, today, today))
+        return self.counts
+
+daily_stats = DailyStatsCache()
+
+def prepare_stats_backfill() -> Optional[int]:
+    # Registrations older than the summary table are counted once. The id boundary is
+    # fixed before the writer starts, so rows above it are only ever counted by the writer.
+    with SessionLocal() as session:
+        if session.get(AppMeta, STATS_BACKFILL_DONE) is not None:
+            return None
+        upto = session.get(AppMeta, STATS_BACKFILL_UPTO)
+        if upto is not None:
+            return int(upto.value)
+        max_id = session.scalar(select(func.max(Registration.id))) or 0
+        session.add(AppMeta(key=STATS_BACKFILL_UPTO, value=str(max_id)))
+        session.commit()
+        return max_id
+
+def run_stats_backfill(upto: int) -> int:
+    counts: Dict[StatKey, int] = Counter()
+    stmt = (
+        select(Registration.created_at, Registration.course, Registration.section, Registration.level)
+        .where(Registration.id <= upto)
+    )
+    with bulk_engine.connect() as conn:
+        for created_at, course, section, level in conn.execution_options(
+            stream_results=True, yield_per=EXPORT_CHUNK_ROWS
+        ).execute(stmt):
+            counts[stat_key(created_at or datetime.now(timezone.utc), course, section, level)] += 1
+    with SessionLocal(bind=bulk_engine) as session:
+        increment_daily_stats(session, counts)
+        session.add(AppMeta(key=STATS_BACKFILL_DONE, value=str(upto)))
+        session.commit()
+    return sum(counts.values())
+
+async def stats_backfill(upto: int):
+    try:
+        n = await run_bulk(run_stats_backfill, upto)
+        logger.info("Stats backfill counted %d existing registrations", n)
+        today = today_tashkent()
+        daily_stats.load(today, await run_db(load_daily_stats, today, today))
+    except Exception as e:
+        logger.exception("Stats backfill failed: %s", e)
+
+def format_breakdown(counts: Dict[Tuple[str, str, str], int]) -> List[str]:
+    by_course: Counter = Counter()
+    by_section: Counter = Counter()
+    by_level: Counter = Counter()
+    for (course, section, level), n in counts.items():
+        by_course[course] += n
+        by_section[section] += n
+        if level:
+            by_level[level] += n
+    lines = []
+    for title, counter in (("📚 Kurslar", by_course), ("🗂 Bo‘limlar", by_section), ("📊 Darajalar", by_level)):
+        if counter:
+            lines.append(f"{title}: " + ", ".join(f"{k} — {n}" for k, n in counter.most_common()))
+    return lines
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    today = today_tashkent()
+    week_start = today - timedelta(days=today.weekday())
+    today_counts = await daily_stats.today()
+    week_counts = Counter(today_counts)
+    if week_start < today:
+        week_counts.update(await run_db(load_daily_stats, week_start, today - timedelta(days=1)))
+
+    # Plain text: labels come from the catalog and may contain Markdown characters.
+    lines = [f"📊 Bugun ({today:%Y-%m-%d}): {sum(today_counts.values())} ta"]
+    lines += format_breakdown(today_counts)
+    lines += ["", f"📅 Shu hafta ({week_start:%Y-%m-%d} – {today:%Y-%m-%d}): {sum(week_counts.values())} ta"]
+    lines += format_breakdown(week_counts)
+    await update.message.reply_text("\n".join(lines))
+
+# ----------------------- Embedded HTTP server -----------------------
+HTTP_HOST = os.environ.get("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.environ.get("PORT", "8080"))
+HTTP_MAX_BODY = 1 << 20
+HTTP_IDLE_TIMEOUT = 30
+# Once a request starts, its whole head (request line and headers) must arrive within
+# HTTP_HEAD_TIMEOUT and stay under these caps, so a client trickling or endlessly
+# repeating headers cannot hold a connection and its memory.
+HTTP_HEAD_TIMEOUT = 10
+HTTP_MAX_HEADERS = 100
+HTTP_MAX_HEADER_BYTES = 16 << 10
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 431: "Request Header Fields Too Large",
+    503: "Service Unavailable",
+}
+
+class HttpRequest:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method: str, path: str, query: Dict[str, List[str]], headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+HttpResponse = Tuple[int, str, bytes]
+HttpRoute = Callable[[HttpRequest], Awaitable[HttpResponse]]
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server (keep-alive, Content-Length bodies only).
+
+    Enough for Telegram webhooks and internal endpoints without pulling in a web framework.
+    """
+
+    def __init__(self, host: str = HTTP_HOST, port: int = HTTP_PORT):
+        self.host = host
+        self.port = port
+        self.routes: Dict[Tuple[str, str], HttpRoute] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: HttpRoute):
+        self.routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        logger.info("HTTP server listening on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                first = await asyncio.wait_for(reader.read(1), HTTP_IDLE_TIMEOUT)
+                if not first:
+                    break
+                head = await asyncio.wait_for(self._read_head(reader, first), HTTP_HEAD_TIMEOUT)
+                if head is None:
+                    await self._respond(writer, 431, "text/plain", b"headers too large", close=True)
+                    break
+                line, headers = head
+                try:
+                    method, target, _ = line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, "text/plain", b"bad request line", close=True)
+                    break
+                length = int(headers.get("content-length") or 0)
+                if length > HTTP_MAX_BODY:
+                    await self._respond(writer, 413, "text/plain", b"too large", close=True)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), HTTP_IDLE_TIMEOUT) if length else b""
+                url = urlsplit(target)
+                handler = self.routes.get((method.upper(), url.path))
+                if handler is None:
+                    known = any(path == url.path for _, path in self.routes)
+                    status, ctype, payload = (405 if known else 404), "text/plain", b""
+                else:
+                    try:
+                        status, ctype, payload = await handler(
+                            HttpRequest(method.upper(), url.path, parse_qs(url.query), headers, body)
+                        )
+                    except Exception as e:
+                        logger.exception("HTTP handler error on %s: %s", url.path, e)
+                        status, ctype, payload = 503, "text/plain", b""
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, ctype, payload, close=close)
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader, first: bytes) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        # None when the head goes over HTTP_MAX_HEADERS or HTTP_MAX_HEADER_BYTES.
+        line = first + await reader.readline()
+        size = len(line)
+        headers: Dict[str, str] = {}
+        count = 0
+        while True:
+            h = await reader.readline()
+            if h in (b"\r\n", b"\n", b""):
+                return line, headers
+            count += 1
+            size += len(h)
+            if count > HTTP_MAX_HEADERS or size > HTTP_MAX_HEADER_BYTES:
+                return None
+            name, _, value = h.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, ctype: str, payload: bytes, close: bool = False):
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {ctype}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+# ----------------------- Webhook -----------------------
+# BOT_MODE=webhook serves updates over HTTP instead of long polling.
+# WEBHOOK_URL is the public base URL; leave it empty to accept POSTs locally
+# (e.g. from webhook_harness.py) without registering anything with Telegram.
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+def webhook_authorized(request: HttpRequest) -> bool:
+    token = request.headers.get("x-telegram-bot-api-secret-token", "")
+    return hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode())
+
+def webhook_endpoint(application: Application) -> HttpRoute:
+    async def receive(request: HttpRequest) -> HttpResponse:
+        if not webhook_authorized(request):
+            return 403, "text/plain", b""
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except Exception:
+            return 400, "text/plain", b""
+        # Acknowledge immediately; handlers run off the update queue.
+        application.update_queue.put_nowait(update)
+        return 200, "text/plain", b""
+    return receive
+
+async def healthz(request: HttpRequest) -> HttpResponse:
+    return 200, "text/plain", b"ok"
+
+async def ready_endpoint(request: HttpRequest) -> HttpResponse:
+    # /healthz answers as soon as the process is up; /ready only once startup is done.
+    if startup.ready:
+        return 200, "text/plain", b"ready"
+    return 503, "text/plain", startup.state().encode()
+
+async def metrics_endpoint(request: HttpRequest) -> HttpResponse:
+    return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode()
+
+def metrics_server_port() -> Optional[int]:
+    # Webhook mode serves /metrics next to the webhook unless METRICS_PORT names another
+    # port; polling mode has no HTTP server of its own, so it listens on METRICS_PORT or PORT.
+    # Worker processes (BOT_WORKERS > 1) each have their own metrics on the next ports.
+    if METRICS_PORT.lower() == "off":
+        return None
+    port = int(METRICS_PORT) if METRICS_PORT else HTTP_PORT
+    if worker_index is not None:
+        return port + 1 + worker_index
+    if BOT_MODE == "webhook" and port == HTTP_PORT:
+        return None
+    return port
+
+async def register_webhook(bot: Bot):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+        logger.info("Webhook registered at %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+    else:
+        logger.warning("WEBHOOK_URL is empty; accepting local webhook POSTs only.")
+
+def stop_on_signals(*signals: int) -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in signals:
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+@contextlib.asynccontextmanager
+async def running(application: Application):
+    # What run_polling does around the updater, for the modes that feed update_queue themselves.
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        yield application
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def serve_webhook(application: Application):
+    server = HttpServer()
+    server.route("POST", WEBHOOK_PATH, webhook_endpoint(application))
+    server.route("GET", "/healthz", healthz)
+    server.route("GET", "/ready", ready_endpoint)
+    if METRICS_PORT.lower() != "off" and metrics_server_port() is None:
+        server.route("GET", "/metrics", metrics_endpoint)
+
+    stop = stop_on_signals(signal.SIGINT, signal.SIGTERM)
+    async with running(application):
+        try:
+            await server.start()
+            await register_webhook(application.bot)
+            await stop.wait()
+        finally:
+            await server.stop()
+
+# ----------------------- Multi-worker mode -----------------------
+# BOT_WORKERS=N (N > 1) splits the bot into one ingress process, which receives every
+# update (long polling or the webhook) and does nothing else, and N worker processes that
+# run the handlers. Updates are sharded by user id, so all of a user's updates reach the
+# same worker in arrival order: the flow state in that worker's user_data is the only live
+# copy, exactly as in a single process. Each worker has its own DB pool (DB_POOL_SIZE
+# connections), registration writer and duplicate filter; the unique indexes settle
+# races between workers. Admin notifications go through the shared outbox and only
+# worker 0 delivers them.
+WORKER_QUEUE_SIZE = MAX_PENDING_UPDATES  # updates waiting for one worker
+WORKER_POLL_SECONDS = 0.01  # a worker's sleep while its queue is empty
+WORKER_DRAIN_TIMEOUT = 0.5
+WORKER_CHECK_SECONDS = 1.0
+WORKER_STOP_TIMEOUT = 30.0
+# A worker that keeps dying right after it starts is restarted after 2, 4, ... up to 60
+# seconds; one that ran for WORKER_STABLE_SECONDS starts over at WORKER_CHECK_SECONDS.
+WORKER_RESTART_MAX_DELAY = 60.0
+WORKER_STABLE_SECONDS = 60.0
+
+INGRESS_UPDATES = CounterMetric("bot_ingress_updates_total", "Updates handed to each worker.", ("worker",))
+INGRESS_FULL = CounterMetric("bot_ingress_queue_full_total", "Times an update found its worker's queue full.", ("worker",))
+WORKER_RESTARTS = CounterMetric("bot_worker_restarts_total", "Worker processes restarted after exiting.", ("worker",))
+
+def raw_update_user_id(data: Dict[str, Any]) -> Optional[int]:
+    # The webhook ingress shards without building Update objects; every update kind with
+    # a user carries it as "from" in its payload.
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get("from")
+            if isinstance(user, dict) and isinstance(user.get("id"), int):
+                return user["id"]
+    return None
+
+def worker_log_path(path: str, index: int) -> str:
+    # updates.jsonl.gz -> updates.w0.jsonl.gz: one recording per worker, merged on replay.
+    head, name = os.path.split(path)
+    stem, dot, ext = name.partition(".")
+    return os.path.join(head, f"{stem}.w{index}{dot}{ext}")
+
+class WorkerPool:
+    """Ingress side of multi-worker mode: one bounded queue and one process per worker."""
+
+    def __init__(self, size: int):
+        # spawn, not fork: each worker starts with its own event loop, threads and DB pool.
+        self.mp = multiprocessing.get_context("spawn")
+        self.queues = [self.mp.Queue(WORKER_QUEUE_SIZE) for _ in range(size)]
+        self.processes: List[Any] = [None] * size
+        self.started = [0.0] * size
+        self.restart_delay = [WORKER_CHECK_SECONDS] * size
+        self.restart_at: List[Optional[float]] = [None] * size
+        self.stopping = False
+
+    def _spawn(self, index: int):
+        process = self.mp.Process(target=worker_main, args=(index, self.queues[index]), name=f"bot-worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+        logger.info("Started %d bot workers", len(self.queues))
+
+    def depths(self) -> Dict[Tuple[int], int]:
+        return {(i,): q.qsize() for i, q in enumerate(self.queues)}
+
+    def dispatch(self, user_id: Optional[int], payload: Dict[str, Any]) -> bool:
+        """Queue an update for its user's worker; False if that worker is too far behind."""
+        index = (user_id or 0) % len(self.queues)
+        try:
+            self.queues[index].put_nowait(payload)
+        except queue.Full:
+            INGRESS_FULL.inc(index)
+            return False
+        INGRESS_UPDATES.inc(index)
+        return True
+
+    async def supervise(self):
+        # A restarted worker reloads its users' flow state from the database and gets a new
+        # queue holding whatever was left in the old one, so only the updates the dead
+        # process had already taken are lost. Until then its queue fills up and the webhook
+        # answers 503 (polling pauses).
+        while not self.stopping:
+            await asyncio.sleep(WORKER_CHECK_SECONDS)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if self.stopping or process.is_alive():
+                    continue
+                if self.restart_at[index] is None:
+                    uptime = now - self.started[index]
+                    delay = (
+                        WORKER_CHECK_SECONDS if uptime >= WORKER_STABLE_SECONDS
+                        else min(WORKER_RESTART_MAX_DELAY, 2 * self.restart_delay[index])
+                    )
+                    self.restart_delay[index] = delay
+                    self.restart_at[index] = now + delay
+                    logger.error(
+                        "Worker %d exited with code %s after %.0fs; restarting it in %.0fs (%d updates queued for it)",
+                        index, process.exitcode, uptime, delay, self.queues[index].qsize(),
+                    )
+                elif now >= self.restart_at[index]:
+                    self.restart_at[index] = None
+                    moved = self._replace_queue(index)
+                    logger.info("Moved %d queued update(s) to the new worker %d", moved, index)
+                    WORKER_RESTARTS.inc(index)
+                    self._spawn(index)
+
+    def _replace_queue(self, index: int) -> int:
+        # Blocking, but the old queue holds at most WORKER_QUEUE_SIZE small updates. Nothing
+        # dispatches to either queue meanwhile, so their order is kept. Workers never wait
+        # inside get(), so the dead one is unlikely to have left the read lock taken; if it
+        # did, get() times out and what is still in the old queue is dropped.
+        old, fresh = self.queues[index], self.mp.Queue(WORKER_QUEUE_SIZE)
+        moved = 0
+        while True:
+            try:
+                fresh.put_nowait(old.get(timeout=WORKER_DRAIN_TIMEOUT))
+            except queue.Empty:
+                break
+            moved += 1
+        if old.qsize():
+            logger.warning("Dropped %d update(s) left in the old queue of worker %d", old.qsize(), index)
+            old.cancel_join_thread()
+        old.close()
+        self.queues[index] = fresh
+        return moved
+
+    def stop(self):
+        # Blocking. Workers finish what is already queued for them, then exit. Updates
+        # queued for workers that never started (startup failed) are dropped.
+        self.stopping = True
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for q, process in zip(self.queues, self.processes):
+            if process is None:
+                q.cancel_join_thread()
+                continue
+            try:
+                q.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Worker %d did not stop in %ss; terminating it", index, WORKER_STOP_TIMEOUT)
+                process.terminate()
+                process.join()
+
+worker_pool: Optional[WorkerPool] = None
+
+GaugeMetric(
+    "bot_ingress_queue_depth", "Updates queued for each worker.",
+    lambda: worker_pool.depths() if worker_pool is not None else {}, ("worker",),
+)
+
+def ingress_endpoint(pool: WorkerPool) -> HttpRoute:
+    async def receive(request: HttpRequest) -> HttpResponse:
+        if not webhook_authorized(request):
+            return 403, "text/plain", b""
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return 400, "text/plain", b""
+        if not isinstance(data, dict):
+            return 400, "text/plain", b""
+        # 503 makes Telegram retry the update later instead of it piling up here.
+        if not pool.dispatch(raw_update_user_id(data), data):
+            return 503, "text/plain", b""
+        return 200, "text/plain", b""
+    return receive
+
+async def forward_polled(pool: WorkerPool, polled: "asyncio.Queue[Update]"):
+    while True:
+        update = await polled.get()
+        payload = update.to_dict()
+        user_id = update_user_id(update)
+        # While the worker is behind, ``polled`` fills up and the updater stops fetching,
+        # so the backlog stays with Telegram.
+        while not pool.dispatch(user_id, payload):
+            await asyncio.sleep(0.05)
+
+def prepare_database():
+    # Once, before any worker starts: the workers then find the schema, the catalog and
+    # the backfill boundaries in place instead of racing to create them.
+    with startup.phase("engine"):
+        connect_database()
+    with startup.phase("migrations"):
+        migrate()
+    with startup.phase("catalog"):
+        seed_catalog()
+    with startup.phase("boundaries"):
+        prepare_stats_backfill()
+        prepare_name_token_backfill()
+    engine.dispose()
+
+async def run_ingress():
+    # Updates are received (and queued for the workers, up to WORKER_QUEUE_SIZE each)
+    # while the database is prepared; the workers start once it is.
+    global worker_pool
+    pool = worker_pool = WorkerPool(BOT_WORKERS)
+    supervisor = None
+
+    base_url = TELEGRAM_API_URL.rstrip("/") + "/bot" if TELEGRAM_API_URL else "https://api.telegram.org/bot"
+    bot = Bot(BOT_TOKEN, base_url=base_url, request=InstrumentedRequest(), get_updates_request=InstrumentedRequest())
+    server = HttpServer(port=HTTP_PORT if BOT_MODE == "webhook" else (metrics_server_port() or HTTP_PORT))
+    server.route("GET", "/healthz", healthz)
+    server.route("GET", "/ready", ready_endpoint)
+    if METRICS_PORT.lower() != "off":
+        server.route("GET", "/metrics", metrics_endpoint)
+    polled: "asyncio.Queue[Update]" = asyncio.Queue(WORKER_QUEUE_SIZE)
+    updater = Updater(bot, polled)
+    forwarder = None
+
+    stop = stop_on_signals(signal.SIGINT, signal.SIGTERM)
+    try:
+        with startup.phase("telegram"):
+            await bot.initialize()
+            if BOT_MODE == "webhook":
+                server.route("POST", WEBHOOK_PATH, ingress_endpoint(pool))
+                await server.start()
+                await register_webhook(bot)
+            else:
+                await server.start()
+                await updater.initialize()
+                await updater.start_polling(drop_pending_updates=DROP_PENDING_UPDATES, allowed_updates=Update.ALL_TYPES)
+                forwarder = asyncio.create_task(forward_polled(pool, polled), name="ingress-forwarder")
+        await asyncio.get_running_loop().run_in_executor(None, prepare_database)
+        with startup.phase("workers"):
+            pool.start()
+        supervisor = asyncio.create_task(pool.supervise(), name="worker-supervisor")
+        startup.finish()
+        await stop.wait()
+    finally:
+        if updater.running:
+            await updater.stop()
+        await server.stop()
+        if forwarder is not None and supervisor is not None:
+            # Telegram already counts these as delivered; hand them over before stopping.
+            deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+            while not polled.empty() and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        tasks = [t for t in (forwarder, supervisor) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(None, pool.stop)
+        await updater.shutdown()
+        await bot.shutdown()
+
+async def run_worker(updates: "multiprocessing.Queue"):
+    application = build_application()
+    stop = stop_on_signals(signal.SIGTERM)
+    async with running(application):
+        logger.info("Worker %d started", worker_index)
+        while not stop.is_set():
+            # Polled rather than a blocking get(): a worker killed while waiting inside get()
+            # would keep the queue's read lock and the ingress could not drain the queue.
+            try:
+                data = updates.get_nowait()
+            except queue.Empty:
+                await asyncio.sleep(WORKER_POLL_SECONDS)
+                continue
+            if data is None:
+                break
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+def worker_main(index: int, updates: "multiprocessing.Queue"):
+    global worker_index
+    worker_index = index
+    # Ctrl+C reaches the whole process group; the ingress decides when workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_context.set({"worker": index})
+    if update_recorder is not None:
+        update_recorder.path = worker_log_path(update_recorder.path, index)
+    asyncio.run(run_worker(updates))
+
 # ----------------------- App bootstrap -----------------------
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+# Long-running loops started on startup; cancelled on shutdown. (Application.create_task
+# is not used for these because Application.stop() waits for those tasks to finish.)
+background_tasks: List[asyncio.Task] = []
+metrics_server: Optional[HttpServer] = None
+
+class Startup:
+    """Startup phases and how long each took, for /ready, /status and the metrics.
+
+    ``import`` is loading this module and ``telegram`` is building the application and
+    initializing the bot (getMe). The database phases run after the bot is already
+    taking updates, which wait for ``db_ready``.
+    """
+
+    def __init__(self):
+        self.current = "import"
+        self.seconds: Dict[str, float] = {}
+        self.ready = False
+        self.error: Optional[str] = None
+        self.telegram_started = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        self.current = name
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = time.perf_counter() - started
+
+    def state(self) -> str:
+        if self.error:
+            return f"failed: {self.error}"
+        return "ready" if self.ready else f"starting: {self.current}"
+
+    def finish(self):
+        self.ready = True
+        logger.info(
+            "Ready in %.0f ms (%s)", (time.perf_counter() - IMPORT_STARTED) * 1000,
+            ", ".join(f"{name} {s * 1000:.0f} ms" for name, s in self.seconds.items()),
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"state": self.state(), **{f"{name}_ms": round(s * 1000) for name, s in self.seconds.items()}}
+
+startup = Startup()
+
+GaugeMetric(
+    "bot_startup_phase_seconds", "Time each startup phase took.",
+    lambda: {(name,): s for name, s in startup.seconds.items()}, ("phase",),
+)
+GaugeMetric("bot_ready", "1 once startup has finished.", lambda: {(): int(startup.ready)})
+
+async def on_startup(application: Application):
+    # Returns quickly: from here on updates are taken, and what needs the database waits
+    # for start_database (confirmations queue in the writer).
+    global metrics_server
+    startup.seconds["telegram"] = time.perf_counter() - startup.telegram_started
+    reg_writer.start()
+    if update_recorder is not None:
+        update_recorder.start()
+        logger.info("Recording updates to %s", update_recorder.path)
+    port = metrics_server_port()
+    if port is not None:
+        metrics_server = HttpServer(port=port)
+        metrics_server.route("GET", "/metrics", metrics_endpoint)
+        metrics_server.route("GET", "/healthz", healthz)
+        metrics_server.route("GET", "/ready", ready_endpoint)
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            # Metrics are optional; a taken port must not keep the bot (or a worker) down.
+            logger.warning("Metrics server not started on port %d: %s", port, e)
+            metrics_server = None
+    background_tasks.append(asyncio.create_task(start_database(application), name="startup"))
+
+async def start_database(application: Application):
+    # Uses in_executor directly: run_db would wait for the db_ready this sets.
+    try:
+        with startup.phase("engine"):
+            await in_executor(bulk_executor, connect_database)
+        with startup.phase("migrations"):
+            applied = await in_executor(bulk_executor, migrate)
+            if applied:
+                logger.info("Applied schema migration(s) %s", ", ".join(map(str, applied)))
+        with startup.phase("catalog"):
+            await in_executor(db_executor, seed_catalog)
+            install_catalog(await in_executor(db_executor, load_catalog))
+        with startup.phase("boundaries"):
+            # Fixed before db_ready lets the writer's first batch through.
+            backfill_upto = await in_executor(db_executor, prepare_stats_backfill)
+            token_backfill = await in_executor(db_executor, prepare_name_token_backfill)
+        with startup.phase("indexes"):
+            duplicate_guard.degraded_indexes = await in_executor(bulk_executor, degraded_registration_indexes)
+    except Exception as e:
+        # Waiting handlers fail instead of hanging, and the bot stops so it can be restarted.
+        logger.critical("Startup failed in phase %s: %s", startup.current, e, exc_info=True)
+        startup.error = f"{startup.current}: {e}"
+        database_failed(e)
+        signal.raise_signal(signal.SIGTERM)
+        return
+    db_ready.set()
+    startup.finish()
+    if duplicate_guard.degraded_indexes:
+        logger.warning(
+            "Existing duplicates prevent unique index(es) %s; relying on the app-level check",
+            ", ".join(duplicate_guard.degraded_indexes),
+        )
+    duplicate_guard.start()
+    if is_primary_worker():
+        admin_notifier.start(application.bot)
+        broadcaster.start(application.bot)
+        archiver.start()
+    background_tasks.append(asyncio.create_task(catalog_watcher(), name="catalog-watcher"))
+    if backfill_upto and is_primary_worker():
+        background_tasks.append(asyncio.create_task(stats_backfill(backfill_upto), name="stats-backfill"))
+    if token_backfill and is_primary_worker():
+        background_tasks.append(asyncio.create_task(name_token_backfill(*token_backfill), name="name-token-backfill"))
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # Runs in a copy of the failing update's context, so the record carries its ids.
+    logger.error("Unhandled error while handling an update: %s", context.error, exc_info=context.error)
+
+async def on_shutdown(application: Application):
+    global metrics_server
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if not db_ready.is_set():
+        # Stopped before the database was ready: what is queued cannot be saved.
+        database_failed(RuntimeError("Shutting down before the database was ready."))
+    await reg_writer.stop()
+    await duplicate_guard.stop()
+    await admin_notifier.stop()
+    await broadcaster.stop()
+    await archiver.stop()
+    if update_recorder is not None:
+        await update_recorder.stop()
+    db_executor.shutdown(wait=True)
+    bulk_executor.shutdown(wait=True)
+    if engine is not None:
+        engine.dispose()
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    # request replaces the HTTP client for every Bot API call (bench_flow.py passes a fake).
+    check_config()
+    startup.current = "telegram"
+    startup.telegram_started = time.perf_counter()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        .persistence(StatePersistence())
+        .concurrent_updates(update_scheduler)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL.rstrip("/") + "/bot")
+    application = builder.build()
+    if update_recorder is not None:
+        application.add_handler(TypeHandler(Update, update_recorder.record), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("cancel", cancel_cmd))
+    application.add_handler(CommandHandler("status", status_cmd, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("export", export_cmd, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("stats", stats_cmd, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("broadcast", broadcast_cmd, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("find", find_cmd, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("import", import_cmd, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("reload_catalog", reload_catalog_cmd, filters=filters.User(user_id=ADMIN_ID)))
     application.add_handler(CallbackQueryHandler(cb_handler, pattern=r"^reg:"))
+    application.add_handler(CallbackQueryHandler(find_cb, pattern=r"^find:"))
     application.add_handler(MessageHandler(filters.CONTACT, contact_handler))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r"^/import\b") & filters.User(user_id=ADMIN_ID), import_document,
+    ))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
-    application.run_polling(drop_pending_updates=True)
+    application.add_error_handler(on_error)
+    return application
+
+def main():
+    check_config()
+    if BOT_WORKERS > 1:
+        asyncio.run(run_ingress())
+        return
+    application = build_application()
+    if BOT_MODE == "webhook":
+        asyncio.run(serve_webhook(application))
+    else:
+        application.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
+    if startup.error:
+        raise SystemExit(f"Startup failed in {startup.error}")
+
+startup.seconds["import"] = time.perf_counter() - IMPORT_STARTED
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
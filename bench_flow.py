@@ -0,0 +1,195 @@
+# Offline load test of the registration flow. Simulated users go /start -> reg:start ->
+# course -> level -> section -> name/age/phone -> reg:confirm through Main's real handlers,
+# update scheduler, persistence and registration writer, against an in-process fake Bot API
+# and a throwaway SQLite database. No Telegram, no network.
+#
+#   python bench_flow.py --users 5000 --concurrency 500
+#   python bench_flow.py --users 2000 --save baseline.json
+#   python bench_flow.py --users 2000 --compare baseline.json    # exit code 1 on regression
+#   python bench_flow.py --database-url postgresql+psycopg2://localhost/scratch
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fake_telegram import FakeBotRequest, registration_flow
+
+STEPS = ("start", "register", "course", "level", "section", "name", "age", "phone", "confirm")
+
+def load_main(database_url: Optional[str], verbose: bool = False):
+    """Import Main against database_url, or a temporary SQLite file.
+
+    Returns (Main, tmpdir); clean up tmpdir (when not None) after the run.
+    """
+    tmpdir = None
+    if not database_url:
+        tmpdir = tempfile.TemporaryDirectory(prefix="bench_flow_")
+        path = os.path.join(tmpdir.name, "bench.db")
+        # WAL lets the writer, persistence and lookups overlap like they do on Postgres.
+        sqlite3.connect(path).execute("PRAGMA journal_mode=WAL").close()
+        database_url = f"sqlite:///{path}"
+
+    # Main reads its configuration at import time.
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ["METRICS_PORT"] = "off"
+    # Simulated load is the point here; per-user flood limits stay on.
+    os.environ.setdefault("FLOOD_GLOBAL_RATE", "0")
+    os.environ.pop("RECORD_UPDATES_PATH", None)
+    import Main
+
+    if not verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    return Main, tmpdir
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    q = statistics.quantiles(ordered, n=100, method="inclusive") if len(ordered) > 1 else ordered * 99
+    return {"n": len(ordered), "p50": q[49] * 1000, "p95": q[94] * 1000, "p99": q[98] * 1000, "max": ordered[-1] * 1000}
+
+def plan_users(Main, args) -> List[Tuple[int, str, Optional[str], str]]:
+    # Drawn up front from the seed so every run sends exactly the same updates.
+    rng = random.Random(args.seed)
+    catalog = Main.catalog
+    plans = []
+    for i in range(args.users):
+        course = rng.choice(list(catalog.courses))
+        level = rng.choice(list(catalog.levels)) if course in catalog.courses_with_level else None
+        section = rng.choice(list(catalog.sections_for(course)))
+        plans.append((args.first_user_id + i, course, level, section))
+    return plans
+
+async def run_user(app, plan, latencies: Dict[str, List[float]], think: float, rng: random.Random):
+    from telegram import Update
+
+    uid, course, level, section = plan
+    for step, payload in registration_flow(uid, course, level, section):
+        update = Update.de_json(payload, app.bot)
+        started = time.perf_counter()
+        # Same path as a real update: per-user ordering and concurrency caps included.
+        await app.update_processor.process_update(update, app.process_update(update))
+        latencies[step].append(time.perf_counter() - started)
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+async def bench(Main, args) -> Dict[str, Any]:
+    fake = FakeBotRequest(latency=args.api_latency_ms / 1000)
+    app = Main.build_application(request=fake)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    plans = plan_users(Main, args)
+    latencies: Dict[str, List[float]] = {step: [] for step in STEPS}
+    gate = asyncio.Semaphore(args.concurrency)
+    rng = random.Random(args.seed)
+
+    async def one(plan):
+        async with gate:
+            await run_user(app, plan, latencies, args.think_ms / 1000, rng)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(plan) for plan in plans))
+    elapsed = time.perf_counter() - started
+
+    saved = await Main.run_db(count_registrations, Main, args.first_user_id, args.first_user_id + args.users)
+    writer = Main.reg_writer.snapshot()
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+    updates = sum(len(v) for v in latencies.values())
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "api_latency_ms": args.api_latency_ms,
+        "elapsed_s": elapsed,
+        "updates": updates,
+        "updates_per_s": updates / elapsed,
+        "registrations_per_s": saved / elapsed,
+        "saved": saved,
+        "api_calls": sum(fake.calls.values()),
+        "avg_batch_size": writer["avg_batch_size"],
+        "steps": {step: percentiles(v) for step, v in latencies.items() if v},
+        "all": percentiles([x for v in latencies.values() for x in v]),
+    }
+
+def count_registrations(Main, lo: int, hi: int) -> int:
+    with Main.SessionLocal() as session:
+        return session.scalar(
+            Main.select(Main.func.count()).select_from(Main.Registration)
+            .where(Main.Registration.tg_user_id >= lo, Main.Registration.tg_user_id < hi)
+        )
+
+def report(result: Dict[str, Any]):
+    print(
+        f"{result['users']} users (concurrency {result['concurrency']}, Bot API latency {result['api_latency_ms']} ms): "
+        f"{result['updates']} updates in {result['elapsed_s']:.2f}s = {result['updates_per_s']:.0f} updates/s, "
+        f"{result['registrations_per_s']:.0f} registrations/s, avg write batch {result['avg_batch_size']}"
+    )
+    print(f"{'step':10s} {'n':>7s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'max ms':>9s}")
+    for step, p in list(result["steps"].items()) + [("all", result["all"])]:
+        print(f"{step:10s} {p['n']:7d} {p['p50']:9.2f} {p['p95']:9.2f} {p['p99']:9.2f} {p['max']:9.2f}")
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    # Sub-millisecond wobble is noise, not a regression.
+    problems = []
+    if result["updates_per_s"] < baseline["updates_per_s"] * (1 - tolerance):
+        problems.append(f"throughput {result['updates_per_s']:.0f}/s vs {baseline['updates_per_s']:.0f}/s")
+    for step, p in result["steps"].items():
+        base = baseline["steps"].get(step)
+        if not base:
+            continue
+        for q in ("p95", "p99"):
+            if p[q] > base[q] * (1 + tolerance) and p[q] - base[q] > 1.0:
+                problems.append(f"{step} {q} {p[q]:.2f} ms vs {base[q]:.2f} ms")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the registration flow")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200, help="users in the flow at the same time")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a user's steps")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="delay of every fake Bot API call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    parser.add_argument("--database-url", help="scratch database instead of a temporary SQLite file")
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--compare", help="baseline JSON from --save; exit 1 if slower")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs baseline, default 20%%")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    Main, tmpdir = load_main(args.database_url, args.verbose)
+    try:
+        result = asyncio.run(bench(Main, args))
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+    report(result)
+
+    if result["saved"] != args.users:
+        print(f"ERROR: {args.users} users confirmed but {result['saved']} registrations were saved")
+        sys.exit(2)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        if problems:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Micro-benchmark: compiled callback router vs. the old if/startswith chain in cb_handler.
+# Only dispatch is measured (handlers are no-ops), first on its own and then with the
+# logging each version of cb_handler does per callback: the old chain an INFO log, the
+# router a sampled trace. Importing Main needs no environment or database, so this runs
+# anywhere.
+#
+#   python bench_router.py [--number 200000]
+import argparse
+import logging
+import timeit
+
+import Main
+
+SAMPLE = [
+    ("reg:start", None),
+    ("reg:course:english", "choose_course"),
+    ("reg:course:math", "choose_course"),
+    ("reg:level:B1", "choose_level"),
+    ("reg:section:general", "choose_section"),
+    ("reg:back:courses", "choose_level"),
+    ("reg:back:levels", "choose_section"),
+    ("reg:confirm", "review"),
+    ("reg:edit", "review"),
+    ("reg:edit:phone", "edit_menu"),
+    ("reg:back:review", "edit_menu"),
+    ("reg:cancel", "review"),
+]
+
+# The old cb_handler's INFO log per callback, sent to a handler-less logger here.
+legacy_logger = logging.getLogger("bench.legacy")
+legacy_logger.propagate = False
+legacy_logger.setLevel(logging.INFO)
+
+def legacy_log(data: str, step):
+    legacy_logger.info("Callback data: %s", data)
+
+# cb_handler's trace, to a handler-less logger: only the sampling and record cost count.
+Main.trace_logger.propagate = False
+
+def router_log(data: str, step):
+    if Main.trace_sampled():
+        Main.trace_logger.info("Callback %s at step %s", data, step)
+
+# Same branch order, comparisons and per-branch split as the old cb_handler.
+def legacy_dispatch(data: str, step):
+    if data == "reg:cancel":
+        return "cancel"
+    if data == "reg:start":
+        return "start"
+    if data == "reg:back:courses":
+        return "back_courses"
+    if data == "reg:back:levels":
+        return "back_levels"
+    if data == "reg:back:review":
+        return "back_review"
+    if data.startswith("reg:course:"):
+        return data.split(":")[2] in Main.COURSES
+    if data.startswith("reg:level:"):
+        return data.split(":")[2] in Main.LEVELS
+    if data.startswith("reg:section:"):
+        return data.split(":")[2]
+    if data == "reg:confirm":
+        return "confirm"
+    if data == "reg:edit":
+        return "edit"
+    if data.startswith("reg:edit:"):
+        field = data.split(":")[2]
+        for name in ("course", "level", "section", "name", "age", "phone"):
+            if field == name:
+                return name
+    return None
+
+def router_dispatch(data: str, step):
+    route, arg = Main.reg_router.resolve(data)
+    return route is not None and route.allows(step) and route.handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Callback dispatch micro-benchmark")
+    parser.add_argument("--number", type=int, default=200_000, help="callbacks per run")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    sample = (SAMPLE * (args.number // len(SAMPLE) + 1))[: args.number]
+
+    def runner(dispatch, log=None):
+        def run():
+            for data, step in sample:
+                if log is not None:
+                    log(data, step)
+                dispatch(data, step)
+        return run
+
+    cases = (
+        ("legacy chain", runner(legacy_dispatch)),
+        ("compiled router", runner(router_dispatch)),
+        ("legacy + INFO log", runner(legacy_dispatch, legacy_log)),
+        ("router + trace", runner(router_dispatch, router_log)),
+    )
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print(f"{name:18s} {best * 1e9 / args.number:8.1f} ns/callback  ({args.number} callbacks, best of {args.repeat})")
+
+if __name__ == "__main__":
+    main()
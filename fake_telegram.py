@@ -0,0 +1,119 @@
+# Fake Telegram for the local harnesses (webhook_harness.py, bench_flow.py): canned Bot API
+# results, an in-process request class that returns them, and Update payloads for the
+# registration flow. Nothing here talks to the network.
+import asyncio
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+# ----------------------- Bot API results -----------------------
+_message_ids = itertools.count(1000)
+_message_ids_lock = threading.Lock()
+
+def api_result(method: str, params: Dict[str, Any]) -> Any:
+    if method == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+    if method == "getUpdates":
+        return []
+    if method in ("sendMessage", "editMessageText"):
+        with _message_ids_lock:
+            message_id = next(_message_ids)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            "text": params.get("text", ""),
+        }
+    return True
+
+class FakeBotRequest(BaseRequest):
+    """In-process Bot API: answers every call with ``api_result``, after ``latency`` seconds."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None, *args, **kwargs) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.json_parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": api_result(api_method, params)}).encode()
+
+# ----------------------- Updates -----------------------
+_ids = itertools.count(1)
+
+def _user(uid: int) -> Dict[str, Any]:
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+def message_update(uid: int, text: str) -> Dict[str, Any]:
+    message = {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": _user(uid),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_ids), "message": message}
+
+def contact_update(uid: int, phone: str) -> Dict[str, Any]:
+    update = message_update(uid, "")
+    del update["message"]["text"]
+    update["message"]["contact"] = {"phone_number": phone, "first_name": f"User{uid}", "user_id": uid}
+    return update
+
+def callback_update(uid: int, data: str) -> Dict[str, Any]:
+    return {
+        "update_id": next(_ids),
+        "callback_query": {
+            "id": str(next(_ids)),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "text": "",
+            },
+        },
+    }
+
+def sample_phone(uid: int) -> str:
+    return f"+99890{uid % 10_000_000:07d}"
+
+def registration_flow(uid: int, course: str = "english", level: Optional[str] = "B1",
+                      section: str = "general") -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """One user's complete signup as (step, update) pairs; ``level`` is skipped when None."""
+    yield "start", message_update(uid, "/start")
+    yield "register", callback_update(uid, "reg:start")
+    yield "course", callback_update(uid, f"reg:course:{course}")
+    if level is not None:
+        yield "level", callback_update(uid, f"reg:level:{level}")
+    yield "section", callback_update(uid, f"reg:section:{section}")
+    yield "name", message_update(uid, "Alamozon Alovuddinov")
+    yield "age", message_update(uid, "21")
+    yield "phone", message_update(uid, sample_phone(uid))
+    yield "confirm", callback_update(uid, "reg:confirm")
+
+def sample_flow(uid: int) -> Iterator[Dict[str, Any]]:
+    for _, update in registration_flow(uid):
+        yield update
@@ -0,0 +1,186 @@
+# Replay an update log written with RECORD_UPDATES_PATH through Main's real handlers,
+# update scheduler and registration writer, against the fake Bot API and a temporary SQLite
+# database (as in bench_flow.py). Reports latency per update kind and the updates where the
+# replayed flow was at a different step than production was.
+#
+#   python replay_updates.py updates.jsonl.gz                # real time
+#   python replay_updates.py updates.jsonl.gz --speed 10     # 10x faster
+#   python replay_updates.py updates.jsonl.gz --speed 0      # as fast as possible
+#   python replay_updates.py updates.w*.jsonl.gz             # one log per worker (BOT_WORKERS)
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List
+
+from bench_flow import load_main, percentiles
+from fake_telegram import FakeBotRequest, callback_update, contact_update, message_update
+
+def read_log(path: str) -> List[Dict[str, Any]]:
+    # Offsets restart with every recording session; sessions are laid end to end.
+    records = []
+    base = last = 0.0
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "session" in record:
+                base = last
+                continue
+            record["t"] = last = base + record["t"]
+            records.append(record)
+    return records
+
+def read_logs(paths: List[str]) -> List[Dict[str, Any]]:
+    # Workers start together, so their logs interleave on a shared clock.
+    records = [record for path in paths for record in read_log(path)]
+    records.sort(key=lambda record: record["t"])
+    return records
+
+def to_update(record: Dict[str, Any]) -> Dict[str, Any]:
+    if record["k"] == "cb":
+        return callback_update(record["u"], record["v"])
+    if record["k"] == "contact":
+        return contact_update(record["u"], record["v"])
+    return message_update(record["u"], record["v"])
+
+def label(Main, record: Dict[str, Any]) -> str:
+    if record["k"] == "cb":
+        route, _ = Main.reg_router.resolve(record["v"])
+        return f"cb {route.name if route else '?'}"
+    if record["k"] == "cmd":
+        return record["v"]
+    return f"{record['k']}@{record['s'] or '-'}"
+
+class DivergenceCheck:
+    """Compares the step each replayed update finds with the step recorded in production.
+
+    A user whose recording starts mid-flow cannot match until the flow resets (e.g. /start),
+    so each user is only checked once their replayed step has matched the recording once.
+    """
+
+    def __init__(self):
+        self.expected: Dict[int, Dict[str, Any]] = {}
+        self.synced = set()
+        self.users = set()
+        self.diverged: List[Dict[str, Any]] = []
+
+    async def __call__(self, update, context):
+        record = self.expected.pop(update.update_id, None)
+        if record is None:
+            return
+        user_id = record["u"]
+        self.users.add(user_id)
+        actual = context.user_data.get("step")
+        if actual == record["s"]:
+            self.synced.add(user_id)
+        elif user_id in self.synced:
+            self.diverged.append({**record, "actual": actual})
+
+async def replay(Main, args, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    # The log only holds updates that production's flood guard admitted; at replay speed
+    # the guard would shed them again.
+    Main.update_scheduler.guard = None
+    app = Main.build_application(request=FakeBotRequest(latency=args.api_latency_ms / 1000))
+    check = DivergenceCheck()
+    app.add_handler(TypeHandler(Update, check), group=-2)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    inflight = asyncio.Semaphore(args.max_inflight)
+    tasks = []
+    max_lag = 0.0
+
+    async def one(record, update):
+        try:
+            started = time.perf_counter()
+            await app.update_processor.process_update(update, app.process_update(update))
+            latencies[label(Main, record)].append(time.perf_counter() - started)
+        finally:
+            inflight.release()
+
+    started = time.perf_counter()
+    for record in records:
+        if args.speed > 0:
+            lag = time.perf_counter() - started - record["t"] / args.speed
+            if lag < 0:
+                await asyncio.sleep(-lag)
+            max_lag = max(max_lag, lag)
+        await inflight.acquire()
+        update = Update.de_json(to_update(record), app.bot)
+        check.expected[update.update_id] = record
+        tasks.append(asyncio.create_task(one(record, update)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+    return {
+        "updates": len(records),
+        "elapsed_s": elapsed,
+        "max_lag_s": max_lag,
+        "latencies": {k: percentiles(v) for k, v in latencies.items()},
+        "all": percentiles([x for v in latencies.values() for x in v]) if records else None,
+        "users": len(check.users),
+        "unsynced_users": len(check.users - check.synced),
+        "diverged": check.diverged,
+    }
+
+def report(Main, result: Dict[str, Any], show: int):
+    print(
+        f"Replayed {result['updates']} updates from {result['users']} users in {result['elapsed_s']:.2f}s "
+        f"({result['updates'] / result['elapsed_s']:.0f}/s), max schedule lag {result['max_lag_s'] * 1000:.0f} ms"
+    )
+    print(f"{'update':28s} {'n':>7s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'max ms':>9s}")
+    rows = sorted(result["latencies"].items(), key=lambda kv: -kv[1]["n"]) + [("all", result["all"])]
+    for name, p in rows:
+        print(f"{name:28s} {p['n']:7d} {p['p50']:9.2f} {p['p95']:9.2f} {p['p99']:9.2f} {p['max']:9.2f}")
+
+    diverged = result["diverged"]
+    print(
+        f"\nDivergences: {len(diverged)} update(s) from {len({d['u'] for d in diverged})} user(s); "
+        f"{result['unsynced_users']} user(s) never matched the recording (started mid-flow)"
+    )
+    transitions = Counter((label(Main, d), d["s"], d["actual"]) for d in diverged)
+    for (name, expected, actual), n in transitions.most_common(show):
+        print(f"  {n:6d}  {name:28s} recorded at {expected!s:15s} replayed at {actual}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded update log")
+    parser.add_argument("logs", nargs="+", help="file(s) written with RECORD_UPDATES_PATH (.gz or plain)")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = real time, N = N times faster, 0 = no pauses")
+    parser.add_argument("--max-inflight", type=int, default=1000, help="updates dispatched but not finished")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="delay of every fake Bot API call")
+    parser.add_argument("--database-url", help="scratch database instead of a temporary SQLite file")
+    parser.add_argument("--show", type=int, default=10, help="divergence patterns to list")
+    parser.add_argument("--fail-on-divergence", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    records = read_logs(args.logs)
+    if not records:
+        print("No updates in the log.")
+        return
+    Main, tmpdir = load_main(args.database_url, args.verbose)
+    try:
+        result = asyncio.run(replay(Main, args, records))
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+    report(Main, result, args.show)
+    if args.fail_on_divergence and result["diverged"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Local webhook harness for Main.py (BOT_MODE=webhook), no Telegram involved.
+#
+#   1) Stub Bot API that answers every method call:
+#        python webhook_harness.py stub --port 8081
+#   2) Bot in webhook mode, talking to the stub:
+#        BOT_MODE=webhook WEBHOOK_SECRET=dev TELEGRAM_API_URL=http://127.0.0.1:8081 python Main.py
+#   3) POST recorded updates (JSON lines, one Update per line) or a generated sample:
+#        python webhook_harness.py post --secret dev updates.jsonl
+#        python webhook_harness.py post --secret dev --sample-users 50
+import argparse
+import http.client
+import itertools
+import json
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from fake_telegram import api_result, sample_flow
+
+# ----------------------- Stub Bot API -----------------------
+class StubBotApi(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            params = json.loads(raw) if raw and "json" in (self.headers.get("Content-Type") or "") else {}
+        except ValueError:
+            params = {}
+        payload = json.dumps({"ok": True, "result": api_result(method, params)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_stub(port: int):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubBotApi)
+    print(f"Stub Bot API on http://127.0.0.1:{port}", file=sys.stderr)
+    server.serve_forever()
+
+# ----------------------- Poster -----------------------
+def post_stream(url: str, secret: str, updates: List[bytes]) -> List[float]:
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+    latencies = []
+    for body in updates:
+        started = time.perf_counter()
+        conn.request("POST", parts.path or "/", body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if resp.status != 200:
+            raise SystemExit(f"Webhook answered {resp.status}")
+    conn.close()
+    return latencies
+
+def run_post(args):
+    if args.sample_users:
+        streams = [
+            [json.dumps(u).encode() for u in sample_flow(args.first_user_id + i)]
+            for i in range(args.sample_users)
+        ]
+    else:
+        # Recorded updates are replayed in order; keep one user's updates on one connection.
+        by_user: Dict[int, List[bytes]] = {}
+        with open(args.file, "rb") as f:
+            for line in f:
+                if line.strip():
+                    update = json.loads(line)
+                    body = update.get("message") or update.get("callback_query") or {}
+                    by_user.setdefault(body.get("from", {}).get("id", 0), []).append(line.strip())
+        streams = list(by_user.values())
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda s: post_stream(args.url, args.secret, s), streams))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(itertools.chain.from_iterable(results))
+    if not latencies:
+        print("No updates posted.")
+        return
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    print(
+        f"Posted {len(latencies)} updates in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s); "
+        f"ack ms p50={q[49]:.2f} p95={q[94]:.2f} p99={q[98]:.2f} max={latencies[-1]:.2f}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Local webhook harness for Main.py")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    stub = sub.add_parser("stub", help="run a stub Telegram Bot API")
+    stub.add_argument("--port", type=int, default=8081)
+    post = sub.add_parser("post", help="POST updates to the bot's webhook")
+    post.add_argument("file", nargs="?", help="JSON lines file with one Update per line")
+    post.add_argument("--url", default="http://127.0.0.1:8080/telegram")
+    post.add_argument("--secret", required=True)
+    post.add_argument("--sample-users", type=int, default=0)
+    post.add_argument("--first-user-id", type=int, default=100000)
+    post.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.cmd == "stub":
+        run_stub(args.port)
+    elif not args.file and not args.sample_users:
+        parser.error("give an updates file or --sample-users")
+    else:
+        run_post(args)
+
+if __name__ == "__main__":
+    main()